@@ -1,5 +1,12 @@
 #!/usr/bin/python
 from sys import *
+import os
+import re
+from collections import namedtuple
+from functools import partial
+import hashlib
+import cPickle
+from array import array
 '''
 Parallel Neptune processor assembler
 
@@ -219,13 +226,46 @@ opcode_tbl = [
 
 symbolTable = dict()
 
+#
+# Diagnostics
+#
+# Errors and warnings are collected, not printed, so that one run reports all
+# of them.
+#
+Diagnostic = namedtuple('Diagnostic', 'fileName lineNum col level message')
+diagnostics = []
+sourceName = ''     # file the diagnostics are for
+
+# lineNum 0: the diagnostic is about the whole file
+def diagnose(lineNum, col, message, level = 'error'):
+    diagnostics.append(Diagnostic(sourceName, lineNum, col, level, message))
+# returns the number of errors
+def errorCount():
+    return len([ d for d in diagnostics if d.level == 'error' ])
+# prints the diagnostics sorted by file and line
+def printDiagnostics(f = stdout):
+    for d in sorted(diagnostics):
+        if d.lineNum == 0:
+            f.write('{0:s}: {1:s}: {2:s}\n'.format(d.fileName, d.level, d.message))
+        else:
+            f.write('{0:s}:{1:d}:{2:d}: {3:s}: {4:s}\n'.format(d.fileName, d.lineNum, d.col, d.level, d.message))
+
+# size field: left and right nibble, Z is no size
+SIZE_TBL = {
+    'P'  : (255, 255),
+    'WP' : (255,   0),
+    'XS' : (  2,   2),
+    'X'  : (  2,   0),
+    'S'  : ( 31,  31),
+    'M'  : ( 31,   3),
+    'B'  : (  1,   0),
+    'W'  : ( 31,   0),
+    'A'  : (  4,   0),
+    'Z'  : (  0,   0)
+}
+
 def lookupOpcode(opcodeName, dechex):
-    for op in opcode_tbl:
-        if opcodeName == op[OP_NAME]:
-            if (op[OP_DECHEX] == dechex) or (dechex == ''):
-                print 'Found op: ', op
-                return op
-    return None
+    return opcodeIndex.get((opcodeName, dechex))
 
 def lookupSymbol(symName):
     if symName in symbolTable:
@@ -240,60 +280,109 @@ def addSymbol(symName, value):
 
 
 #
-# label: op.d.w r0,r1
+# label: op.d.w r0,r1 ; comment
 #
-#
-def tokenizeLine(line):
-    label = ''
-    opcode = ['', '', 'Z'] # opcode name, type, size
-    arg1 = ''
-    arg2 = ''
-    
-    # sym: op r0,r2
-    # sym:op r0,r1 ; comment
-    # op
-       
-    if ':' in line:
-        s = line.split(':')
-        label = s[0]
-        line = s[1]
-        
-    parts = line.split()  # at least one space between the opcode and the first argument
-    if len(parts) < 1:
-        return [label, opcode, arg1, arg2]
-
-    if len(parts) - 1 == 1:
-        if ',' in parts[1]:
-            args = parts[1].split(',')
-            arg1 = args[0]
-            arg2 = args[1]
-        else:
-            arg1 = parts[1]
-    elif len(parts) - 1 == 2:
-        arg1 = parts[1].rstrip(',')
-        arg2 = parts[2].lstrip(',')
-    
-    br_opcode = parts[0].upper().split('.')
-    if len(br_opcode) == 1:
-        opcode[0] = br_opcode[0]
-    elif len(br_opcode) == 2:
-        opcode[0] = br_opcode[0]
-        if br_opcode[1] != 'D' and br_opcode[1] != 'H':
-            if len(br_opcode) > 2:
-                return [label, opcode, arg1, arg2] # unknown type
-            else:
-                opcode[2] = br_opcode[1] # transfer size
+# [label:] [opcode[.type][.size] [arg1[,] [arg2]]], the comment is removed
+# before, directives are opcodes starting with '.'
+LABEL_SYNTAX = r'''
+    [ \t]*(?:([A-Za-z_]\w*)[ \t]*:)?          # label
+'''
+OP_SYNTAX = r'''
+    [ \t]*
+    (?:(\.?[A-Za-z_]\w*)([.\w]*)               # opcode and extensions
+        (?:[ \t]+([^\s,;]+)                    # first argument
+            (?:[ \t]*[, \t][ \t]*([^\s,;]+))?  # second argument
+        )?
+    )?
+    [ \t]*
+'''
+LABEL_RE = re.compile(LABEL_SYNTAX + OP_SYNTAX + r'\s*$', re.X)
+# lines without ':' can't have a label, the label group is always empty
+LINE_RE = re.compile('()' + OP_SYNTAX + r'\s*$', re.X)
+# matches up to the first error, for the columns of the messages
+PREFIX_RE = re.compile(LABEL_SYNTAX + OP_SYNTAX, re.X)
+OP_TYPES = ('D', 'H', 'B')
+
+# tokens of a line, text: the line without the comment
+class Tokens(namedtuple('Tokens', 'label name dechex size dst src text')):
+    __slots__ = ()
+
+    # column of the opcode
+    @property
+    def col(self):
+        return PREFIX_RE.match(self.text).start(2) + 1
+    # column of the arguments, of the opcode without arguments
+    @property
+    def acol(self):
+        m = PREFIX_RE.match(self.text)
+        if m.group(4) == None:
+            return m.start(2) + 1
+        return m.start(4) + 1
+
+# builds the tokens from a tuple without the keyword handling of Tokens()
+newTokens = partial(tuple.__new__, Tokens)
+# tokens by line without the comment, unrolled code repeats the same lines
+tokenIndex = dict()
+
+# type and size of the extensions of an opcode by their text
+extIndex = { '': ('', 'Z') }
+
+# returns the type and size of the extensions or None, errors are diagnosed
+def parseExt(ext, lineNum, col):
+    exts = ext.upper().split('.')
+    dechex = ''
+    size = 'Z'
+    if exts[0] != '':
+        diagnose(lineNum, col, 'Unexpected {0:s}'.format(ext))
+        return None
+    col += 1
+    exts = exts[1:]
+    if len(exts) == 1:
+        if exts[0] == 'D' or exts[0] == 'H':
+            dechex = exts[0]
         else:
-            opcode[1] = br_opcode[1]
-    elif len(br_opcode) == 3:
-        opcode[0] = br_opcode[0]
-        if br_opcode[1] != 'D' and br_opcode[1] != 'B':
-            return [label, opcode, arg1, arg2] # unknown type
-        opcode[1] = br_opcode[1] # transfer type
-        opcode[2] = br_opcode[2] # transfer size
+            size = exts[0]
+    elif len(exts) == 2:
+        if exts[0] not in OP_TYPES:
+            diagnose(lineNum, col, 'Unknown type {0:s}'.format(exts[0]))
+            return None
+        dechex = exts[0]
+        size = exts[1]
+        col += len(exts[0]) + 1
+    else:
+        diagnose(lineNum, col, 'Too many extensions {0:s}'.format(ext))
+        return None
+    if size not in SIZE_TBL:
+        diagnose(lineNum, col, 'Unknown size {0:s}'.format(size))
+        return None
+    extIndex[ext] = (dechex, size)
+    return dechex, size
+# returns the tokens of a line or None, errors are diagnosed
+def tokenizeLine(line, lineNum):
+    code = line.split(';', 1)[0]
+    t = tokenIndex.get(code)
+    if t != None:
+        return t
+    if ':' in code:
+        m = LABEL_RE.match(code)
+    else:
+        m = LINE_RE.match(code)
+    if m == None:
+        end = PREFIX_RE.match(code).end()
+        diagnose(lineNum, end + 1, 'Unexpected {0:s}'.format(code[end:].strip()))
+        return None
+    label, op, ext, arg1, arg2 = m.groups()
+    if op == None:
+        t = newTokens((label or '', '', '', 'Z', '', '', code))
     else:
-        return [label, opcode, arg1, arg2]
-    return [label, opcode, arg1, arg2]
+        dechex_size = extIndex.get(ext)
+        if dechex_size == None:
+            dechex_size = parseExt(ext, lineNum, m.start(3) + 1)
+            if dechex_size == None:
+                return None
+        t = newTokens((label or '', op.upper(), dechex_size[0], dechex_size[1], arg1 or '', arg2 or '', code))
+    tokenIndex[code] = t
+    return t
 
 # get register number
 def getReg(reg):
@@ -318,6 +407,8 @@ def getSymbolOrLiteral(reg):
     reg = reg.lstrip('#') # '#' is only to indicate that the argument is a number
     sym = lookupSymbol(reg)
     if sym == None:
+        if reg[:1].isalpha() or reg[:1] == '_': # register or unknown symbol
+            return None
         try:
             val = int(reg)
             return val
@@ -332,208 +423,1200 @@ def setDST(dst):
 def setSRC(src):
     return src << 16
 
+#
+# Encoders, one per operand type
+# name: opcode name for the messages, base: opcode bits
+# lineNum, t: line number and tokens of the line, for the messages
+# fl, fr: size field
+# dst, src: registers or None, dst_sym, src_sym: values or None
+# return the list of opcode words and the error flag, errors are diagnosed
+#
+def encTwoOp(name, base, lineNum, t, fl, fr, dst, src, dst_sym, src_sym):
+    # two arguments with size and type
+    if src == None:
+        if src_sym != None:
+            # return the CONSTANT version
+            return [ base + 0x01000000 + setDST(dst) + setSRC(src_sym) + (fl << 8) + fr ], False
+        diagnose(lineNum, t.acol, 'Two register arguments expected for {0:s}'.format(name))
+        return None, True
+    if dst == None:
+        diagnose(lineNum, t.acol, 'Two register arguments expected for {0:s}'.format(name))
+        return None, True
+    return [ base + setDST(dst) + setSRC(src) + (fl << 8) + fr ], False
+
+def encTwoOpS(name, base, lineNum, t, fl, fr, dst, src, dst_sym, src_sym):
+    # two arguments with size and without type
+    if dst == None or src == None:
+        diagnose(lineNum, t.acol, 'Two register arguments expected for {0:s}'.format(name))
+        return None, True
+    return [ base + setDST(dst) + setSRC(src) + (fl << 8) + fr ], False
+
+def encOneOp(name, base, lineNum, t, fl, fr, dst, src, dst_sym, src_sym):
+    # one argument with size and type
+    if dst == None or src != None:
+        diagnose(lineNum, t.acol, 'One register argument expected for {0:s}'.format(name))
+        return None, True
+    return [ base + setDST(dst) + (fl << 8) + fr ], False
+
+def encOneOpS(name, base, lineNum, t, fl, fr, dst, src, dst_sym, src_sym):
+    # one argument with size and type
+    if dst != None or src != None:
+        diagnose(lineNum, t.acol, 'One register argument expected for {0:s}'.format(name))
+        return None, True
+    return [ base + setDST(dst) + (fl << 8) + fr ], False
+
+def encLDN(name, base, lineNum, t, fl, fr, dst, src, dst_sym, src_sym):
+    # one register + literal argument
+    if dst == None or src_sym == None:
+        diagnose(lineNum, t.acol, 'One register argument plus one literal expected for {0:s}'.format(name))
+        return None, True
+    numnibs = 0x01000000
+    if src_sym > 0xFFFFF:
+        diagnose(lineNum, t.acol, 'Constant {0:x} exceeds range for {1:s}'.format(src_sym, name), 'warning')
+    elif src_sym > 0XFFFF:
+        numnibs = 0x05000000
+    elif src_sym > 0XFFF:
+        numnibs = 0x04000000
+    elif src_sym > 0XFF:
+        numnibs = 0x03000000
+    elif src_sym > 0XF:
+        numnibs = 0x02000000
+    return [ base + numnibs + setDST(dst) + (src_sym & 0xFFFFF) ], False
+
+def encLDB(name, base, lineNum, t, fl, fr, dst, src, dst_sym, src_sym):
+    # one register + literal argument
+    if dst == None or src_sym == None:
+        diagnose(lineNum, t.acol, 'One register argument plus one literal expected for {0:s}'.format(name))
+        return None, True
+    return [ base + setDST(dst) + (src_sym & 255) ], False
+
+def encNone(name, base, lineNum, t, fl, fr, dst, src, dst_sym, src_sym):
+    # no arguments
+    if dst != None and src_sym != None:
+        diagnose(lineNum, t.acol, 'No arguments expected for {0:s}'.format(name))
+        return None, True
+    return [ base ], False
+
+def encAbs(name, base, lineNum, t, fl, fr, dst, src, dst_sym, src_sym):
+    # absolute
+    if dst_sym == None:
+        diagnose(lineNum, t.acol, 'One absolute argument expected for {0:s}'.format(name))
+        return None, True
+    return [ base + (dst_sym & 65535) ], False
+
+def encLSAbs(name, base, lineNum, t, fl, fr, dst, src, dst_sym, src_sym):
+    # absolute
+    if dst == None or src_sym == None:
+        diagnose(lineNum, t.acol, 'One absolute argument expected for {0:s}'.format(name))
+        return None, True
+    return [ base + setDST(dst) + (dst_sym & 65535) ], False
+
+def encOneLit(name, base, lineNum, t, fl, fr, dst, src, dst_sym, src_sym):
+    # register P opcodes load and compare
+    if dst_sym == None:
+        diagnose(lineNum, t.acol, 'One literal argument expected for {0:s}'.format(name))
+        return None, True
+    return [ base + (dst_sym & 31) ], False
+
+ENCODER_TBL = {
+    T_TWO_OP   : encTwoOp,
+    T_TWO_OP_S : encTwoOpS,
+    T_ONE_OP   : encOneOp,
+    T_ONE_OP_S : encOneOpS,
+    T_LDN      : encLDN,
+    T_LDB      : encLDB,
+    T_NONE     : encNone,
+    T_ABS      : encAbs,
+    T_LS_ABS   : encLSAbs,
+    T_ONE_LIT  : encOneLit
+}
+# returns the encoder of an opcode, the opcode bits are bound to it
+def makeEncoder(op):
+    enc = ENCODER_TBL.get(op[OP_TYPE])
+    if enc == None:
+        return None
+    name = op[OP_NAME]
+    base = op[OP_BASE]
+    return lambda lineNum, t, fl, fr, dst, src, dst_sym, src_sym: enc(name, base, lineNum, t, fl, fr, dst, src, dst_sym, src_sym)
+# opcodes by (name, type), the first entry of opcode_tbl is used like a
+# search from the top would, without type the first entry with that name
+opcodeIndex = dict()
+for op in opcode_tbl:
+    if op[OP_NAME] != '':
+        opcodeIndex.setdefault((op[OP_NAME], op[OP_DECHEX]), op)
+        opcodeIndex.setdefault((op[OP_NAME], ''), op)
+# encoders by (name, type)
+encoderIndex = dict()
+for key in opcodeIndex:
+    encoderIndex[key] = makeEncoder(opcodeIndex[key])
+
+#
+# Preprocessor
+#
+# Directives are handled before the tokenizer, the lines are streamed to it:
+#
+#   .equ name, expr         defines a symbol
+#   .macro name [p1, ...]   defines a macro up to .endm, \p1 is replaced by the
+#   .endm                   argument and \@ by a number unique to the expansion
+#   .rept expr              repeats the lines up to .endr
+#   .endr
+#   .if expr, .ifdef name, .ifndef name, .else, .endif
+#
+# A macro is used like an opcode: name arg1, arg2, ...
+# Expressions are python integer expressions of numbers and symbols.
+#
+DIRECTIVE_RE = re.compile(r'[ \t]*(?:([A-Za-z_]\w*)[ \t]*:)?[ \t]*(\.[A-Za-z_]\w*)(.*)$', re.S)
+MACROCALL_RE = re.compile(r'[ \t]*(?:([A-Za-z_]\w*)[ \t]*:)?[ \t]*([A-Za-z_]\w*)(.*)$', re.S)
+PARAM_RE = re.compile(r'\\(\w+|@)')
+EXPR_RE = re.compile(r'[\w\s+\-*/%&|^~()<>=!]*$')
+MAXDEPTH = 64   # nested expansions
+
+# returns the value of an expression or None, errors are diagnosed
+def evalExpr(expr, lineNum, names):
+    expr = expr.replace('#', '').strip()
+    if len(expr) == 0 or not EXPR_RE.match(expr):
+        diagnose(lineNum, 1, 'Invalid expression {0:s}'.format(expr))
+        return None
+    try:
+        return int(eval(expr, { '__builtins__': {} }, names))
+    except Exception:
+        diagnose(lineNum, 1, 'Invalid expression {0:s}'.format(expr))
+        return None
+# returns a generator of the lines of a source after the directives:
+# [ line number, source line, line for the tokenizer or None ], lines without
+# code are only listed. .equ defines the symbols in equates.
+def preprocess(lines, equates):
+    state = { 'macros': dict(), 'equates': equates, 'count': 0 }
+    return processLines(enumerate(lines, 1), state, 0)
+# collects the lines up to the end directive of a block, returns them or None
+def collectBlock(items, start, end, lineNum):
+    body = []
+    nested = 0
+    for item in items:
+        m = DIRECTIVE_RE.match(item[1].split(';', 1)[0])
+        if m != None:
+            name = m.group(2).upper()
+            if name == start:
+                nested += 1
+            elif name == end:
+                if nested == 0:
+                    return body, item
+                nested -= 1
+        body.append(item)
+    diagnose(lineNum, 1, 'Missing {0:s}'.format(end.lower()))
+    return None, None
+# yields the lines of a macro, the parameters replaced
+def expandMacro(body, values, lineNum):
+    for n, line in body:
+        yield lineNum, PARAM_RE.sub(lambda m: values.get(m.group(1), m.group(0)), line)
+
+def processLines(items, state, depth):
+    items = iter(items)
+    equates = state['equates']
+    macros = state['macros']
+    active = True
+    conds = []      # [ active before the .if, a branch was taken ]
+    for lineNum, line in items:
+        # a directive is the first '.' after blanks or a label
+        m = None
+        i = line.find('.')
+        if i >= 0:
+            before = line[:i].rstrip()
+            if before == '' or before[-1] == ':':
+                m = DIRECTIVE_RE.match(line.split(';', 1)[0])
+        if m != None:
+            name = m.group(2).upper()
+            arg = m.group(3).strip()
+            if name == '.IF' or name == '.IFDEF' or name == '.IFNDEF':
+                conds.append([ active, False ])
+                if active:
+                    if name == '.IF':
+                        active = bool(evalExpr(arg, lineNum, equates))
+                    else:
+                        active = (arg in equates) == (name == '.IFDEF')
+                    conds[-1][1] = active
+                yield lineNum, line, None
+                continue
+            elif name == '.ELSE' or name == '.ENDIF':
+                if len(conds) == 0:
+                    diagnose(lineNum, m.start(2) + 1, '{0:s} without .if'.format(name.lower()))
+                elif name == '.ELSE':
+                    active = conds[-1][0] and not conds[-1][1]
+                    conds[-1][1] = True
+                else:
+                    active = conds.pop()[0]
+                yield lineNum, line, None
+                continue
+        if not active:
+            yield lineNum, line, None
+            continue
+        if m != None:
+            if name == '.EQU':
+                parts = arg.split(',', 1)
+                value = None
+                if len(parts) == 2:
+                    value = evalExpr(parts[1], lineNum, equates)
+                else:
+                    diagnose(lineNum, m.start(3) + 1, '.equ name, value expected')
+                if value != None:
+                    sym = parts[0].strip()
+                    if sym in equates and equates[sym] != value:
+                        diagnose(lineNum, m.start(3) + 1, 'Duplicated symbol {0:s}'.format(sym))
+                    equates[sym] = value
+                yield lineNum, line, None
+                continue
+            elif name == '.MACRO':
+                yield lineNum, line, None
+                body, end = collectBlock(items, '.MACRO', '.ENDM', lineNum)
+                if body == None:
+                    return
+                params = arg.replace(',', ' ').split()
+                if len(params) == 0:
+                    diagnose(lineNum, m.start(3) + 1, 'Macro name expected')
+                else:
+                    macros[params[0].upper()] = (params[1:], body)
+                for item in body + [ end ]:
+                    yield item[0], item[1], None
+                continue
+            elif name == '.REPT':
+                yield lineNum, line, None
+                count = evalExpr(arg, lineNum, equates)
+                body, end = collectBlock(items, '.REPT', '.ENDR', lineNum)
+                if body == None:
+                    return
+                if depth >= MAXDEPTH:
+                    diagnose(lineNum, 1, 'Expansions nested too deep')
+                    count = 0
+                for i in range(count or 0):
+                    for item in processLines(body, state, depth + 1):
+                        yield item
+                yield end[0], end[1], None
+                continue
+            elif name == '.ENDM' or name == '.ENDR':
+                diagnose(lineNum, m.start(2) + 1, '{0:s} without start'.format(name.lower()))
+                yield lineNum, line, None
+                continue
+            # other directives go to the tokenizer
+        if len(macros) > 0:
+            m = MACROCALL_RE.match(line.split(';', 1)[0])
+            if m != None and m.group(2).upper() in macros:
+                params, body = macros[m.group(2).upper()]
+                args = [ a.strip() for a in m.group(3).split(',') ]
+                if args == [ '' ]:
+                    args = []
+                if len(args) > len(params):
+                    diagnose(lineNum, m.start(3) + 1, 'Too many arguments for {0:s}'.format(m.group(2)))
+                    yield lineNum, line, None
+                    continue
+                if depth >= MAXDEPTH:
+                    diagnose(lineNum, m.start(2) + 1, 'Expansions nested too deep')
+                    yield lineNum, line, None
+                    continue
+                values = dict(zip(params, args + [ '' ] * (len(params) - len(args))))
+                state['count'] += 1
+                values['@'] = str(state['count'])
+                # the label of the line is defined at the first opcode
+                if m.group(1) != None:
+                    yield lineNum, line, m.group(1) + ':'
+                else:
+                    yield lineNum, line, None
+                for item in processLines(expandMacro(body, values, lineNum), state, depth + 1):
+                    yield item
+                continue
+        yield lineNum, line, line
+    if len(conds) > 0:
+        diagnose(lineNum, 1, 'Missing .endif')
+
 def assembleLine(line, lineNum, pc, ignore_missing_sym):
-    original_line = line
-    # remove comments
-    without_comments = line.split(';')
-    without_comments = without_comments[0].strip()
-    
-    tokens = tokenizeLine(without_comments)
-    print '* Tokens: ', tokens
-    if (len(tokens[0]) > 0) and ignore_missing_sym: # use this flag to create symbols on first pass only
-        if not addSymbol(tokens[0], pc):
-            print 'Duplicated symbol {0:s} at line {1:d}'.format(label, lineNum)
-            return None
-    
-    if len(tokens[1][0]) > 0:
-        op = lookupOpcode(tokens[1][0], tokens[1][1])
-    else:
+    tokens = tokenizeLine(line, lineNum)
+    if tokens == None:
+        return None, True
+    if getInclude(tokens) != None:
+        diagnose(lineNum, tokens.col, '.include needs the object mode (-i)')
+        return None, True
+    if (len(tokens.label) > 0) and ignore_missing_sym: # use this flag to create symbols on first pass only
+        if not addSymbol(tokens.label, pc):
+            diagnose(lineNum, line.index(tokens.label) + 1, 'Duplicated symbol {0:s}'.format(tokens.label))
+            return None, True
+    return encodeTokens(tokens, lineNum, ignore_missing_sym)
+# returns True when an argument is neither a register nor a known symbol or
+# literal, i.e. a label defined further down
+def isForward(tokens):
+    for arg in (tokens.dst, tokens.src):
+        if len(arg) > 0 and getReg(arg) == None and getSymbolOrLiteral(arg) == None:
+            return True
+    return False
+# encodes the tokens of a line, symbols are taken as 0 when ignore_missing_sym
+# returns the list of opcode words and the error flag
+def encodeTokens(tokens, lineNum, ignore_missing_sym):
+    if len(tokens.name) == 0:
         return None, False
 
-    if op == None:
-        print 'Unknown opcode {0:s} at line {1:d}'.format(tokens[1][0], lineNum)
+    key = (tokens.name, tokens.dechex)
+    enc = encoderIndex.get(key)
+    if enc == None:
+        if key in opcodeIndex: # no encoder for its type, nothing is emitted
+            return None, False
+        if (tokens.name, '') in opcodeIndex:
+            diagnose(lineNum, tokens.col, 'Unknown type {0:s} for {1:s}'.format(tokens.dechex, tokens.name))
+        else:
+            diagnose(lineNum, tokens.col, 'Unknown opcode {0:s}'.format(tokens.name))
         return None, True
 
-    f_left = 0
-    f_right = 0        
-    
-    if tokens[1][2] == 'P':
-        f_left = 255
-        f_right = 255
-    elif tokens[1][2] == 'WP':
-        f_left = 255
-        f_right = 0
-    elif tokens[1][2] == 'XS':
-        f_left = 2
-        f_right = 2
-    elif tokens[1][2] == 'X':
-        f_left = 2
-        f_right = 0
-    elif tokens[1][2] == 'S':
-        f_left = 31
-        f_right = 31
-    elif tokens[1][2] == 'M':
-        f_left = 31
-        f_right = 3
-    elif tokens[1][2] == 'B':
-        f_left = 1
-        f_right = 0
-    elif tokens[1][2] == 'W':
-        f_left = 31
-        f_right = 0
-    elif tokens[1][2] == 'A':
-        f_left = 4
-        f_right = 0
-    elif tokens[1][2] != 'Z':
-        # ignore no size
-        print 'Unknown size {0:s} for {1:s} at line {2:d}'.format(tokens[1][2], tokens[1][0], lineNum)
-        return None, True
+    size = SIZE_TBL[tokens.size]
     
     # assemble
-    dst = getReg(tokens[2])
-    dst_sym = getSymbolOrLiteral(tokens[2])
-    src = getReg(tokens[3])
-    src_sym = getSymbolOrLiteral(tokens[3])
+    dst = getReg(tokens.dst)
+    dst_sym = getSymbolOrLiteral(tokens.dst)
+    src = getReg(tokens.src)
+    src_sym = getSymbolOrLiteral(tokens.src)
     if ignore_missing_sym == True:
         dst_sym = 0
         src_sym = 0    
     
-    print '* Dst & src :', dst, src
-    if op[OP_TYPE] == T_TWO_OP: # two arguments with size and type
-        if src == None:
-            if src_sym != None:
-                # return the CONSTANT version
-                return [ op[OP_BASE] + 0x01000000 + setDST(dst) + setSRC(src_sym) + (f_left << 8) + f_right ], False
-            print 'Two register arguments expected for {0:s} at line {1:d}'.format(tokens[1][0], lineNum)
-            return None, True
-            
-        if dst == None or (src == None and src_sym == None):
-            print 'Two register arguments expected for {0:s} at line {1:d}'.format(tokens[1][0], lineNum)
-            return None, True
-        
-        return [ op[OP_BASE] + setDST(dst) + setSRC(src) + (f_left << 8) + f_right ], False
-
-    elif op[OP_TYPE] == T_TWO_OP_S: # two arguments with size and without type
-        if dst == None or src == None:
-            print 'Two register arguments expected for {0:s} at line {1:d}'.format(tokens[1][0], lineNum)
-            return None, True
-        
-        return [ op[OP_BASE] + setDST(dst) + setSRC(src) + (f_left << 8) + f_right ], False
-    elif op[OP_TYPE] == T_ONE_OP: # One argument with size and type
-        if dst == None or src != None:
-            print 'One register argument expected for {0:s} at line {1:d}'.format(tokens[1][0], lineNum)
-            return None, True
-        
-        return [ op[OP_BASE] + setDST(dst) + (f_left << 8) + f_right ], False
-    elif op[OP_TYPE] == T_ONE_OP_S: # One argument with size and type
-        if dst != None or src != None:
-            print 'One register argument expected for {0:s} at line {1:d}'.format(tokens[1][0], lineNum)
-            return None, True
-        
-        return [ op[OP_BASE] + setDST(dst) + (f_left << 8) + f_right ], False
-    elif op[OP_TYPE] == T_LDN: # One register + literal argument
-        if dst == None or src_sym == None:
-            print 'One register argument plus one literal expected for {0:s} at line {1:d}'.format(tokens[1][0], lineNum)
-            return None, True
-        numnibs = 0x01000000
-        if src_sym > 0xFFFFF:
-            print 'Constant {0:x} exceeds range for {1:s}'.format(tokens[1][0], src_sym)
-        elif src_sym > 0XFFFF:
-            numnibs = 0x05000000
-        elif src_sym > 0XFFF:
-            numnibs = 0x04000000
-        elif src_sym > 0XFF:
-            numnibs = 0x03000000
-        elif src_sym > 0XF:
-            numnibs = 0x02000000
-        return [ op[OP_BASE] + numnibs + setDST(dst) + (src_sym & 0xFFFFF) ], False
-    elif op[OP_TYPE] == T_LDB: # One register + literal argument
-        if dst == None or src_sym == None:
-            print 'One register argument plus one literal expected for {0:s} at line {1:d}'.format(tokens[1][0], lineNum)
-            return None, True
-        
-        return [ op[OP_BASE] + setDST(dst) + (src_sym & 255) ], False
-    elif op[OP_TYPE] == T_NONE: # No arguments
-        if dst != None and src_sym != None:
-            print 'No arguments expected for {0:s} at line {1:d}'.format(tokens[1][0], lineNum)
-            return None, True
-        
-        return [ op[OP_BASE] ], False
-        
-    elif op[OP_TYPE] == T_ABS: # Absolute
-        if dst_sym == None:
-            print 'One absolute argument expected for {0:s} at line {1:d}'.format(tokens[1][0], lineNum)
-            return None, True
-
-        return [op[OP_BASE] + (dst_sym & 65535) ], False
-    elif op[OP_TYPE] == T_LS_ABS: # Absolute
-        if dst == None or src_sym == None:
-            print 'One absolute argument expected for {0:s} at line {1:d}'.format(tokens[1][0], lineNum)
-            return None, True
-        
-        return [op[OP_BASE] + setDST(dst) + (dst_sym & 65535) ], False
-    elif op[OP_TYPE] == T_ONE_LIT: # Register P opcodes load and compare
-        if dst_sym == None:
-            print 'One literal argument expected for {0:s} at line {1:d}'.format(tokens[1][0], lineNum)
-            return None, True
-        
-        return [op[OP_BASE] + (dst_sym & 31) ], False
+    return enc(lineNum, tokens, size[0], size[1], dst, src, dst_sym, src_sym)
 # first pass, creates and checks symbols and opcodes
 # returns True if successes
 def firstPass(fileName):
+    global sourceName
+    sourceName = fileName
     f = open(fileName, 'rt')
+    lines = f.readlines()
+    f.close()
     
     pc = 0
-    lineNum = 1
-    for line in f:
-        op, flag = assembleLine(line, lineNum, pc, True)
+    for lineNum, line, code in preprocess(lines, symbolTable):
+        if code == None:
+            continue
+        op, flag = assembleLine(code, lineNum, pc, True)
         
-        if flag:
-            print 'Cancelled due to error'
-            return False
         if op != None:
             pc += len(op)
-        lineNum += 1
-    f.close()
-# first pass, creates and checks symbols and opcodes
-# returns True if successes
+    return errorCount() == 0
+# second pass, encodes every line with the symbols of the first pass
+# returns the assembled lines [ line number, pc, opcode words, source line ]
+# or None
 def secondPass(fileName):
+    global sourceName
+    sourceName = fileName
     f = open(fileName, 'rt')
-    fileNamewoExt = fileName.rsplit('.')
-    fileNamewoExt = fileNamewoExt[0]
-    lst = open(fileNamewoExt + '.lst', 'wt')
-    bin = open(fileNamewoExt + '.bin', 'wt')
+    lines = f.readlines()
+    f.close()
     
+    result = []
     pc = 0
-    lineNum = 1
-    for line in f:
-        op, flag = assembleLine(line, lineNum, pc, False)
+    # the symbols of .equ are defined by the first pass already
+    for lineNum, line, code in preprocess(lines, dict(symbolTable)):
+        op = None
+        if code != None:
+            op, flag = assembleLine(code, lineNum, pc, False)
         
-        if flag:
-            print 'Cancelled due to error'
-            return False
+        result.append([ lineNum, pc, op, line ])
+        if op != None:
+            pc += len(op)
+    if errorCount() > 0:
+        return None
+    return result
+# returns the lines as [ line number, source line, tokens or None ], errors
+# are diagnosed
+def tokenizeLines(lines):
+    for lineNum, line, code in preprocess(lines, symbolTable):
+        tokens = None
+        if code != None:
+            tokens = tokenizeLine(code, lineNum)
+        if tokens != None and getInclude(tokens) != None:
+            diagnose(lineNum, tokens.col, '.include needs the object mode (-i)')
+            tokens = None
+        yield lineNum, line, tokens
+# encodes the tokenized lines, forward references are encoded again at the end
+# returns [ line number, pc, opcode words, source line ]
+def encodeLines(items):
+    result = []
+    fixups = []     # [ index in result, tokens ]
+    pc = 0
+    for lineNum, line, tokens in items:
+        op, forward = None, False
+        if tokens != None:
+            if len(tokens.label) > 0:
+                if not addSymbol(tokens.label, pc):
+                    diagnose(lineNum, tokens.text.index(tokens.label) + 1, 'Duplicated symbol {0:s}'.format(tokens.label))
+            forward = (len(tokens.name) > 0) and isForward(tokens)
+            op, flag = encodeTokens(tokens, lineNum, forward)
+        if forward and op != None:
+            fixups.append([ len(result), tokens ])
+        result.append([ lineNum, pc, op, line ])
+        if op != None:
+            pc += len(op)
+
+    for i, tokens in fixups:
+        op, flag = encodeTokens(tokens, result[i][0], False)
+        result[i][2] = op
+    return result
+# single pass, every line is tokenized and encoded once, lines using labels
+# defined further down are encoded again when all labels are known (fixups)
+# returns the assembled lines like secondPass or None
+def onePass(fileName):
+    global sourceName
+    sourceName = fileName
+    f = open(fileName, 'rt')
+    lines = f.readlines()
+    f.close()
+
+    # the lines are streamed, the labels are known to the preprocessor
+    result = encodeLines(tokenizeLines(lines))
+    if errorCount() > 0:
+        return None
+    return result
+#
+# Objects and linker
+#
+# Every source file is assembled to an object, cached on disk under the sha1 of
+# its contents. Addresses are only known when the objects are linked, so all
+# lines using a symbol are relocations, encoded again by the linker.
+#
+# .include <file> places the object of the file at that line.
+#
+OBJVERSION = 3
+CACHEDIR = '.pncache'
+
+# returns the file name of an .include directive or None
+def getInclude(tokens):
+    if tokens.name != '.INCLUDE':
+        return None
+    return tokens.dst.strip('"\'')
+# assembles the lines of a file to an object:
+# records [ line number, opcode words, source line, included file ]
+# labels { label: index in records }
+# relocs [ index in records, tokens as tuple ]
+# equates { symbol of .equ: value }
+# diagnostics [ diagnostic as tuple ]
+# returns the object, it has errors when the error count went up
+def assembleObject(fileName, lines):
+    records = []
+    labels = dict()
+    relocs = []
+    equates = dict()
+    first = len(diagnostics)
+    for lineNum, line, code in preprocess(lines, equates):
+        op, reloc, inc, tokens = None, False, None, None
+        if code != None:
+            tokens = tokenizeLine(code, lineNum)
+        if tokens != None:
+            if len(tokens.label) > 0:
+                if tokens.label in labels or tokens.label in equates:
+                    diagnose(lineNum, code.index(tokens.label) + 1, 'Duplicated symbol {0:s}'.format(tokens.label))
+                else:
+                    labels[tokens.label] = len(records)
+            inc = getInclude(tokens)
+            if inc == None:
+                reloc = (len(tokens.name) > 0) and isForward(tokens)
+                op, flag = encodeTokens(tokens, lineNum, reloc)
+        if reloc and op != None:
+            relocs.append([ len(records), tuple(tokens) ])
+        records.append([ lineNum, op, line, inc ])
+    return { 'records': records, 'labels': labels, 'relocs': relocs, 'equates': equates,
+             'diagnostics': [ tuple(d) for d in diagnostics[first:] ] }
+# returns the object of a file from the cache, assembles it when the file
+# changed, objects with errors are not cached
+def loadObject(fileName, cacheDir):
+    global sourceName
+    sourceName = fileName
+    f = open(fileName, 'rt')
+    lines = f.readlines()
+    f.close()
+    key = hashlib.sha1('{0:d}\n'.format(OBJVERSION) + ''.join(lines)).hexdigest()
+    objName = os.path.join(cacheDir, key + '.pno')
+    if os.path.exists(objName):
+        try:
+            f = open(objName, 'rb')
+            obj = cPickle.load(f)
+            f.close()
+            print '{0:s}: cached'.format(fileName)
+            # the warnings are reported again
+            diagnostics.extend([ Diagnostic(fileName, *d[1:]) for d in obj['diagnostics'] ])
+            return obj
+        except (EOFError, cPickle.UnpicklingError):
+            pass # broken object, assembled again
+    errors = errorCount()
+    obj = assembleObject(fileName, lines)
+    if errorCount() > errors:
+        return obj
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    f = open(objName + '.tmp', 'wb')
+    cPickle.dump(obj, f, cPickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.rename(objName + '.tmp', objName)
+    print '{0:s}: assembled'.format(fileName)
+    return obj
+# loads the objects of a file and of the files it includes
+def loadProject(fileName, cacheDir, objects, stack):
+    global sourceName
+    if fileName in objects:
+        return
+    obj = loadObject(fileName, cacheDir)
+    objects[fileName] = obj
+    for record in obj['records']:
+        if record[3] != None:
+            inc = os.path.normpath(os.path.join(os.path.dirname(fileName), record[3]))
+            sourceName = fileName
+            if inc in stack or inc == fileName:
+                diagnose(record[0], 1, 'Recursive .include of {0:s}'.format(record[3]))
+            elif not os.path.isfile(inc):
+                diagnose(record[0], 1, 'Included file {0:s} not found'.format(record[3]))
+            else:
+                loadProject(inc, cacheDir, objects, stack + [ fileName ])
+# places the object of a file at pc, defines its labels
+# returns the next pc
+def placeObject(fileName, objects, pc, result, relocs):
+    global sourceName
+    obj = objects[fileName]
+    index = []  # index in result of every record
+    addr = []   # pc of every record
+    for lineNum, op, line, inc in obj['records']:
+        index.append(len(result))
+        addr.append(pc)
+        result.append([ lineNum, pc, op, line ])
+        if inc != None:
+            pc = placeObject(os.path.normpath(os.path.join(os.path.dirname(fileName), inc)), objects, pc, result, relocs)
+        elif op != None:
+            pc += len(op)
+    sourceName = fileName
+    for label in obj['labels']:
+        if not addSymbol(label, addr[obj['labels'][label]]):
+            diagnose(obj['records'][obj['labels'][label]][0], 1, 'Duplicated symbol {0:s}'.format(label))
+    for sym in obj['equates']:
+        if not addSymbol(sym, obj['equates'][sym]):
+            diagnose(1, 1, 'Duplicated symbol {0:s}'.format(sym))
+    for i, tokens in obj['relocs']:
+        relocs.append([ index[i], Tokens._make(tokens), fileName ])
+    return pc
+# assembles a file and the files it includes in object mode, links them
+# returns the assembled lines like secondPass or None
+def linkProject(fileName):
+    global sourceName
+    cacheDir = os.path.join(os.path.dirname(fileName), CACHEDIR)
+    objects = dict()
+    fileName = os.path.normpath(fileName)
+    symbolTable.clear() # objects are assembled without symbols
+    loadProject(fileName, cacheDir, objects, [])
+    if errorCount() > 0:
+        return None
+    result = []
+    relocs = []     # [ index in result, tokens, file name ]
+    placeObject(fileName, objects, 0, result, relocs)
+    for i, tokens, name in relocs:
+        sourceName = name
+        op, flag = encodeTokens(tokens, result[i][0], False)
+        result[i][2] = op
+    if errorCount() > 0:
+        return None
+    return result
+#
+# Analysis
+#
+# Splits the code in basic blocks at the jumps of opcode_tbl and their targets,
+# finds the loops and estimates the cycles of each block from CYCLE_TBL.
+#
+# estimated cycles per opcode, the ALU latches its arguments and writes the
+# result back on the next clock, jumps refill the opcode fetch, others take 1
+CYCLE_TBL = {
+    'ADD'  : 2, 'SUB'  : 2, 'RSUB' : 2, 'NOT'  : 2,
+    'EQ'   : 2, 'NEQ'  : 2, 'GT'   : 2, 'GTEQ' : 2, 'LT'   : 2, 'LTEQ' : 2,
+    'OR'   : 2, 'XOR'  : 2, 'AND'  : 2, 'MOV'  : 2, 'EX'   : 2,
+    'SR'   : 2, 'SL'   : 2,
+    'JMP'  : 2, 'CALL' : 2, 'RET'  : 2,
+    'JC'   : 2, 'JNC'  : 2, 'JT'   : 2, 'JNT'  : 2
+}
+BLOCK_END = ('RET', 'STOP')
+
+# opcodes by the top byte of the word
+opcodeByByte = dict()
+for op in opcode_tbl:
+    if op[OP_NAME] != '':
+        opcodeByByte.setdefault(op[OP_BASE] >> 24, op)
+
+# returns the basic blocks of the assembled lines, in address order:
+# { start, end, succ: next blocks, calls: called blocks, index: of the first
+#   line in result, count: instructions, cycles, loops: headers of the loops }
+def findBlocks(result):
+    code = dict()   # pc: [ word, index in result ]
+    for i in range(len(result)):
+        lineNum, pc, op, line = result[i]
+        if op != None:
+            for j in range(len(op)):
+                code[pc + j] = [ op[j], i ]
+    leaders = set()
+    if 0 in code:
+        leaders.add(0)
+    for pc in code:
+        op = opcodeByByte.get(code[pc][0] >> 24)
+        if op == None:
+            continue
+        if op[OP_TYPE] == T_ABS:
+            leaders.add(code[pc][0] & 65535)
+            leaders.add(pc + 1)
+        elif op[OP_NAME] in BLOCK_END:
+            leaders.add(pc + 1)
+    blocks = []
+    for start in sorted([ pc for pc in leaders if pc in code ]):
+        b = { 'start': start, 'index': code[start][1], 'count': 0, 'cycles': 0,
+              'succ': [], 'calls': [], 'loops': [] }
+        pc = start
+        while True:
+            op = opcodeByByte.get(code[pc][0] >> 24)
+            name = '' if op == None else op[OP_NAME]
+            b['count'] += 1
+            b['cycles'] += CYCLE_TBL.get(name, 1)
+            pc += 1
+            if name == 'JMP':
+                b['succ'].append(code[pc - 1][0] & 65535)
+                break
+            elif op != None and op[OP_TYPE] == T_ABS:
+                if name == 'CALL':
+                    b['calls'].append(code[pc - 1][0] & 65535)
+                else:
+                    b['succ'].append(code[pc - 1][0] & 65535)
+                if pc in code:
+                    b['succ'].append(pc)
+                break
+            elif name in BLOCK_END:
+                break
+            elif pc in leaders or pc not in code:
+                if pc in code:
+                    b['succ'].append(pc)
+                break
+        b['end'] = pc
+        b['succ'] = [ s for s in b['succ'] if s in code ]
+        b['calls'] = [ s for s in b['calls'] if s in code ]
+        blocks.append(b)
+    return blocks
+# finds the natural loops of the back edges found by a depth first search,
+# returns { header: set of the block starts } and marks the blocks
+def findLoops(blocks):
+    byStart = dict([ (b['start'], b) for b in blocks ])
+    preds = dict([ (b['start'], []) for b in blocks ])
+    for b in blocks:
+        for s in b['succ']:
+            preds[s].append(b['start'])
+    back = []
+    state = dict()  # start: 1 on the stack, 2 done
+    for root in [ b['start'] for b in blocks ]:
+        if root in state:
+            continue
+        stack = [ [ root, iter(byStart[root]['succ'] + byStart[root]['calls']) ] ]
+        state[root] = 1
+        while len(stack) > 0:
+            node, succ = stack[-1]
+            for s in succ:
+                if state.get(s) == 1:
+                    if s in byStart[node]['succ']:
+                        back.append([ node, s ])
+                elif s not in state:
+                    state[s] = 1
+                    stack.append([ s, iter(byStart[s]['succ'] + byStart[s]['calls']) ])
+                    break
+            else:
+                state[node] = 2
+                stack.pop()
+    loops = dict()
+    for tail, head in back:
+        body = loops.setdefault(head, set([ head ]))
+        work = [ tail ]
+        while len(work) > 0:
+            n = work.pop()
+            if n not in body:
+                body.add(n)
+                work.extend(preds[n])
+    for head in loops:
+        for n in loops[head]:
+            byStart[n]['loops'].append(head)
+    return loops
+# returns the name of an address, its label if it has one
+def addressName(pc, labels):
+    if pc in labels:
+        return labels[pc]
+    return '{0:06X}'.format(pc)
+# annotates the blocks and loops of the assembled lines
+# returns the notes of the listing { index in result: [ text ] } and the
+# report of the loops, innermost and most expensive first
+def analyze(result):
+    blocks = findBlocks(result)
+    loops = findLoops(blocks)
+    labels = dict()
+    for sym in symbolTable:
+        labels.setdefault(symbolTable[sym], sym)
+    byStart = dict([ (b['start'], b) for b in blocks ])
+    notes = dict()
+    info = []
+    for head in loops:
+        body = loops[head]
+        depth = len(byStart[head]['loops'])
+        count = sum([ byStart[n]['count'] for n in body ])
+        cycles = sum([ byStart[n]['cycles'] for n in body ])
+        info.append([ depth, cycles, count, head, len(body) ])
+        notes.setdefault(byStart[head]['index'], []).append(
+            'loop {0:s}: depth {1:d}, {2:d} blocks, {3:d} instructions, {4:d} cycles per iteration'.format(
+                addressName(head, labels), depth, len(body), count, cycles))
+    n = 0
+    for b in blocks:
+        s = 'block {0:d} {1:s}: {2:d} instructions, {3:d} cycles'.format(n, addressName(b['start'], labels), b['count'], b['cycles'])
+        if len(b['loops']) > 0:
+            s = s + ', loop depth {0:d}'.format(len(b['loops']))
+        notes.setdefault(b['index'], []).append(s)
+        n += 1
+    report = [ '{0:d} blocks, {1:d} instructions, {2:d} cycles, {3:d} loops'.format(len(blocks),
+        sum([ b['count'] for b in blocks ]), sum([ b['cycles'] for b in blocks ]), len(loops)) ]
+    info.sort(key = lambda l: (-l[0], -l[1]))
+    for depth, cycles, count, head, nblocks in info:
+        report.append('{0:s}loop {1:s} at line {2:d}: depth {3:d}, {4:d} instructions, {5:d} cycles per iteration'.format(
+            '  ' * (depth - 1), addressName(head, labels), result[byStart[head]['index']][0], depth, count, cycles))
+    return notes, report
+#
+# Optimizer
+#
+# Rewrites the tokens of the one pass assembler before they are encoded, in
+# basic blocks split at the labels and at the jumps of opcode_tbl:
+#
+# - moves of a register to itself and writes to the constant registers 0, 9
+#   and F are removed
+# - an LDN is removed when a following LDN writes the same register, LDN
+#   writes all its nibbles at P, so the last one only is left
+# - chains of INCP and DECP become a LOADP when P is known or are shortened
+# - jumps to a JMP are sent to its target
+#
+# Every ALU opcode loads the constant register 14 before it runs, an ALU opcode
+# is removed only when a later one of the same block loads it again. Opcodes
+# that set the carry are removed only when no JC or JNC reads it before it is
+# set again, the flags and registers are kept as they are at the end of the
+# blocks. Only labels are moved, so the labels have to be used only as the
+# targets of the jumps and the jumps must go to labels.
+#
+CONST_REGS = (0, 9, 15)
+CARRY_OPS = ('ADD', 'SUB', 'RSUB', 'NOT', 'INCP', 'DECP')
+CARRY_READ = ('JC', 'JNC')
+SILENT_OPS = ('MOV', 'AND', 'OR', 'XOR', 'SR', 'SL') # set no flags
+
+# returns the opcode of the tokens or None
+def tokensOpcode(tokens):
+    if tokens == None or len(tokens.name) == 0:
+        return None
+    return opcodeIndex.get((tokens.name, tokens.dechex))
+# returns True for the opcodes of the families 0 and 1
+def isALU(op):
+    return (op[OP_BASE] >> 28) < 2
+# returns the tokens of an opcode removed from a line, the label is kept
+def removeTokens(tokens):
+    return tokens._replace(name = '', dechex = '', size = 'Z', dst = '', src = '')
+# returns the index of the first line that can't be optimized and the reason
+# or None, see above
+def checkLabels(items):
+    labels = set([ t.label for lineNum, line, t in items if t != None and len(t.label) > 0 ])
+    for i in range(len(items)):
+        t = items[i][2]
+        if t == None or len(t.name) == 0:
+            continue
+        op = tokensOpcode(t)
+        if op == None:
+            return i, 'unknown opcode {0:s}'.format(t.name)
+        if op[OP_TYPE] == T_ABS:
+            if t.dst not in labels:
+                return i, 'jump to an address'
+        elif t.dst.lstrip('#') in labels or t.src.lstrip('#') in labels:
+            return i, 'address used as a value'
+    return None
+# returns the basic blocks as lists of the indexes of their opcodes
+def optimizerBlocks(items):
+    blocks = []
+    block = []
+    for i in range(len(items)):
+        t = items[i][2]
+        if t == None:
+            continue
+        if len(t.label) > 0 and len(block) > 0:
+            blocks.append(block)
+            block = []
+        op = tokensOpcode(t)
+        if op == None:
+            continue
+        block.append(i)
+        if op[OP_TYPE] == T_ABS or op[OP_NAME] in BLOCK_END:
+            blocks.append(block)
+            block = []
+    if len(block) > 0:
+        blocks.append(block)
+    return blocks
+# returns the known values of P before the opcodes of a block, None if unknown
+def knownP(items, block):
+    values = []
+    p = None
+    for i in block:
+        values.append(p)
+        t = items[i][2]
+        if t.name == 'LOADP':
+            p = getSymbolOrLiteral(t.dst)
+            if p != None:
+                p = p & 31
+        elif p != None and t.name == 'INCP':
+            p = (p + 1) & 31
+        elif p != None and t.name == 'DECP':
+            p = (p - 1) & 31
+    return values
+# optimizes a block from the end, adds [ index, text ] to changes
+def optimizeBlock(items, block, changes):
+    pvalues = knownP(items, block)
+    carry = True    # the carry is read after the block
+    const = False   # an ALU opcode loads register 14 later
+    k = len(block) - 1
+    while k >= 0:
+        i = block[k]
+        t = items[i][2]
+        op = tokensOpcode(t)
+        name = op[OP_NAME]
+        if name == 'INCP' or name == 'DECP':
+            j = k
+            while j > 0 and items[block[j - 1]][2].name in ('INCP', 'DECP'):
+                j -= 1
+            if not carry:
+                optimizeChain(items, block[j:k + 1], pvalues[j], changes)
+            carry = False
+            k = j - 1
+            continue
+        if isALU(op):
+            dst = getReg(t.dst)
+            src = getReg(t.src)
+            reason = None
+            if name == 'MOV' and dst != None and dst == src:
+                reason = 'moves a register to itself'
+            elif dst in CONST_REGS and (name in SILENT_OPS or (name in CARRY_OPS and not carry)):
+                reason = 'writes a constant register'
+            if reason != None and const:
+                items[i][2] = removeTokens(t)
+                changes.append([ i, 'removed {0:s}: {1:s}'.format(' '.join(t.text.split()), reason) ])
+                k -= 1
+                continue
+            const = True
+        elif name == 'LDN':
+            dst = getReg(t.dst)
+            for n in block[k + 1:]:
+                u = items[n][2]
+                if u.name != 'LDN':
+                    break
+                if getReg(u.dst) == dst:
+                    items[i][2] = removeTokens(t)
+                    changes.append([ i, 'removed {0:s}: written again at line {1:d}'.format(' '.join(t.text.split()), items[n][0]) ])
+                    break
+        if name in CARRY_OPS:
+            carry = False
+        elif name in CARRY_READ:
+            carry = True
+        k -= 1
+# replaces a chain of INCP and DECP followed by a dead carry, p: P before the
+# chain or None
+def optimizeChain(items, chain, p, changes):
+    net = 0
+    for i in chain:
+        if items[i][2].name == 'INCP':
+            net += 1
+        else:
+            net -= 1
+    net = net & 31
+    first = items[chain[0]][2]
+    if p != None and len(chain) > 1:
+        ops = [ first._replace(name = 'LOADP', dechex = '', size = 'Z', dst = '#{0:d}'.format((p + net) & 31), src = '') ]
+    elif net <= 16 and net < len(chain):
+        ops = [ first._replace(name = 'INCP') ] * net
+    elif net > 16 and 32 - net < len(chain):
+        ops = [ first._replace(name = 'DECP') ] * (32 - net)
+    else:
+        return
+    for n in range(len(chain)):
+        t = items[chain[n]][2]
+        if n < len(ops):
+            if n > 0:
+                ops[n] = t._replace(name = ops[n].name)
+            items[chain[n]][2] = ops[n]
+        else:
+            items[chain[n]][2] = removeTokens(t)
+    text = ', '.join([ '{0:s} {1:s}'.format(t.name.lower(), t.dst).strip() for t in ops ]) or 'nothing'
+    changes.append([ chain[0], '{0:d} incp/decp replaced by {1:s}'.format(len(chain), text) ])
+# sends the jumps to a JMP to its target
+def threadJumps(items, changes):
+    first = dict()  # label: first opcode at or after it
+    pending = []
+    for i in range(len(items)):
+        t = items[i][2]
+        if t == None:
+            continue
+        if len(t.label) > 0:
+            pending.append(t.label)
+        if len(t.name) > 0:
+            for label in pending:
+                first[label] = i
+            pending = []
+    for i in range(len(items)):
+        t = items[i][2]
+        op = tokensOpcode(t)
+        if op == None or op[OP_TYPE] != T_ABS:
+            continue
+        target = t.dst
+        seen = set([ target ])
+        while target in first:
+            u = items[first[target]][2]
+            if u.name != 'JMP' or u.dst in seen:
+                break
+            target = u.dst
+            seen.add(target)
+        if target != t.dst:
+            items[i][2] = t._replace(dst = target)
+            changes.append([ i, 'jump to {0:s} sent to {1:s}'.format(t.dst, target) ])
+# optimizes the tokenized lines in place, returns the changes [ index, text ]
+def optimize(items):
+    changes = []
+    bad = checkLabels(items)
+    if bad != None:
+        diagnose(items[bad[0]][0], 1, 'Not optimized: {0:s}'.format(bad[1]), 'warning')
+        return changes
+    for block in optimizerBlocks(items):
+        optimizeBlock(items, block, changes)
+    threadJumps(items, changes)
+    changes.sort()
+    return changes
+CHECKSTEPS = 1000000 # default steps of the check of the optimizer
+# returns the final state of a program run on the simulator
+def runState(result, steps):
+    import pneptune_sim # only needed to check the optimizer
+    cpu = pneptune_sim.NeptuneCPU(list(getWords(result)))
+    count, elapsed = cpu.run(steps)
+    regs = [ pneptune_sim.Neptune_SnapshotValue(cpu.RR[i]) for i in range(pneptune_sim.MAXALUREGS) ]
+    flags = (bool(cpu.RF[pneptune_sim.CARRYF]), bool(cpu.RF[pneptune_sim.CMPF]))
+    return count, cpu.HALT, regs, cpu.RP, flags, len(cpu.RSTACK)
+# runs the original and the optimized program up to steps instructions,
+# differences are diagnosed at lineNum, the first changed line. Programs that
+# don't stop within steps are not checked.
+# returns the report
+def checkOptimized(original, result, lineNum, steps = CHECKSTEPS):
+    a = runState(original, steps)
+    b = runState(result, steps)
+    if a[1] == None or b[1] == None:
+        diagnose(0, 0, 'Check skipped: not stopped after {0:d} steps (-n sets the steps)'.format(steps), 'warning')
+        return []
+    names = [ 'halt', 'registers', 'P', 'flags', 'stack depth' ]
+    for n in range(len(names)):
+        if a[n + 1] != b[n + 1]:
+            diagnose(lineNum, 1, 'Check: optimized program differs in {0:s}'.format(names[n]))
+            return []
+    return [ 'check: same results, {0:d} steps before, {1:d} after'.format(a[0], b[0]) ]
+# assembles in one pass with the optimizer, the original program is assembled
+# first for the errors and the check
+# returns the result, the notes of the listing and the report
+def optimizedPass(fileName, check, steps = CHECKSTEPS):
+    global sourceName
+    sourceName = fileName
+    f = open(fileName, 'rt')
+    lines = f.readlines()
+    f.close()
+
+    # the preprocessor runs first, the labels are not known to it
+    items = [ list(item) for item in tokenizeLines(lines) ]
+    equates = dict(symbolTable)
+    original = encodeLines(items)
+    if errorCount() > 0:
+        return None, {}, []
+    symbolTable.clear()
+    symbolTable.update(equates)
+    changes = optimize(items)
+    result = encodeLines(items)
+    notes = dict()
+    report = []
+    for i, text in changes:
+        notes.setdefault(i, []).append(text)
+        report.append('line {0:d}: {1:s}'.format(items[i][0], text))
+    report.append('{0:d} changes, {1:d} words removed'.format(len(changes), len(getWords(original)) - len(getWords(result))))
+    if check:
+        lineNum = 0
+        if len(changes) > 0:
+            lineNum = items[changes[0][0]][0]
+        report.extend(checkOptimized(original, result, lineNum, steps))
+    if errorCount() > 0:
+        return None, {}, []
+    return result, notes, report
+#
+# Output
+#
+# Every file is built in memory and written at once. The words are split in
+# width bit units for the memories of the HDL, the Saturn memories of
+# saturn_top.v and tb_saturn_bus_ctrl.v are 16 bit wide, nibble addresses grow
+# from bit 0, so the low half of a word comes first.
+#
+# returns the opcode words of the assembled lines
+def getWords(result):
+    words = array('I')
+    for lineNum, pc, op, line in result:
+        if op != None:
+            words.extend(op)
+    return words
+# returns the words as width bit units
+def splitWords(words, width):
+    if width == 32:
+        return words
+    units = array('I')
+    for w in words:
+        units.append(w & 0xFFFF)
+        units.append(w >> 16)
+    return units
+# hex text, one word per line, read by the simulator
+def writeHexText(f, words, width):
+    f.write(''.join([ '{0:08x}\r\n'.format(w) for w in words ]))
+# raw words, little or big endian
+def writeRawLE(f, words, width):
+    writeRaw(f, words, 'little')
+
+def writeRawBE(f, words, width):
+    writeRaw(f, words, 'big')
+
+def writeRaw(f, words, order):
+    words = array('I', words)
+    if order != byteorder:
+        words.byteswap()
+    words.tofile(f)
+# $readmemh, one width bit unit per line
+def writeReadmemh(f, words, width):
+    fmt = '{{0:0{0:d}x}}\n'.format(width // 4)
+    f.write(''.join([ fmt.format(u) for u in splitWords(words, width) ]))
+# returns an Intel HEX record
+def ihexRecord(addr, rtype, data):
+    rec = [ len(data), addr >> 8, addr & 255, rtype ] + data
+    rec.append(-sum(rec) & 255)
+    return ':' + ''.join([ '{0:02X}'.format(b) for b in rec ]) + '\n'
+# Intel HEX with one width bit unit per record at its unit address, like the
+# memory initialization files of the FPGA tools
+def writeIntelHex(f, words, width):
+    nbytes = width // 8
+    shifts = range((nbytes - 1) * 8, -8, -8)
+    recs = []
+    upper = 0
+    for addr, u in enumerate(splitWords(words, width)):
+        if (addr >> 16) != upper:
+            upper = addr >> 16
+            recs.append(ihexRecord(0, 4, [ upper >> 8, upper & 255 ]))
+        recs.append(ihexRecord(addr & 0xFFFF, 0, [ (u >> s) & 255 for s in shifts ]))
+    recs.append(ihexRecord(0, 1, []))
+    f.write(''.join(recs))
+
+# output formats: file extension, writer
+OUTPUT_TBL = {
+    'hex'      : ('.bin', writeHexText),
+    'le'       : ('.le',  writeRawLE),
+    'be'       : ('.be',  writeRawBE),
+    'readmemh' : ('.hex', writeReadmemh),
+    'ihex'     : ('.ihx', writeIntelHex)
+}
+# writes the listing and the output files of the assembled lines, notes are
+# written before their line of the listing
+def writeOutput(fileName, result, formats = [ 'hex' ], width = 16, notes = {}):
+    fileNamewoExt = fileName.rsplit('.')
+    fileNamewoExt = fileNamewoExt[0]
+    
+    lst = []
+    for i in range(len(result)):
+        lineNum, pc, op, line = result[i]
+        for note in notes.get(i, []):
+            lst.append('                  ; {0:s}\n'.format(note))
         if op != None:
             for j in range(len(op)):
                 s = '{0:6d}  {1:06X} {2:08X}  '.format(lineNum, pc, op[j])
                 if j == 0:
-                    lst.write(s + line)
+                    lst.append(s + line)
                 else:
-                    lst.write(s + '\r\n')
-                bin.write('{0:08x}\r\n'.format(op[j]))
-            pc += len(op)
+                    lst.append(s + '\r\n')
         else:
-            s = '{0:6d}            {1:s}'.format(lineNum, line)
-            lst.write(s)
-        lineNum += 1
+            lst.append('{0:6d}            {1:s}'.format(lineNum, line))
+    f = open(fileNamewoExt + '.lst', 'wt')
+    f.write(''.join(lst))
     f.close()
-    lst.close()
-    bin.close()
-print 'Two pass Neptune assembler'
-
-firstPass(argv[1])
-secondPass(argv[1])
 
-#op, flag = assembleLine('aa: add.d.w r0, r1', 0, 0)
+    words = getWords(result)
+    for fmt in formats:
+        ext, writer = OUTPUT_TBL[fmt]
+        f = open(fileNamewoExt + ext, 'wb')
+        writer(f, words, width)
+        f.close()
 
-#print op
 
+if __name__ == '__main__':
+    # pneptune_asm.py [-2|-i|-O [-c [-n steps]]] [-a] [-o format,...] [-w 16|32] <source>
+    # -2 assembles in two passes, -i assembles every file to a cached object
+    # and links them, -O optimizes, -c checks the optimized program on the
+    # simulator for up to -n steps, -a annotates the listing with the blocks
+    # and loops, -o output formats, -w width of readmemh and ihex
+    args = argv[1:]
+    mode = ''
+    formats = [ 'hex' ]
+    width = 16
+    analysis = False
+    check = False
+    steps = CHECKSTEPS
+    while len(args) > 1 and args[0][0] == '-':
+        if args[0] == '-i' or args[0] == '-2' or args[0] == '-O':
+            mode = args[0]
+            args = args[1:]
+        elif args[0] == '-c':
+            check = True
+            args = args[1:]
+        elif args[0] == '-n' and len(args) > 2:
+            steps = int(args[1])
+            args = args[2:]
+        elif args[0] == '-a':
+            analysis = True
+            args = args[1:]
+        elif args[0] == '-o' and len(args) > 2:
+            formats = args[1].split(',')
+            args = args[2:]
+        elif args[0] == '-w' and len(args) > 2:
+            width = int(args[1])
+            args = args[2:]
+        else:
+            print 'Unknown option {0:s}'.format(args[0])
+            exit(1)
+    if len(args) != 1:
+        print 'usage: pneptune_asm.py [-2|-i|-O [-c [-n steps]]] [-a] [-o hex,le,be,readmemh,ihex] [-w 16|32] <source>'
+        exit(1)
+    for fmt in formats:
+        if fmt not in OUTPUT_TBL:
+            print 'Unknown output format {0:s}'.format(fmt)
+            exit(1)
+    if width != 16 and width != 32:
+        print 'Width must be 16 or 32'
+        exit(1)
+    if check and mode != '-O':
+        print '-c checks the optimizer, it needs -O'
+        exit(1)
+    notes = {}
+    if mode == '-i':
+        print 'Neptune assembler and linker'
+        result = linkProject(args[0])
+    elif mode == '-2':
+        print 'Two pass Neptune assembler'
+        result = None
+        if firstPass(args[0]):
+            result = secondPass(args[0])
+    elif mode == '-O':
+        print 'Optimizing Neptune assembler'
+        result, notes, report = optimizedPass(args[0], check, steps)
+        for line in report:
+            print line
+    else:
+        print 'One pass Neptune assembler'
+        result = onePass(args[0])
+    printDiagnostics()
+    if result == None:
+        print 'Cancelled, {0:d} errors'.format(errorCount())
+        exit(1)
+    if analysis:
+        blocks, report = analyze(result)
+        for i in blocks:
+            notes.setdefault(i, []).extend(blocks[i])
+        for line in report:
+            print line
+    writeOutput(args[0], result, formats, width, notes)
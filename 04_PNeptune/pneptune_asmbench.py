@@ -0,0 +1,248 @@
+#!/usr/bin/python
+'''
+PNeptune assembler benchmark
+
+Generates sources from opcode_tbl of the assembler and times the phases of the
+two pass assembler on them: tokenizing, pass 1, pass 2 and writing the output
+(listing and hex), every phase the best of -r runs. total is a whole run from
+cold caches. Every source is assembled in its own process, its peak memory is
+reported too.
+
+pneptune_asmbench.py [-n lines,...] [-m mix] [-s seed] [-r runs] [-o results.json]
+                     [-b baseline.json] [-g source.pnasm]
+
+-n  number of opcodes of the sources, default 1000,10000,100000
+-m  opcode mix as name=weight,..., like ADD=4,MOV=2,JMP=1, the opcodes not
+    given are left out, default every opcode of opcode_tbl with weight 1
+-s  seed of the generator
+-o  writes the results as JSON
+-b  compares the times with the results of an earlier run
+-g  only writes a source of the first size
+
+Every 8th opcode has a label, jumps and calls go to a random label, half of
+them further down (forward references).
+
+'''
+from sys import *
+import os
+import time
+import json
+import random
+import shutil
+import tempfile
+import resource
+import multiprocessing
+import pneptune_asm
+from pneptune_asm import opcode_tbl, OP_NAME, OP_DECHEX, OP_TYPE
+from pneptune_asm import T_ONE_OP, T_TWO_OP, T_TWO_CNT, T_TWO_OP_S, T_ABS, T_LDN, T_NONE, T_ONE_LIT
+
+LABELEVERY = 8      # opcodes per label
+FORWARD = 0.5       # part of the jumps that go further down
+COMMENTS = 0.1      # part of comment lines
+PHASES = [ 'tokenize', 'pass 1', 'pass 2', 'output', 'total' ]
+SIZES = [ 'w', 'a', 'x', 'xs', 's', 'm', 'b', 'p', 'wp' ]
+REGS = [ 'a', 'b', 'c', 'd', 'r6', 'r7', 'r8', 'r10', 'r11', 'r12', 'r13' ]
+# operand types the generator writes arguments for
+GEN_TYPES = ( T_ONE_OP, T_TWO_OP, T_TWO_CNT, T_TWO_OP_S, T_ABS, T_LDN, T_NONE, T_ONE_LIT )
+
+# returns the opcodes of a mix and their weights
+def Neptune_BenchMix(spec):
+    ops = [ op for op in opcode_tbl if op[OP_NAME] != '' and op[OP_TYPE] in GEN_TYPES ]
+    if spec == '':
+        return ops, [ 1.0 ] * len(ops)
+    weights = dict()
+    for item in spec.split(','):
+        name, weight = item.split('=')
+        if name.upper() not in [ op[OP_NAME] for op in ops ]:
+            raise ValueError('Unknown opcode {0:s}'.format(name))
+        weights[name.upper()] = float(weight)
+    ops = [ op for op in ops if op[OP_NAME] in weights ]
+    return ops, [ weights[op[OP_NAME]] for op in ops ]
+# returns the source line of an opcode, label: label of the line or ''
+# target: label for jumps
+def Neptune_BenchLine(op, rnd, label, target):
+    t = op[OP_TYPE]
+    name = op[OP_NAME].lower()
+    if op[OP_DECHEX] != '':
+        name = name + '.' + op[OP_DECHEX].lower()
+    if t in (T_ONE_OP, T_TWO_OP, T_TWO_CNT, T_TWO_OP_S):
+        name = name + '.' + rnd.choice(SIZES)
+    if t == T_TWO_OP or t == T_TWO_OP_S:
+        args = rnd.choice(REGS) + ',' + rnd.choice(REGS)
+    elif t == T_TWO_CNT:
+        args = '{0:s},#{1:d}'.format(rnd.choice(REGS), rnd.randrange(16))
+    elif t == T_ONE_OP:
+        args = rnd.choice(REGS)
+    elif t == T_LDN:
+        args = '{0:s},#{1:d}'.format(rnd.choice(REGS), rnd.randrange(16 ** rnd.randrange(1, 6)))
+    elif t == T_ONE_LIT:
+        args = '#{0:d}'.format(rnd.randrange(32))
+    elif t == T_ABS:
+        args = target
+    else:
+        args = ''
+    line = '{0:8s}{1:12s}{2:s}'.format(label + ':' if label != '' else '', name, args).rstrip()
+    if rnd.random() < COMMENTS:
+        line = line.ljust(40) + '; ' + name
+    return line + '\n'
+# returns the lines of a source with count opcodes
+def Neptune_BenchSource(count, spec, seed):
+    rnd = random.Random(seed)
+    ops, weights = Neptune_BenchMix(spec)
+    total = sum(weights)
+    cumul = []
+    s = 0.0
+    for w in weights:
+        s += w
+        cumul.append(s / total)
+    nlabels = (count + LABELEVERY - 1) // LABELEVERY
+    lines = [ '; {0:d} opcodes, mix {1:s}, seed {2:d}\n'.format(count, spec or 'all', seed) ]
+    for i in range(count):
+        if rnd.random() < COMMENTS:
+            lines.append('; comment {0:d}\n'.format(i))
+        r = rnd.random()
+        k = 0
+        while cumul[k] < r:
+            k += 1
+        here = i // LABELEVERY
+        if here + 1 < nlabels and (here == 0 or rnd.random() < FORWARD):
+            target = rnd.randrange(here + 1, nlabels)
+        else:
+            target = rnd.randrange(0, here + 1)
+        label = ''
+        if i % LABELEVERY == 0:
+            label = 'L{0:d}'.format(here)
+        lines.append(Neptune_BenchLine(ops[k], rnd, label, 'L{0:d}'.format(target)))
+    return lines
+# clears the symbols, diagnostics and caches of the assembler
+def Neptune_BenchReset():
+    pneptune_asm.symbolTable.clear()
+    del pneptune_asm.diagnostics[:]
+    pneptune_asm.tokenIndex.clear()
+# times the phases of the assembler on a source, runs times
+# returns { phase: best seconds }, the number of words and the peak memory
+def Neptune_BenchCase(fileName, runs):
+    f = open(fileName, 'rt')
+    lines = f.readlines()
+    f.close()
+    best = dict()
+    words = 0
+    for run in range(runs):
+        Neptune_BenchReset()
+        times = [ time.time() ]
+        items = list(pneptune_asm.tokenizeLines(lines))
+        times.append(time.time())
+        # the tokens are cached now, the passes time the work after tokenizing
+        pneptune_asm.symbolTable.clear()
+        ok = pneptune_asm.firstPass(fileName)
+        times.append(time.time())
+        result = pneptune_asm.secondPass(fileName)
+        times.append(time.time())
+        if not ok or result == None:
+            pneptune_asm.printDiagnostics()
+            raise ValueError('{0:s} has errors'.format(fileName))
+        pneptune_asm.writeOutput(fileName, result)
+        times.append(time.time())
+        Neptune_BenchReset()
+        if pneptune_asm.firstPass(fileName):
+            pneptune_asm.writeOutput(fileName, pneptune_asm.secondPass(fileName))
+        times.append(time.time())
+        for i in range(len(PHASES)):
+            best[PHASES[i]] = min(best.get(PHASES[i], 1e9), times[i + 1] - times[i])
+        words = len(pneptune_asm.getWords(result))
+    return best, words, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+# runs a case in a new process, returns its results
+def Neptune_BenchRun(count, spec, seed, runs, tmpdir):
+    fileName = os.path.join(tmpdir, 'bench{0:d}.pnasm'.format(count))
+    lines = Neptune_BenchSource(count, spec, seed)
+    f = open(fileName, 'wt')
+    f.writelines(lines)
+    f.close()
+    pool = multiprocessing.Pool(1)
+    best, words, peak = pool.apply(Neptune_BenchCase, (fileName, runs))
+    pool.close()
+    pool.join()
+    phases = dict()
+    for phase in PHASES:
+        phases[phase] = { 'seconds': best[phase], 'lines_per_s': len(lines) / max(best[phase], 1e-9) }
+    return { 'opcodes': count, 'lines': len(lines), 'words': words, 'mix': spec or 'all',
+             'seed': seed, 'peak_kb': peak, 'phases': phases }
+# returns the case of the results with the same source or None
+def Neptune_BenchFind(results, case):
+    for c in results['cases']:
+        if (c['opcodes'], c['mix'], c['seed']) == (case['opcodes'], case['mix'], case['seed']):
+            return c
+    return None
+# prints the results of a case, compared to the baseline case when given
+def Neptune_BenchPrint(case, base):
+    print '{0:d} opcodes, {1:d} lines, {2:d} words, peak memory {3:d} KB'.format(
+        case['opcodes'], case['lines'], case['words'], case['peak_kb'])
+    for phase in PHASES:
+        p = case['phases'][phase]
+        s = '  {0:10s} {1:8.3f} s {2:10.0f} lines/s'.format(phase, p['seconds'], p['lines_per_s'])
+        if base != None:
+            b = base['phases'][phase]['seconds']
+            s = s + '  baseline {0:8.3f} s {1:+6.1f}%'.format(b, 100.0 * (p['seconds'] - b) / max(b, 1e-9))
+        print s
+
+
+if __name__ == '__main__':
+    args = argv[1:]
+    counts = [ 1000, 10000, 100000 ]
+    spec = ''
+    seed = 1
+    runs = 3
+    output = None
+    baseline = None
+    generate = None
+    while len(args) > 1 and args[0][0] == '-':
+        if args[0] == '-n':
+            counts = [ int(n) for n in args[1].split(',') ]
+        elif args[0] == '-m':
+            spec = args[1]
+        elif args[0] == '-s':
+            seed = int(args[1])
+        elif args[0] == '-r':
+            runs = int(args[1])
+        elif args[0] == '-o':
+            output = args[1]
+        elif args[0] == '-b':
+            baseline = json.load(open(args[1]))
+        elif args[0] == '-g':
+            generate = args[1]
+        else:
+            print 'Unknown option {0:s}'.format(args[0])
+            exit(1)
+        args = args[2:]
+    if len(args) != 0:
+        print 'usage: pneptune_asmbench.py [-n lines,...] [-m mix] [-s seed] [-r runs] [-o results.json] [-b baseline.json] [-g source.pnasm]'
+        exit(1)
+    try:
+        Neptune_BenchMix(spec)
+    except ValueError as e:
+        print e
+        exit(1)
+    if generate != None:
+        f = open(generate, 'wt')
+        f.writelines(Neptune_BenchSource(counts[0], spec, seed))
+        f.close()
+        exit(0)
+
+    results = { 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': version.split()[0],
+                'runs': runs, 'cases': [] }
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for count in counts:
+            case = Neptune_BenchRun(count, spec, seed, runs, tmpdir)
+            results['cases'].append(case)
+            base = None
+            if baseline != None:
+                base = Neptune_BenchFind(baseline, case)
+            Neptune_BenchPrint(case, base)
+    finally:
+        shutil.rmtree(tmpdir)
+    if output != None:
+        f = open(output, 'wt')
+        json.dump(results, f, indent = 1, sort_keys = True)
+        f.write('\n')
+        f.close()
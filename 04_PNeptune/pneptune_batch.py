@@ -0,0 +1,135 @@
+#!/usr/bin/python
+'''
+PNeptune batch runner
+
+Runs many programs on a pool of worker processes, one NeptuneCPU per program.
+
+pneptune_batch.py [-e list|int] [-t] [-j workers] [-n steps] [-h] <dir|manifest>
+
+A directory runs all .bin files in it. A manifest has one program per line,
+the code file and optional initial register values in hex, relative names are
+relative to the manifest:
+
+    sqrt.bin
+    add.bin A=0000000000000000000000000000123 B=45
+
+For every program a line is written as soon as it is done:
+
+    name  steps  carry  compare  halt  registers 0..15 [trace hash]
+
+'''
+from sys import *
+import os
+import hashlib
+import multiprocessing
+import pneptune_sim
+from pneptune_sim import RN, CARRYF, CMPF
+
+CHUNK = 64  # programs sent to a worker at once
+
+# reads a directory or a manifest, returns [ name, code, { register: value } ]
+def Neptune_ReadBatch(name):
+    progs = []
+    if os.path.isdir(name):
+        for f in sorted(os.listdir(name)):
+            if f.endswith('.bin'):
+                progs.append([ f, pneptune_sim.Neptune_ReadCode(os.path.join(name, f)), dict() ])
+        return progs
+    base = os.path.dirname(name)
+    for line in open(name):
+        items = line.split('#')[0].split()
+        if len(items) == 0:
+            continue
+        regs = dict()
+        for item in items[1:]:
+            reg, value = item.split('=')
+            regs[RN.index(reg)] = int(value, 16)
+        progs.append([ items[0], pneptune_sim.Neptune_ReadCode(os.path.join(base, items[0])), regs ])
+    return progs
+#
+# Workers
+#
+# The programs are sent once to every worker when the pool starts, the tasks
+# are only the index ranges of the programs.
+#
+PROGS = None
+OPTS = None
+
+class Neptune_TraceHash(object):
+    def __init__(self):
+        self.h = hashlib.sha1()
+
+    def write(self, data):
+        self.h.update(data)
+
+def Neptune_BatchInit(progs, opts):
+    global PROGS, OPTS
+    PROGS = progs
+    OPTS = opts
+    pneptune_sim.Neptune_SelectEngine(opts['engine'])
+# runs the programs first..last-1, returns the result lines
+def Neptune_BatchRun(task):
+    first, last = task
+    lines = []
+    for name, code, regs in PROGS[first:last]:
+        cpu = pneptune_sim.NeptuneCPU(list(code))
+        for ireg in regs:
+            cpu.setReg(ireg, regs[ireg])
+        h = None
+        if OPTS['hash']: # the binary trace of the run goes into the hash
+            h = Neptune_TraceHash()
+            pneptune_sim.Neptune_TraceLevel(cpu, pneptune_sim.TRACE_FULL, 4096)
+            pneptune_sim.Neptune_TraceStream(cpu, h)
+        count, elapsed = cpu.run(OPTS['steps'], blocks = OPTS['blocks'])
+        s = '{0:s}\t{1:d}\t{2:d}\t{3:d}\t{4:s}'.format(name, count, cpu.RF[CARRYF], cpu.RF[CMPF], cpu.HALT or 'steps')
+        for i in range(pneptune_sim.MAXALUREGS):
+            s = s + '\t{0:032x}'.format(pneptune_sim.Neptune_SnapshotValue(cpu.RR[i]))
+        if h != None:
+            pneptune_sim.Neptune_TraceClose(cpu)
+            s = s + '\t' + h.h.hexdigest()
+        lines.append(s)
+    return lines
+
+
+if __name__ == '__main__':
+    args = argv[1:]
+    opts = { 'engine': 'list', 'blocks': False, 'steps': 1000000, 'hash': False }
+    workers = None
+    while len(args) > 1 and args[0][0] == '-':
+        if args[0] == '-e' and len(args) > 2:
+            opts['engine'] = args[1]
+            args = args[2:]
+        elif args[0] == '-t':
+            opts['engine'] = 'int' # translated blocks need the int engine
+            opts['blocks'] = True
+            args = args[1:]
+        elif args[0] == '-j' and len(args) > 2:
+            workers = int(args[1])
+            args = args[2:]
+        elif args[0] == '-n' and len(args) > 2:
+            opts['steps'] = int(args[1])
+            args = args[2:]
+        elif args[0] == '-h':
+            opts['hash'] = True
+            args = args[1:]
+        else:
+            print 'Unknown option {0:s}'.format(args[0])
+            exit(1)
+    if len(args) != 1:
+        print 'usage: pneptune_batch.py [-e list|int] [-t] [-j workers] [-n steps] [-h] <dir|manifest>'
+        exit(1)
+    if opts['hash'] and opts['blocks']:
+        print 'translated blocks are not traced, -h needs the interpreter'
+        exit(1)
+    if not pneptune_sim.Neptune_SelectEngine(opts['engine']):
+        print 'Unknown engine {0:s}'.format(opts['engine'])
+        exit(1)
+
+    progs = Neptune_ReadBatch(args[0])
+    tasks = [ (i, min(i + CHUNK, len(progs))) for i in range(0, len(progs), CHUNK) ]
+    pool = multiprocessing.Pool(workers, Neptune_BatchInit, (progs, opts))
+    for lines in pool.imap_unordered(Neptune_BatchRun, tasks):
+        for line in lines:
+            stdout.write(line + '\n')
+    pool.close()
+    pool.join()
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+'''
+PNeptune disassembler
+
+Decodes opcode words with opcode_tbl of the assembler, the text is in the
+syntax of the assembler: assembling it gives the same words back. The traces
+of the simulator are made with it.
+
+pneptune_dis.py [-s] <code file>
+
+The code file is read like the simulator does. The listing has the byte
+address, the word and its text, jump targets are labels named after their
+address. -s writes assembler source instead.
+
+'''
+from sys import *
+import operator
+from pneptune_asm import opcode_tbl, SIZE_TBL, OP_NAME, OP_DECHEX, OP_BASE, OP_TYPE
+from pneptune_asm import T_ONE_OP, T_TWO_OP, T_TWO_CNT, T_ONE_OP_S, T_TWO_OP_S, T_REL, T_ABS
+from pneptune_asm import T_LS_ABS, T_LDN, T_LDB, T_LDW, T_NONE, T_ONE_LIT
+
+# opcodes the simulator runs but the assembler doesn't assemble yet
+sim_tbl = [
+    [ 'LOAD', '', 0x60000000, T_TWO_OP_S,  1 ], # load Rd from @Rs
+    [ 'STO',  '', 0x68000000, T_TWO_OP_S,  1 ], # store Rd to @Rs
+    [ 'JMP',  '', 0x70000000, T_ABS,       2 ], # jump absolute
+    [ 'CALL', '', 0x70010000, T_ABS,       2 ], # call absolute
+    [ 'LOAD', '', 0x70020000, T_LS_ABS,    2 ],
+    [ 'STO',  '', 0x70030000, T_LS_ABS,    2 ]
+]
+# names of the registers as the assembler reads them
+REG_NAMES = [ '0', 'R1', 'A', 'B', 'C', 'D', 'R6', 'R7', 'R8', 'R9',
+              'R10', 'R11', 'R12', 'R13', 'R14', 'R15' ]
+# bits of a word set from the arguments by the encoders of the assembler, the
+# other bits are those of the opcode
+ARG_BITS = {
+    T_ONE_OP   : 0x00F0FFFF, # dst, field
+    T_TWO_OP   : 0x00FFFFFF, # dst, src, field
+    T_TWO_CNT  : 0x00FFFFFF, # dst, constant, field
+    T_ONE_OP_S : 0x0000FFFF, # field
+    T_TWO_OP_S : 0x00FFFFFF, # dst, src, field
+    T_REL      : 0x0000FFFF,
+    T_ABS      : 0x0000FFFF, # word address
+    T_LS_ABS   : 0x00F0FFFF, # dst, word address
+    T_LDN      : 0x07FFFFFF, # number of nibbles, dst, nibbles
+    T_LDB      : 0x00F000FF, # dst, byte
+    T_LDW      : 0x00F0FFFF,
+    T_NONE     : 0x00000000,
+    T_ONE_LIT  : 0x0000001F  # literal
+}
+# size extension by field, fields without extension are written as the
+# simulator shows them
+FIELD_NAMES = dict()
+for size in SIZE_TBL:
+    if size != 'Z':
+        FIELD_NAMES[SIZE_TBL[size]] = '.' + size
+FIELD_NAMES[SIZE_TBL['Z']] = ''
+
+# returns the bits of an opcode that don't come from its arguments
+def Neptune_OpMask(op):
+    return ~ARG_BITS[op[OP_TYPE]] & 0xFFFFFFFF
+# opcodes by the top byte of the word, most specific first
+DECODE_TBL = [ [] for i in range(256) ]
+for op in opcode_tbl + sim_tbl:
+    if op[OP_NAME] == '':
+        continue
+    for byte in range(256):
+        if (byte << 24) & Neptune_OpMask(op) == op[OP_BASE] & Neptune_OpMask(op) & 0xFF000000:
+            DECODE_TBL[byte].append(op)
+for ops in DECODE_TBL:
+    ops.sort(key = lambda op: -bin(Neptune_OpMask(op)).count('1'))
+
+# text of the words, decoded once
+DISCACHE = dict()
+
+# returns the opcode of a word or None
+def Neptune_Opcode(word):
+    for op in DECODE_TBL[word >> 24]:
+        mask = Neptune_OpMask(op)
+        if (word & mask) == (op[OP_BASE] & mask):
+            return op
+    return None
+# returns the name of the jump target of a word, its byte address like the PC
+def Neptune_Target(word):
+    return 'L{0:05x}'.format((word << 2) & 0x003FFFFF)
+# returns the text of a word
+def Neptune_DecodeText(word):
+    op = Neptune_Opcode(word)
+    if op == None:
+        return 'unknown'
+    t = op[OP_TYPE]
+    dst = REG_NAMES[(word >> 20) & 15]
+    src = (word >> 16) & 15
+    field = ((word >> 8) & 255, word & 255)
+    name = op[OP_NAME]
+    if op[OP_DECHEX] != '':
+        name = name + '.' + op[OP_DECHEX]
+    if t in (T_ONE_OP, T_TWO_OP, T_TWO_CNT, T_ONE_OP_S, T_TWO_OP_S, T_LS_ABS):
+        name = name + FIELD_NAMES.get(field, '.[{0:2d}..{1:2d}]'.format(field[0], field[1]))
+    if t == T_TWO_OP or t == T_TWO_OP_S:
+        args = dst + ',' + REG_NAMES[src]
+    elif t == T_TWO_CNT:
+        args = '{0:s},#{1:d}'.format(dst, src)
+    elif t == T_ONE_OP:
+        args = dst
+    elif t == T_LDN:
+        count = (word >> 24) & 7
+        if count == 0 or count > 5:
+            return 'unknown'
+        args = '{0:s},#{1:d}'.format(dst, word & ((1 << (4 * count)) - 1))
+    elif t == T_LDB:
+        args = '{0:s},#{1:d}'.format(dst, word & 255)
+    elif t == T_ABS:
+        args = Neptune_Target(word)
+    elif t == T_LS_ABS:
+        args = '{0:s},#{1:d}'.format(dst, word & 0xFFFF)
+    elif t == T_ONE_LIT:
+        args = '#{0:d}'.format(word & 31)
+    else:
+        return name
+    return name.ljust(8) + ' ' + args
+# returns the text of a word, cached
+def Neptune_Disasm(word):
+    s = DISCACHE.get(word)
+    if s == None:
+        s = Neptune_DecodeText(word)
+        DISCACHE[word] = s
+    return s
+# decodes the words not decoded yet, returns the set of the different words
+def Neptune_DecodeAll(words):
+    unique = set(words)
+    for word in unique.difference(DISCACHE):
+        DISCACHE[word] = Neptune_DecodeText(word)
+    return unique
+# returns the texts of all words, every different word is decoded once
+def Neptune_DisasmImage(words):
+    Neptune_DecodeAll(words)
+    return map(DISCACHE.__getitem__, words)
+# returns the byte addresses of the jump targets of the words
+def Neptune_Targets(unique):
+    targets = set()
+    for word in unique:
+        op = Neptune_Opcode(word)
+        if op != None and op[OP_TYPE] == T_ABS:
+            targets.add((word << 2) & 0x003FFFFF)
+    return targets
+# returns the byte addresses of count words as text, 5 hex digits
+def Neptune_Addresses(count):
+    low = [ '{0:03x}'.format(pc) for pc in range(0, 4096, 4) ]
+    addrs = []
+    for high in range(0, (count + 1023) >> 10):
+        addrs.extend(map('{0:02x}'.format(high).__add__, low))
+    del addrs[count:]
+    return addrs
+# returns the listing of the words: address, word and text, the labels of the
+# jump targets on their own lines
+# the text after the address is made once per different word
+def Neptune_Listing(words):
+    unique = Neptune_DecodeAll(words)
+    texts = dict()
+    for word in unique:
+        texts[word] = '  {0:08x}        {1:s}'.format(word, DISCACHE[word])
+    lines = map(operator.add, Neptune_Addresses(len(words)), map(texts.__getitem__, words))
+    listing = []
+    i = 0
+    for pc in sorted(Neptune_Targets(unique)):
+        if pc < 4 * len(words):
+            listing.extend(lines[i:pc >> 2])
+            listing.append('L{0:05x}:'.format(pc))
+            i = pc >> 2
+    listing.extend(lines[i:])
+    return listing
+# returns assembler source of the words, targets outside of the words are
+# defined with .equ
+def Neptune_Source(words):
+    texts = Neptune_DisasmImage(words)
+    targets = Neptune_Targets(set(words))
+    lines = [ '        .equ    L{0:05x}, {1:d}'.format(pc, pc >> 2) for pc in sorted(targets) if pc >= 4 * len(words) ]
+    for i in range(len(words)):
+        label = ''
+        if (i << 2) in targets:
+            label = 'L{0:05x}:'.format(i << 2)
+        lines.append('{0:8s}{1:s}'.format(label, texts[i]))
+    return lines
+
+
+if __name__ == '__main__':
+    args = argv[1:]
+    source = False
+    if len(args) == 2 and args[0] == '-s':
+        source = True
+        args = args[1:]
+    if len(args) != 1:
+        print 'usage: pneptune_dis.py [-s] <code file>'
+        exit(1)
+    import pneptune_sim # reads the code files
+    words = pneptune_sim.Neptune_ReadCode(args[0])
+    if source:
+        lines = Neptune_Source(words)
+    else:
+        lines = Neptune_Listing(words)
+    stdout.write('\n'.join(lines) + '\n')
@@ -14,17 +14,22 @@ Per opcode binary or decimal computation (when it makes sense like add and sub)
 
 '''
 from sys import *
-RA = [ ]     # 4 Address registers
-RR = [ ] # 4 32 nibble registers
-RPC = 0      # 20 bit program counter
-RSTACK = []  # 256 level hw stack
-RSTACKPTR = 0# stack pointer to the last used
-RP = 0       # P register
+from collections import deque
+import struct
+import time
+import mmap
+import string
+import re
+from array import array
+from binascii import hexlify, unhexlify
+from pneptune_dis import Neptune_Disasm
+# the state of a core is kept in a NeptuneCPU, the handlers get it as cpu
+MEMSIZE = 0x10000 # default size of MEM
 CARRYF = 0   # carry flag in F register
 CMPF = 1     # compare flag when true in F register
 FIELDS = [ 'P ', 'WP', 'XS', 'X ', 'S ', 'M ', 'B ', 'W ' ]
+ENGINE = 'list' # register file engine of new CPUs, see Neptune_SelectEngine
 
-DEBUG       = True
 WORDSIZE    = 32
 WORDSIZEM1  = WORDSIZE - 1
 MAXALUREGS  = 16
@@ -33,11 +38,25 @@ set_carry = True
 # register names
 RN = [ '0', 'R1', 'A', 'B', 'C', 'D', 'R6', 'R7', 'R8', '9', 'R10', 'R11', 'R12', 'R13', 'CNT', 'F' ]
 
-def Neptune_Reset():
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    if DEBUG:
+def Neptune_Reset(cpu):
+    if cpu.TRACE != TRACE_OFF:
         print 'Reset'
     
+    cpu.H['Neptune_ClearRegs'](cpu)
+    del cpu.RA[:]
+    for i in range(MAXADDRREGS):
+        cpu.RA.append(0)
+   
+    cpu.RPC = 0
+    cpu.RSTACK = []
+    cpu.RSTACKPTR = 0
+    cpu.RP = 0
+    cpu.RF = [ False, False, False, False, False, False, False, False, False, False, False, False, False, False, False ]
+    
+# clears the ALU register file, list engine: one list of 32 nibbles per register
+def Neptune_ClearRegs(cpu):
+    RR = cpu.RR
+    del RR[:]
     for i in range(MAXALUREGS):
         if i == 9:
             RR.append([9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9, 9])
@@ -45,15 +64,15 @@ def Neptune_Reset():
             RR.append([15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15, 15])
         else:
             RR.append([0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0])
-    for i in range(MAXADDRREGS):
-        RA.append(0)
-   
-    RPC = 0
-    RSTACK = []
-    RSTACKPTR = 0
-    RP = 0
-    RF = [ False, False, False, False, False, False, False, False, False, False, False, False, False, False, False ]
-    
+# loads the constant register 14 with val at nibble nib, all other nibbles are zero
+def Neptune_SetConst(cpu, nib, val):
+    RR = cpu.RR
+    RR[14] = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+    RR[14][nib] = val
+# writes a single nibble
+def Neptune_SetNibble(cpu, ireg, nib, val):
+    RR = cpu.RR
+    RR[ireg][nib] = val
 #
 # Add opcode, adds in binary or decimal from right to left
 # isrc     : first operand register
@@ -61,9 +80,8 @@ def Neptune_Reset():
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
 # set_carry: True if carry has to be set for overflows on the left most nibble
-def Neptune_AddB(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'ADD.H.{0:s}  {1:s},{2:s}'.format(size, RN[idst], RN[isrc])
+def Neptune_AddB(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
     c = 0
     r = 0
     for i in range(nib_start, nib_end):
@@ -78,7 +96,6 @@ def Neptune_AddB(isrc, idst, nib_start, nib_end, size):
         
     if set_carry:
         RF[CARRYF] = c == 1
-    return deb_str
 #
 # Add opcode, adds in decimal from right to left
 # isrc     : first operand register
@@ -86,9 +103,8 @@ def Neptune_AddB(isrc, idst, nib_start, nib_end, size):
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
 # set_carry: True if carry has to be set for overflows on the left most nibble
-def Neptune_AddD(isrc, idst, nib_start, nib_end, size):
-    #global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'ADD.D.{0:s}  {1:s},{2:s}'.format(size, RN[idst], RN[isrc])
+def Neptune_AddD(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
     c = 0
     r = 0
     for i in range(nib_start, nib_end+1):
@@ -99,10 +115,9 @@ def Neptune_AddD(isrc, idst, nib_start, nib_end, size):
         else:
             c = 0
         if (idst != 0) and (idst != 9) and (idst != 15):
-            RR[idst][i] = r
+            RR[idst][i] = r & 15 # the low 4 bits, also when not BCD
     if set_carry:
         RF[CARRYF] = c == 1
-    return deb_str
 #
 # RSub opcode, reverse sub in binary or decimal from right to left
 # isrc     : first operand register
@@ -110,9 +125,8 @@ def Neptune_AddD(isrc, idst, nib_start, nib_end, size):
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
 # set_carry: True if carry has to be set for overflows on the left most nibble
-def Neptune_RSubB(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'RSUB.H.{0:s} {1:s},{2:s}'.format(size, RN[idst], RN[isrc])
+def Neptune_RSubB(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
     c = 0
     r = 0
     for i in range(nib_start, nib_end+1):
@@ -127,7 +141,6 @@ def Neptune_RSubB(isrc, idst, nib_start, nib_end, size):
         
     if set_carry:
         RF[CARRYF] = c == 1
-    return deb_str
 #
 # RSub opcode, reverse sub in decimal from right to left
 # isrc     : first operand register
@@ -135,9 +148,8 @@ def Neptune_RSubB(isrc, idst, nib_start, nib_end, size):
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
 # set_carry: True if carry has to be set for overflows on the left most nibble
-def Neptune_RSubD(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'RSUB.D.{0:s} {1:s},{2:s}'.format(size, RN[idst], RN[isrc])
+def Neptune_RSubD(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
     c = 0
     r = 0
     for i in range(nib_start, nib_end+1):
@@ -149,11 +161,10 @@ def Neptune_RSubD(isrc, idst, nib_start, nib_end, size):
             c = 0
             r -= 10
         if (idst != 0) and (idst != 9) and (idst != 15):
-            RR[idst][i] = r
+            RR[idst][i] = r & 15
         
     if set_carry:
         RF[CARRYF] = c == 1
-    return deb_str
 #
 # Sub opcode, sub in binary from right to left
 # isrc     : first operand register
@@ -161,9 +172,8 @@ def Neptune_RSubD(isrc, idst, nib_start, nib_end, size):
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
 # set_carry: True if carry has to be set for overflows on the left most nibble
-def Neptune_SubB(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'SUB.H.{0:s}  {1:s},{2:s}'.format(size, RN[idst], RN[isrc])
+def Neptune_SubB(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
     c = 0
     r = 0
     for i in range(nib_start, nib_end+1):
@@ -179,7 +189,6 @@ def Neptune_SubB(isrc, idst, nib_start, nib_end, size):
         
     if set_carry:
         RF[CARRYF] = c == 1
-    return deb_str
 #
 # Sub opcode, sub in decimal from right to left
 # isrc     : first operand register
@@ -187,9 +196,8 @@ def Neptune_SubB(isrc, idst, nib_start, nib_end, size):
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
 # set_carry: True if carry has to be set for overflows on the left most nibble
-def Neptune_SubD(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'SUB.D.{0:s}  {1:s},{2:s}'.format(size, RN[idst], RN[isrc])
+def Neptune_SubD(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
     c = 0
     r = 0
     for i in range(nib_start, nib_end+1):
@@ -202,65 +210,57 @@ def Neptune_SubD(isrc, idst, nib_start, nib_end, size):
             r -= 10
         #print r, RR[idst][i], RR[isrc][i], c
         if (idst != 0) and (idst != 9) and (idst != 15):
-            RR[idst][i] = r
+            RR[idst][i] = r & 15
         
     if set_carry:
         RF[CARRYF] = c == 1
-    return deb_str
 #
 # Compare if equal from right to left
 # isrc     : first operand register
 # idst     : send and destination register
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
-def Neptune_CmpEq(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'EQ.{0:s}     {1:s},{2:s}'.format(size, RN[idst], RN[isrc])
+def Neptune_CmpEq(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
     eq = True # equal
     for i in range(nib_start, nib_end+1):
         if RR[idst][i] != RR[isrc][i]:
             eq = False
     RF[CMPF] = eq    
-    return deb_str
 #
 # Compare if not equal from right to left
 # isrc     : first operand register
 # idst     : send and destination register
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
-def Neptune_CmpNEq(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'NEQ.{0:s}    {1:s},{2:s}'.format(size, RN[idst], RN[isrc])
+def Neptune_CmpNEq(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
     eq = True # equal
     for i in range(nib_start, nib_end+1):
         if RR[idst][i] != RR[isrc][i]:
             eq = False
     RF[CMPF] = not eq   
-    return deb_str
 #
 # Compare if greater than from right to left
 # isrc     : first operand register
 # idst     : send and destination register
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
-def Neptune_CmpGT(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'GT.{0:s}     {1:s},{2:s}'.format(size, RN[idst], RN[isrc])
+def Neptune_CmpGT(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
     gt = True
     for i in range(nib_start, nib_end+1):
         gt = RR[idst][i] > RR[isrc][i]
 
     RF[CMPF] = gt
-    return deb_str 
 #
 # Compare if greater than or equal from right to left
 # isrc     : first operand register
 # idst     : send and destination register
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
-def Neptune_CmpGTEQ(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'GTEQ.{0:s}   {1:s},{2:s}'.format(size, RN[idst], RN[isrc])
+def Neptune_CmpGTEQ(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
     eq = True # equal
     gt = False
     for i in range(nib_start, nib_end+1):
@@ -268,31 +268,27 @@ def Neptune_CmpGTEQ(isrc, idst, nib_start, nib_end, size):
             eq = False
         gt = RR[idst][i] > RR[isrc][i]
     RF[CMPF] = eq or gt
-    return deb_str
 #
 # Compare if less than from right to left
 # isrc     : first operand register
 # idst     : send and destination register
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
-def Neptune_CmpLT(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'LT.{0:s}     {1:s},{2:s}'.format(size, RN[idst], RN[isrc])
+def Neptune_CmpLT(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
     lt = True
     for i in range(nib_start, nib_end+1):
         gt = RR[idst][i] < RR[isrc][i]
 
     RF[CMPF] = lt
-    return deb_str
 #
 # Compare if less than or equal from right to left
 # isrc     : first operand register
 # idst     : send and destination register
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
-def Neptune_CmpLTEQ(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'LTEQ.{0:s}   {1:s},{2:s}'.format(size, RN[idst], RN[isrc])
+def Neptune_CmpLTEQ(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
     eq = True # equal
     gt = False
     for i in range(nib_start, nib_end+1):
@@ -300,20 +296,17 @@ def Neptune_CmpLTEQ(isrc, idst, nib_start, nib_end, size):
             eq = False
         gt = RR[idst][i] > RR[isrc][i]
     RF[CMPF] = (not eq) or (not gt)
-    return deb_str
 #
 # And from right to left
 # isrc     : first operand register
 # idst     : send and destination register
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
-def Neptune_AND(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'AND.{0:s}    {1:s},{2:s}'.format(size, RN[idst], RN[isrc])
+def Neptune_AND(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
     for i in range(nib_start, nib_end+1):
         if (idst != 0) and (idst != 9) and (idst != 15):
             RR[idst][i] = RR[idst][i] & RR[isrc][i]
-    return deb_str
 #
 # OR from right to left
 # And from right to left
@@ -321,97 +314,106 @@ def Neptune_AND(isrc, idst, nib_start, nib_end, size):
 # idst     : send and destination register
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
-def Neptune_OR(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'OR.{0:s}     {1:s},{2:s}'.format(size, RN[idst], RN[isrc])
+def Neptune_OR(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
     for i in range(nib_start, nib_end+1):
         if (idst != 0) and (idst != 9) and (idst != 15):
             RR[idst][i] = RR[idst][i] & RR[isrc][i]
-    return deb_str
 # XOR from right to left
 # isrc     : first operand register
 # idst     : send and destination register
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
-def Neptune_XOR(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'XOR.{0:s}    {1:s},{2:s}'.format(size, RN[idst], RN[isrc])
+def Neptune_XOR(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
     for i in range(nib_start, nib_end+1):
         if (idst != 0) and (idst != 9) and (idst != 15):
             RR[idst][i] = RR[idst][i] ^ RR[isrc][i]
-    return deb_str
 # NOT from right to left
 # isrc     : first operand register
 # idst     : send and destination register
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
-def Neptune_NOT(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'NOT.{0:s}    {1:s}'.format(size, RN[idst])
+def Neptune_NOT(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
     for i in range(nib_start, nib_end+1):
         if (idst != 0) and (idst != 9) and (idst != 15):
             RR[idst][i] = 15 - RR[isrc][i]
-    return deb_str
 # Moves nibbles
 # isrc     : first operand register
 # idst     : send and destination register
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
-def Neptune_MOV(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry, RN
-    deb_str = 'MOV.{0:s}    {1:s},{2:s}'.format(size, RN[idst], RN[isrc])
+def Neptune_MOV(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
     #print dumpReg(isrc)
     #print dumpReg(idst)
     for i in range(nib_start, nib_end+1):
         if (idst != 0) and (idst != 9) and (idst != 15):
             RR[idst][i] = RR[isrc][i]
-    return deb_str    
 # Exchanges nibbles
 # isrc     : first operand register
 # idst     : send and destination register
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
-def Neptune_EX(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'EX.{0:s}     {1:s},{2:s}'.format(size, RN[idst], RN[isrc])
+def Neptune_EX(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
     for i in range(nib_start, nib_end+1):
         t = RR[isrc][i]
         if (isrc != 0) and (isrc != 9) and (isrc != 15):
             RR[isrc][i] = RR[idst][i]
         if (idst != 0) and (idst != 9) and (idst != 15):
             RR[idst][i] = t
-    return deb_str        
 # SRD shift right a whole nibble, zeroes are feeded from the right
 # isrc     : first operand register
 # idst     : send and destination register
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
-def Neptune_SRD(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'SR.D.{0:s}   {1:s}'.format(size, RN[idst])
+def Neptune_SRD(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
     if nib_start < nib_end:
         for i in range(nib_start + 1, nib_end + 1):
             if (idst != 0) and (idst != 9) and (idst != 15):
                 RR[idst][i - 1] = RR[idst][i]
     if (idst != 0) and (idst != 9) and (idst != 15):
         RR[idst][nib_end] = 0
-    return deb_str
 # SLD shift right a whole nibble
 # isrc     : first operand register
 # idst     : send and destination register
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
-def Neptune_SLD(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'SL.D.{0:s}   {1:s}'.format(size, RN[idst])
-
+def Neptune_SLD(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
     if (idst != 0) and (idst != 9) and (idst != 15):
         if nib_start < nib_end:
             for i in range(nib_end, nib_start, -1):
                 if (i + 1) < WORDSIZE:
                     RR[idst][i+1] = RR[idst][i]
         RR[idst][nib_start] = 0
-    return deb_str
+#
+# Memory
+#
+# MEM is a bytearray (or a mmap of a file) of MEMSIZE bytes, two nibbles per
+# byte, the high nibble first. Fields are read and written as strings of hex
+# digits in memory order with one slice per access.
+#
+# reads count nibbles at the byte address addr, returns the hex digits
+def Neptune_MemRead(cpu, addr, count):
+    MEM = cpu.MEM
+    n = (count + 1) >> 1
+    if addr < 0 or addr + n > len(MEM):
+        raise IndexError('MEM address {0:x} out of range'.format(addr))
+    return hexlify(MEM[addr:addr + n])[:count]
+# writes the hex digits s at the byte address addr, the low nibble of the last
+# byte is cleared for an odd number of digits
+def Neptune_MemWrite(cpu, addr, s):
+    MEM = cpu.MEM
+    if len(s) & 1:
+        s = s + '0'
+    n = len(s) >> 1
+    if addr < 0 or addr + n > len(MEM):
+        raise IndexError('MEM address {0:x} out of range'.format(addr))
+    MEM[addr:addr + n] = unhexlify(s)
 # Load 
 # loads nib_end - nib_start nibbles atrting at a byte address
 # from most sig byte to least sig byte: 
@@ -426,21 +428,12 @@ def Neptune_SLD(isrc, idst, nib_start, nib_end, size):
 # idst     : send and destination register
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
-def Neptune_LOAD(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'LOAD.{0:s}  {1:s},{2:s}'.format(size, RN[idst], RN[isrc])
-
+def Neptune_LOAD(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
     addr = (RR[isrc][3] << 12) + (RR[isrc][2] << 8) + (RR[isrc][1] << 4) + (RR[isrc][0])
-    high = True
-    for i in range(nib_start, nib_end + 1):
-        if high:
-            high = False
-            RR[idst][i] = (MEM[addr] >> 4) & 15
-        else:
-            high = True
-            RR[idst][i] = MEM[addr] & 15
-            addr += 1
-    return deb_str
+    if nib_end >= nib_start: # nib_start is loaded from the first nibble
+        s = Neptune_MemRead(cpu, addr, nib_end - nib_start + 1)
+        RR[idst][nib_start:nib_end + 1] = [ int(c, 16) for c in s ]
 # Store
 # MEM  +0  +1  +2
 #      65  43  21
@@ -452,27 +445,14 @@ def Neptune_LOAD(isrc, idst, nib_start, nib_end, size):
 # idst     : send and destination register
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
-def Neptune_STO(isrc, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'STO.{0:s}   {1:s}, {2:s}'.format(size, RN[idst], RN[isrc])
-
+def Neptune_STO(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
     addr = (RR[isrc][3] << 12) + (RR[isrc][2] << 8) + (RR[isrc][1] << 4) + (RR[isrc][0])
-    
-    nend = nib_end 
-    flag = True
-    while flag:
-        if nend == nib_start:
-            MEM[addr] = RR[idst][nib_start] << 4
-        else:
-            MEM[addr] = (RR[idst][nend] << 4) + (RR[idst][nend-1] << 4)
-        addr += 1
-        nend -= 2
-        if nend < nib_start:
-            flag = False
-    return deb_str
+    if nib_end >= nib_start:
+        Neptune_MemWrite(cpu, addr, ''.join([ '{0:x}'.format(RR[idst][i]) for i in range(nib_end, nib_start - 1, -1) ]))
 # Load 
 # loads nib_end - nib_start nibbles atrting at a byte address
-# from most sig byte to least sig byte: 
+# from most sig byte to least sig byte, nib_start isn't loaded
 #
 # MEM  +0  +1  +2
 #      65  43  21
@@ -484,20 +464,11 @@ def Neptune_STO(isrc, idst, nib_start, nib_end, size):
 # idst     : send and destination register
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
-def Neptune_LOAD_ABS(addr, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'LOAD.{0:s}  {1:02d}, %04x'.format(size, RN[idst], addr)
-
-    high = True
-    for i in range(nib_end, nib_start, -1):
-        if high:
-            high = False
-            RR[idst][i] = (MEM[addr] >> 4) & 15
-        else:
-            high = True
-            RR[idst][i] = MEM[addr] & 15
-            addr += 1
-    return deb_str
+def Neptune_LOAD_ABS(cpu, addr, idst, nib_start, nib_end):
+    RR = cpu.RR
+    if nib_end > nib_start:
+        s = Neptune_MemRead(cpu, addr, nib_end - nib_start)
+        RR[idst][nib_start + 1:nib_end + 1] = [ int(c, 16) for c in reversed(s) ]
 # Store
 # MEM  +0  +1  +2
 #      65  43  21
@@ -509,68 +480,531 @@ def Neptune_LOAD_ABS(addr, idst, nib_start, nib_end, size):
 # idst     : send and destination register
 # nib_start: right most (start) nibble
 # nib_end  : left most (end) nibble
-def Neptune_STO_ABS(addr, idst, nib_start, nib_end, size):
-    global RR, RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    deb_str = 'STO.{0:s}   {1:02d}, {2:04x}'.format(size, RN[idst], addr)
-
-    nend = nib_end 
-    while flag:
-        if nend == nib_start:
-            MEM[addr] = RR[idst][nib_start] << 4
-        else:
-            MEM[addr] = (RR[idst][nend] << 4) + (RR[idst][nend-1] << 4)
-        addr += 1
-        nend -= 2
-        if nend < nib_start:
-            flag = False
-    return deb_str
+def Neptune_STO_ABS(cpu, addr, idst, nib_start, nib_end):
+    RR = cpu.RR
+    if nib_end >= nib_start:
+        Neptune_MemWrite(cpu, addr, ''.join([ '{0:x}'.format(RR[idst][i]) for i in range(nib_end, nib_start - 1, -1) ]))
     
-def dumpReg(isrc):
-    global RR, RN
+def dumpReg(cpu, isrc):
+    RR = cpu.RR
     s = '{0:s}: '.format(RN[isrc])
     for j in range(WORDSIZEM1, 0, -1):
         s = s + '{0:x}'.format(RR[isrc][j])
     return s
+# returns a copy of the register for the trace
+def Neptune_Snapshot(cpu, isrc):
+    RR = cpu.RR
+    return tuple(RR[isrc])
     
-# executes a single step
-# Updates all registers as needed
-# word0 : least significant word
-# word1 : most significant word
 #
+# Packed integer engine
+#
+# Each 128 bit register is kept as a single int, nibble n lives in bits 4n+3..4n.
+# The ALU opcodes work on whole fields with masks instead of looping over the
+# nibbles. Results and flags are the same as the list engine above, the quirks
+# of the list handlers are kept so both engines dump the same registers.
+# Except for decimal add/sub of nibbles that aren't BCD: a nibble result above
+# 15 or below 0 is kept as it is in the list, the int engine keeps its low 4
+# bits like a 4 bit register does (NeptuneInt_DecSerial).
+#
+WORDMASK = (1 << (4 * WORDSIZE)) - 1
+ONES     = WORDMASK // 15               # 0x111...1
+SIXES    = ONES * 6                     # 0x666...6
+NINES    = ONES * 9                     # 0x999...9
+EIGHTS   = ONES * 8                     # 0x888...8
+# NMASK[n] selects nibble n
+NMASK    = [ 15 << (4 * n) for n in range(WORDSIZE) ]
+# FMASK[start][end] selects nibbles start..end, zero when end < start
+FMASK    = [ [ ((1 << (4 * (e - s + 1))) - 1) << (4 * s) if e >= s else 0 for e in range(WORDSIZE) ] for s in range(WORDSIZE) ]
+# constant registers 0, 9 and F are never written
+WRITABLE = [ (i != 0) and (i != 9) and (i != 15) for i in range(MAXALUREGS) ]
+
+# clears the ALU register file, int engine: one int per register
+def NeptuneInt_ClearRegs(cpu):
+    RR = cpu.RR
+    RR[:] = [ 0 ] * MAXALUREGS
+    RR[9] = NINES
+    RR[15] = WORDMASK
+# loads the constant register 14 with val at nibble nib, all other nibbles are zero
+def NeptuneInt_SetConst(cpu, nib, val):
+    RR = cpu.RR
+    RR[14] = val << (4 * nib)
+# writes a single nibble
+def NeptuneInt_SetNibble(cpu, ireg, nib, val):
+    RR = cpu.RR
+    RR[ireg] = (RR[ireg] & ~NMASK[nib]) | (val << (4 * nib))
+# returns True if any nibble of x is above 9
+def NeptuneInt_NotBCD(x):
+    return (x & ((x << 1) | (x << 2)) & EIGHTS) != 0
+# decimal add of two masked fields a + b + cin using the add six and
+# correct trick, only valid when all nibbles are BCD
+# returns the masked result and the carry out of nibble nib_end
+def NeptuneInt_BCDAdd(a, b, cin, nib_start, nib_end):
+    m = FMASK[nib_start][nib_end]
+    t1 = a + (SIXES & m)
+    t2 = t1 + b + (cin << (4 * nib_start))
+    t3 = t1 ^ b
+    t4 = t2 ^ t3                                # carries into every bit
+    t5 = ~t4 & ((ONES & m) << 4)                # nibbles that didn't carry out
+    t6 = (t5 >> 2) | (t5 >> 3)                  # take the six back
+    return (t2 - t6) & m, (t2 >> (4 * (nib_end + 1))) & 1
+# nibble by nibble decimal add/sub, used when a field holds non BCD nibbles
+# sub: False computes a + b, True computes a - b
+# the result nibbles are masked to 4 bits, the list engine keeps F+F = 20 and
+# 0-F = -5 as they are
+def NeptuneInt_DecSerial(a, b, nib_start, nib_end, sub):
+    c = 0
+    res = 0
+    for i in range(nib_start, nib_end + 1):
+        sh = 4 * i
+        if sub:
+            r = 10 + ((a >> sh) & 15) - ((b >> sh) & 15) - c
+            if r < 10:
+                c = 1
+            else:
+                c = 0
+                r -= 10
+        else:
+            r = ((a >> sh) & 15) + ((b >> sh) & 15) + c
+            if r >= 10:
+                c = 1
+                r -= 10
+            else:
+                c = 0
+        res |= (r & 15) << sh
+    return res, c
+# decimal add a + b of two masked fields, returns the result and the carry
+def NeptuneInt_DecAdd(a, b, nib_start, nib_end):
+    if NeptuneInt_NotBCD(a) or NeptuneInt_NotBCD(b):
+        return NeptuneInt_DecSerial(a, b, nib_start, nib_end, False)
+    return NeptuneInt_BCDAdd(a, b, 0, nib_start, nib_end)
+# decimal subtract a - b of two masked fields, returns the result and the borrow
+def NeptuneInt_DecSub(a, b, nib_start, nib_end):
+    if NeptuneInt_NotBCD(a) or NeptuneInt_NotBCD(b):
+        return NeptuneInt_DecSerial(a, b, nib_start, nib_end, True)
+    m = FMASK[nib_start][nib_end]
+    r, c = NeptuneInt_BCDAdd(a, (NINES & m) - b, 1, nib_start, nib_end) # ten's complement
+    return r, 1 - c
+
+def NeptuneInt_AddB(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
+    c = 0
+    if nib_end > nib_start: # the last nibble is excluded like in Neptune_AddB
+        m = FMASK[nib_start][nib_end - 1]
+        r = (RR[isrc] & m) + (RR[idst] & m)
+        c = (r >> (4 * nib_end)) & 1
+        if WRITABLE[idst]:
+            RR[idst] = (RR[idst] & ~m) | (r & m)
+    if set_carry:
+        RF[CARRYF] = c == 1
+
+def NeptuneInt_AddD(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
+    c = 0
+    if nib_end >= nib_start:
+        m = FMASK[nib_start][nib_end]
+        r, c = NeptuneInt_DecAdd(RR[isrc] & m, RR[idst] & m, nib_start, nib_end)
+        if WRITABLE[idst]:
+            RR[idst] = (RR[idst] & ~m) | r
+    if set_carry:
+        RF[CARRYF] = c == 1
+
+def NeptuneInt_RSubB(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
+    c = 0
+    if nib_end >= nib_start:
+        m = FMASK[nib_start][nib_end]
+        r = (RR[isrc] & m) - (RR[idst] & m)
+        c = r < 0
+        if WRITABLE[idst]:
+            RR[idst] = (RR[idst] & ~m) | (r & m)
+    if set_carry:
+        RF[CARRYF] = c == 1
+
+def NeptuneInt_RSubD(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
+    c = 0
+    if nib_end >= nib_start:
+        m = FMASK[nib_start][nib_end]
+        r, c = NeptuneInt_DecSub(RR[isrc] & m, RR[idst] & m, nib_start, nib_end)
+        if WRITABLE[idst]:
+            RR[idst] = (RR[idst] & ~m) | r
+    if set_carry:
+        RF[CARRYF] = c == 1
+
+def NeptuneInt_SubB(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
+    c = 0
+    if nib_end >= nib_start:
+        m = FMASK[nib_start][nib_end]
+        r = (RR[idst] & m) - (RR[isrc] & m)
+        c = r < 0
+        if WRITABLE[idst]:
+            RR[idst] = (RR[idst] & ~m) | (r & m)
+    if set_carry:
+        RF[CARRYF] = c == 1
+
+def NeptuneInt_SubD(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
+    c = 0
+    if nib_end >= nib_start:
+        m = FMASK[nib_start][nib_end]
+        r, c = NeptuneInt_DecSub(RR[idst] & m, RR[isrc] & m, nib_start, nib_end)
+        if WRITABLE[idst]:
+            RR[idst] = (RR[idst] & ~m) | r
+    if set_carry:
+        RF[CARRYF] = c == 1
+
+def NeptuneInt_CmpEq(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
+    RF[CMPF] = ((RR[idst] ^ RR[isrc]) & FMASK[nib_start][nib_end]) == 0
+
+def NeptuneInt_CmpNEq(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
+    RF[CMPF] = ((RR[idst] ^ RR[isrc]) & FMASK[nib_start][nib_end]) != 0
+# like Neptune_CmpGT only the left most nibble decides
+def NeptuneInt_CmpGT(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
+    gt = True
+    if nib_end >= nib_start:
+        gt = (RR[idst] & NMASK[nib_end]) > (RR[isrc] & NMASK[nib_end])
+    RF[CMPF] = gt
+
+def NeptuneInt_CmpGTEQ(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
+    eq = ((RR[idst] ^ RR[isrc]) & FMASK[nib_start][nib_end]) == 0
+    gt = False
+    if nib_end >= nib_start:
+        gt = (RR[idst] & NMASK[nib_end]) > (RR[isrc] & NMASK[nib_end])
+    RF[CMPF] = eq or gt
+# like Neptune_CmpLT the flag is always set
+def NeptuneInt_CmpLT(cpu, isrc, idst, nib_start, nib_end):
+    RF = cpu.RF
+    RF[CMPF] = True
+
+def NeptuneInt_CmpLTEQ(cpu, isrc, idst, nib_start, nib_end):
+    RR, RF = cpu.RR, cpu.RF
+    eq = ((RR[idst] ^ RR[isrc]) & FMASK[nib_start][nib_end]) == 0
+    gt = False
+    if nib_end >= nib_start:
+        gt = (RR[idst] & NMASK[nib_end]) > (RR[isrc] & NMASK[nib_end])
+    RF[CMPF] = (not eq) or (not gt)
+
+def NeptuneInt_AND(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
+    if WRITABLE[idst]:
+        RR[idst] &= RR[isrc] | ~FMASK[nib_start][nib_end]
+# like Neptune_OR it does an AND
+def NeptuneInt_OR(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
+    if WRITABLE[idst]:
+        RR[idst] &= RR[isrc] | ~FMASK[nib_start][nib_end]
+
+def NeptuneInt_XOR(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
+    if WRITABLE[idst]:
+        RR[idst] ^= RR[isrc] & FMASK[nib_start][nib_end]
+
+def NeptuneInt_NOT(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
+    if WRITABLE[idst]:
+        m = FMASK[nib_start][nib_end]
+        RR[idst] = (RR[idst] & ~m) | (~RR[isrc] & m)
+
+def NeptuneInt_MOV(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
+    if WRITABLE[idst]:
+        m = FMASK[nib_start][nib_end]
+        RR[idst] = (RR[idst] & ~m) | (RR[isrc] & m)
+
+def NeptuneInt_EX(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
+    m = FMASK[nib_start][nib_end]
+    t = RR[isrc]
+    if WRITABLE[isrc]:
+        RR[isrc] = (t & ~m) | (RR[idst] & m)
+    if WRITABLE[idst]:
+        RR[idst] = (RR[idst] & ~m) | (t & m)
+
+def NeptuneInt_SRD(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
+    if WRITABLE[idst]:
+        if nib_start < nib_end:
+            m = FMASK[nib_start][nib_end]
+            RR[idst] = (RR[idst] & ~m) | (((RR[idst] & m) >> 4) & m)
+        else:
+            RR[idst] &= ~NMASK[nib_end]
+# like Neptune_SLD nibbles start+1..end move to start+2..end+1 (up to the
+# left most nibble) and the nibble start+1 keeps its value
+def NeptuneInt_SLD(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
+    if WRITABLE[idst]:
+        if nib_start < nib_end:
+            m = FMASK[nib_start + 1][min(nib_end, WORDSIZE - 2)]
+            RR[idst] = (RR[idst] & ~(m << 4)) | ((RR[idst] & m) << 4)
+        RR[idst] &= ~NMASK[nib_start]
+
+def NeptuneInt_LOAD(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
+    addr = RR[isrc] & 0xFFFF
+    if nib_end >= nib_start:
+        s = Neptune_MemRead(cpu, addr, nib_end - nib_start + 1)
+        m = FMASK[nib_start][nib_end]
+        RR[idst] = (RR[idst] & ~m) | (int(s[::-1], 16) << (4 * nib_start))
+
+def NeptuneInt_STO(cpu, isrc, idst, nib_start, nib_end):
+    RR = cpu.RR
+    addr = RR[isrc] & 0xFFFF
+    if nib_end >= nib_start:
+        n = nib_end - nib_start + 1
+        Neptune_MemWrite(cpu, addr, '{0:0{1:d}x}'.format((RR[idst] >> (4 * nib_start)) & ((1 << (4 * n)) - 1), n))
+
+def NeptuneInt_LOAD_ABS(cpu, addr, idst, nib_start, nib_end):
+    RR = cpu.RR
+    if nib_end > nib_start:
+        s = Neptune_MemRead(cpu, addr, nib_end - nib_start)
+        m = FMASK[nib_start + 1][nib_end]
+        RR[idst] = (RR[idst] & ~m) | (int(s, 16) << (4 * (nib_start + 1)))
+
+def NeptuneInt_STO_ABS(cpu, addr, idst, nib_start, nib_end):
+    RR = cpu.RR
+    if nib_end >= nib_start:
+        n = nib_end - nib_start + 1
+        Neptune_MemWrite(cpu, addr, '{0:0{1:d}x}'.format((RR[idst] >> (4 * nib_start)) & ((1 << (4 * n)) - 1), n))
+
+def NeptuneInt_dumpReg(cpu, isrc):
+    RR = cpu.RR
+    return '{0:s}: {1:031x}'.format(RN[isrc], RR[isrc] >> 4)
+
+def NeptuneInt_Snapshot(cpu, isrc):
+    RR = cpu.RR
+    return RR[isrc]
+
+INT_ENGINE = {
+    'Neptune_ClearRegs' : NeptuneInt_ClearRegs,
+    'Neptune_SetConst'  : NeptuneInt_SetConst,
+    'Neptune_SetNibble' : NeptuneInt_SetNibble,
+    'Neptune_AddB'      : NeptuneInt_AddB,
+    'Neptune_AddD'      : NeptuneInt_AddD,
+    'Neptune_RSubB'     : NeptuneInt_RSubB,
+    'Neptune_RSubD'     : NeptuneInt_RSubD,
+    'Neptune_SubB'      : NeptuneInt_SubB,
+    'Neptune_SubD'      : NeptuneInt_SubD,
+    'Neptune_CmpEq'     : NeptuneInt_CmpEq,
+    'Neptune_CmpNEq'    : NeptuneInt_CmpNEq,
+    'Neptune_CmpGT'     : NeptuneInt_CmpGT,
+    'Neptune_CmpGTEQ'   : NeptuneInt_CmpGTEQ,
+    'Neptune_CmpLT'     : NeptuneInt_CmpLT,
+    'Neptune_CmpLTEQ'   : NeptuneInt_CmpLTEQ,
+    'Neptune_AND'       : NeptuneInt_AND,
+    'Neptune_OR'        : NeptuneInt_OR,
+    'Neptune_XOR'       : NeptuneInt_XOR,
+    'Neptune_NOT'       : NeptuneInt_NOT,
+    'Neptune_MOV'       : NeptuneInt_MOV,
+    'Neptune_EX'        : NeptuneInt_EX,
+    'Neptune_SRD'       : NeptuneInt_SRD,
+    'Neptune_SLD'       : NeptuneInt_SLD,
+    'Neptune_LOAD'      : NeptuneInt_LOAD,
+    'Neptune_STO'       : NeptuneInt_STO,
+    'Neptune_LOAD_ABS'  : NeptuneInt_LOAD_ABS,
+    'Neptune_STO_ABS'   : NeptuneInt_STO_ABS,
+    'dumpReg'           : NeptuneInt_dumpReg,
+    'Neptune_Snapshot'  : NeptuneInt_Snapshot
+}
+# the list engine handlers by the same names
+LIST_ENGINE = dict([ (name, globals()[name]) for name in INT_ENGINE ])
+# the handlers of every engine, a CPU calls the handlers of its engine (cpu.H)
+ENGINES = { 'list': LIST_ENGINE, 'int': INT_ENGINE }
+# selects the register file engine of the CPUs created from now on, CPUs
+# created before keep their engine
+# name: 'list' (default) or 'int'
+def Neptune_SelectEngine(name):
+    global ENGINE
+    if not name in ENGINES:
+        return False
+    ENGINE = name
+    return True
+
+#
+# Decoder
+#
+# Every word is decoded once into a tuple, the first item is the executor,
+# the second the original word, the rest are the resolved operands for the
+# executor. Decoded words are kept in the DCACHE of the CPU by their PC. The
+# code is fetched from memory, LOAD/STO only reach MEM, so decoded words stay
+# valid until other code is loaded (see Neptune_Load).
+#
+
+PM_NONE = 0 # field nibbles given by the opcode
+PM_WP   = 1 # end nibble is P
+PM_P    = 2 # start and end nibbles are P
+
+# ALU handlers for families 0 and 1, kept by name and looked up in the
+# handlers of the engine when decoding
+ALU_OPS = [
+    [ 'Neptune_AddB',  'Neptune_AddB',   None,            None,
+      'Neptune_SubB',  'Neptune_SubB',   'Neptune_RSubB', 'Neptune_RSubB',
+      'Neptune_AddD',  'Neptune_AddD',   None,            None,
+      'Neptune_SubD',  'Neptune_SubD',   'Neptune_RSubD', 'Neptune_RSubD' ],
+    [ 'Neptune_CmpEq', 'Neptune_CmpNEq', 'Neptune_CmpGT', 'Neptune_CmpGTEQ',
+      'Neptune_CmpLT', 'Neptune_CmpLTEQ','Neptune_OR',    'Neptune_XOR',
+      'Neptune_AND',   'Neptune_MOV',    'Neptune_EX',    None,
+      'Neptune_SRD',   'Neptune_SLD',    None,            None ]
+]
+# resolves nibbles that depend on P
+def Neptune_ResolveField(cpu, nib_start, nib_end, pmode):
+    if pmode == PM_WP:
+        return nib_start, cpu.RP
+    elif pmode == PM_P:
+        return cpu.RP, cpu.RP
+    return nib_start, nib_end
+#
+# Executors, run the decoded word d on the CPU cpu, return True when the
+# simulation has to stop, the reason is left in cpu.HALT
+#
+# families 0 and 1
+# d: ex, word, handler, src, dst, nib_start, nib_end, field, pmode, const, setconst
+def Neptune_ExALU(cpu, d):
+    ex, word, handler, src, dst, nib_start, nib_end, field, pmode, const, setconst = d
+    if pmode != PM_NONE:
+        nib_start, nib_end = Neptune_ResolveField(cpu, nib_start, nib_end, pmode)
+    # used for CONstant source operands in some opcodes
+    setconst(cpu, nib_start, const)
+    handler(cpu, src, dst, nib_start, nib_end)
+    cpu.RPC += 4
+# family 2, P opcodes
+# d: ex, word, literal
+def Neptune_ExLOADP(cpu, d):
+    cpu.RP = d[2]
+    cpu.RPC += 4
+
+def Neptune_ExEQP(cpu, d):
+    cpu.RF[CMPF] = cpu.RP == d[2]
+    cpu.RPC += 4
+
+def Neptune_ExNEQP(cpu, d):
+    cpu.RF[CMPF] = cpu.RP != d[2]
+    cpu.RPC += 4
+
+def Neptune_ExINCP(cpu, d):
+    if cpu.RP == WORDSIZEM1:
+        cpu.RF[CARRYF] = True
+        cpu.RP = 0
+    else:
+        cpu.RP += 1
+        cpu.RF[CARRYF] = False
+    cpu.RPC += 4
+
+def Neptune_ExDECP(cpu, d):
+    if cpu.RP == 0:
+        cpu.RP = WORDSIZEM1
+        cpu.RF[CARRYF] = True
+    else:
+        cpu.RP -= 1
+        cpu.RF[CARRYF] = False
+    cpu.RPC += 4
+# family 3, load nibbles at P, doesn't modify P
+# d: ex, word, dst, nibs, count
+def Neptune_ExLDN(cpu, d):
+    ex, word, dst, nibs, count = d
+    setnibble = cpu.H['Neptune_SetNibble']
+    for j in range(count):
+        setnibble(cpu, dst, cpu.RP, nibs & 15)
+        nibs = nibs >> 4
+    cpu.RPC += 4
+# family 4, inherent opcodes
+def Neptune_ExRET(cpu, d):
+    if len(cpu.RSTACK) == 0:
+        cpu.HALT = 'Stack Underflow!'
+        return True
+    cpu.RPC = cpu.RSTACK.pop()
+
+def Neptune_ExSTOP(cpu, d):
+    cpu.HALT = 'STOP reached'
+    return True
+# families 5 and 7, jumps
+# d: ex, word, address
+def Neptune_ExJMP(cpu, d):
+    cpu.RPC = d[2]
+
+def Neptune_ExCALL(cpu, d):
+    cpu.RSTACK.append(cpu.RPC + 4)
+    cpu.RPC = d[2]
+
+def Neptune_ExCALL7(cpu, d):
+    cpu.RSTACK.append(cpu.RPC + 1)
+    cpu.RPC = d[2]
+
+def Neptune_ExJC(cpu, d):
+    if cpu.RF[CARRYF]:
+        cpu.RPC = d[2]
+    else:
+        cpu.RPC += 4
+
+def Neptune_ExJNC(cpu, d):
+    if cpu.RF[CARRYF]:
+        cpu.RPC += 4
+    else:
+        cpu.RPC = d[2]
+
+def Neptune_ExJT(cpu, d):
+    if cpu.RF[CMPF]:
+        cpu.RPC = d[2]
+    else:
+        cpu.RPC += 4
+
+def Neptune_ExJNT(cpu, d):
+    if cpu.RF[CMPF]:
+        cpu.RPC += 4
+    else:
+        cpu.RPC = d[2]
+# families 6 and 7, loads and stores
+# d: ex, word, handler, src or address, dst, nib_start, nib_end, field, pmode
+def Neptune_ExMEM(cpu, d):
+    ex, word, handler, src, dst, nib_start, nib_end, field, pmode = d
+    if pmode != PM_NONE:
+        nib_start, nib_end = Neptune_ResolveField(cpu, nib_start, nib_end, pmode)
+    handler(cpu, src, dst, nib_start, nib_end)
+    cpu.RPC += 4
+
+def Neptune_ExUnknown(cpu, d):
+    cpu.HALT = 'unknown opcode: {0:08x}'.format(d[1])
+    return True
+
+def Neptune_ExLDNInvalid(cpu, d):
+    cpu.HALT = 'LDN invalid number of nibbles {0:d}'.format((d[1] >> 24) & 15)
+    return True
+
+JUMPS5 = [ Neptune_ExJMP, Neptune_ExCALL, Neptune_ExJC, Neptune_ExJNC, Neptune_ExJT, Neptune_ExJNT ]
+P_OPS = [ Neptune_ExLOADP, Neptune_ExEQP, Neptune_ExNEQP, Neptune_ExINCP, Neptune_ExDECP ]
+
+# decodes a word, the handlers are taken from the engine handlers H
 # Opcodes are 32 bit i.e. word long
 # Loads of multiple nibbles are achieved via multiple opcodes
 #
-def Neptune_SingleStep(word):
-    global RPC, RP, RF, RSTACK, RSTACKPTR, DEBUG, CARRYF, CMPF, set_carry
-    
+def Neptune_Decode(word, H = LIST_ENGINE):
     dst         = (word >> 20) & 15
     src         = (word >> 16) & 15
-    dec_bin     = ((word >> 27) & 1) == 1 
+    dec_bin     = ((word >> 27) & 1) == 1
     nib_start   = (word >> 0) & 255
     nib_end     = (word >> 8) & 255
-    sign        = (word & 0x0200) == 0x0200
-    rel         = (word << 2) & 0x003FFFFF
     aabs        = (word << 2) & 0x003FFFFF
-    
     op          = (word >> 24) & 15
     family      = (word >> 28) & 15
-    jgroup      = (word >> 10) & 3
-    err_flag    = False
-    
-        
+
     field = '[{0:2d}..{1:2d}]'.format(nib_end, nib_start)
-    
+    pmode = PM_NONE
+
     if nib_start == WORDSIZEM1 and nib_end == WORDSIZEM1:
         field = 'S'
     elif  nib_start == 0 and nib_end == WORDSIZEM1:
         field = 'W'
     elif  nib_start == 0 and nib_end == 255:
         field = 'WP'
-        nib_end = RP
+        pmode = PM_WP
     elif  nib_start == 255 and nib_end == 255:
         field = 'P'
-        nib_start = RP
-        nib_end = RP
+        pmode = PM_P
     elif  nib_start == 0 and nib_end == 2:
         field = 'X'
     elif  nib_start == 2 and nib_end == 2:
@@ -580,254 +1014,1010 @@ def Neptune_SingleStep(word):
     elif  nib_start == 3 and nib_end == WORDSIZEM1:
         field = 'M'
 
-    deb_str_hdr = '{0:05x}  {1:08x}       '.format(RPC, word)
-    
-    # prepare constant 
     if (family == 0) or (family == 1):
-    # used for CONstant source operands in some opcodes
-        RR[14] = [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
-        RR[14][nib_start] = src
-    #print 'src:{0:d} dst: {1:d} left: {2:d} right: {3:d}'.format(src, dst, nib_end, nib_start)
-    #print RR
-    #print dumpReg(0)
-    #print dumpReg(1)
-    #print dumpReg(2)
-    #print dumpReg(3)
-        
-    if family == 0:
-        if (op & 1) == 1:
-            src = 14 # use constant
-        if (op == 0) or (op == 1): # 
-            deb_str = Neptune_AddB(src, dst, nib_start, nib_end, field)
-            RPC += 4
-        elif (op == 4) or (op == 5):
-            deb_str = Neptune_SubB(src, dst, nib_start, nib_end, field)
-            RPC += 4
-        elif (op == 6) or (op == 7):
-            deb_str = Neptune_RSubB(src, dst, nib_start, nib_end, field)
-            RPC += 4
-        #elif op == 3:
-        #    Neptune_NOTB(src, dst, nib_start, nib_end, field)
-        #    RPC += 4
-        elif (op == 8) or (op == 9): # 
-            deb_str = Neptune_AddD(src, dst, nib_start, nib_end, field)
-            RPC += 4
-        elif (op == 12) or (op == 13):
-            deb_str = Neptune_SubD(src, dst, nib_start, nib_end, field)
-            RPC += 4
-        elif (op == 14) or (op == 15):
-            deb_str = Neptune_RSubD(src, dst, nib_start, nib_end, field)
-            RPC += 4
-        #elif op == 11:
-        #    Neptune_NOTD(src, dst, nib_start, nib_end, field)
-        #    RPC += 4
-        else:
-            print 'unknown opcode: {0:08x}'.format(word)
-            err_flag = True
-        deb_str = deb_str.ljust(25, ' ') + dumpReg(dst)
-    elif family == 1:
-        if op == 0:
-            deb_str = Neptune_CmpEq(src, dst, nib_start, nib_end, field)
-            RPC += 4
-        elif op == 1:
-            deb_str = Neptune_CmpNEq(src, dst, nib_start, nib_end, field)
-            RPC += 4
-        elif op == 2:
-            deb_str = Neptune_CmpGT(src, dst, nib_start, nib_end, field)
-            RPC += 4
-        elif op == 3:
-            deb_str = Neptune_CmpGTEQ(src, dst, nib_start, nib_end, field)
-            RPC += 4
-        elif op == 4:
-            deb_str = Neptune_CmpLT(src, dst, nib_start, nib_end, field)
-            RPC += 4
-        elif op == 5:
-            deb_str = Neptune_CmpLTEQ(src, dst, nib_start, nib_end, field)
-            RPC += 4
-        elif op == 6:
-            deb_str = Neptune_OR(src, dst, nib_start, nib_end, field)
-            RPC += 4
-        elif op == 7:
-            deb_str = Neptune_XOR(src, dst, nib_start, nib_end, field)
-            RPC += 4
-        elif op == 8:
-            deb_str = Neptune_AND(src, dst, nib_start, nib_end, field)
-            RPC += 4
-        elif op == 9:
-            deb_str = Neptune_MOV(src, dst, nib_start, nib_end, field)
-            RPC += 4
-        elif op == 10:
-            deb_str = Neptune_EX(src, dst, nib_start, nib_end, field)
-            RPC += 4
-        #elif op == 11:
-        #    Neptune_CLR(src, dst, nib_start, nib_end, field)
-        #    RPC += 4
-        elif op == 12:
-            deb_str = Neptune_SRD(src, dst, nib_start, nib_end, field)
-            RPC += 4
-        elif op == 13:
-            deb_str = Neptune_SLD(src, dst, nib_start, nib_end, field)        
-            RPC += 4
-        #elif op == 14:
-        #        Neptune_CSR(src, dst, nib_start, nib_end, field)
-        #    RPC += 4
-        #elif op == 15:
-        #        Neptune_CSL(src, dst, nib_start, nib_end, field)
-        #    RPC += 4
-        else:
-            print 'unknown opcode: {0:08x}'.format(word)
-            err_flag = True
-        deb_str = deb_str.ljust(25, ' ') + dumpReg(dst)
+        name = ALU_OPS[family][op]
+        if name == None:
+            return (Neptune_ExUnknown, word)
+        isrc = src
+        if (family == 0) and ((op & 1) == 1):
+            isrc = 14 # use constant
+        return (Neptune_ExALU, word, H[name], isrc, dst, nib_start, nib_end, field, pmode, src, H['Neptune_SetConst'])
     elif family == 2: # P opcodes
-        if op == 0: #loadp #n
-            deb_str = 'LOADP    #{0:02x}'.format(word & WORDSIZEM1)
-            RP = word & WORDSIZEM1
-            RPC += 4
-        elif op == 1: # eqp
-            deb_str = 'EQP      #{0:02x}'.format(word & WORDSIZEM1)
-            RF[CMPF] = RP == (word & WORDSIZEM1)
-            RPC += 4
-        elif op == 2: # neqp
-            deb_str = 'NEQP     #{0:02x}'.format(word & WORDSIZEM1)
-            RF[CMPF] = RP != (word & WORDSIZEM1)
-            RPC += 4
-        elif op == 3: # incp
-            deb_str = 'INCP'
-            if RP == WORDSIZEM1:
-                RF[CARRYF] = True
-                RP = 0
-            else:
-                RP += 1
-                RF[CARRYF] = False
-            RPC += 4
-        elif op == 4: # decp
-            deb_str = 'DECP'
-            if RP == 0:
-                RP = WORDSIZEM1
-                RF[CARRYF] = True
-            else:
-                RP -= 1
-                RF[CARRYF] = False
-            RPC += 4
-        else:
-            print 'unknown opcode: {0:08x}'.format(word)
-            err_flag = True
-        deb_str =deb_str.ljust(25, ' ') + 'P: {0:x}'.format(RP)
+        if op < len(P_OPS):
+            return (P_OPS[op], word, word & WORDSIZEM1)
     elif family == 3: # load nibbles at P+n..P, dosn't modify P
-        nibs = word & 0x000FFFFF
-        if op == 1:
-            deb_str = 'LDN      {0:s},#{1:1x}'.format(RN[dst], nibs & 0xF)
-        elif op == 2:
-            deb_str = 'LDN      {0:s},#{1:02x}'.format(RN[dst], nibs & 0xFF)
-        elif op == 3:
-            deb_str = 'LDN      {0:s},#{1:03x}'.format(RN[dst], nibs & 0xFFF)
-        elif op == 4:
-            deb_str = 'LDN      {0:s},#{1:04x}'.format(RN[dst], nibs & 0xFFFF)
-        elif op == 5:
-            deb_str = 'LDN      {0:s},#{1:05x}'.format(RN[dst], nibs)
-        else:
-            deb_str = 'LDN invalid number of nibbles {0:d}', op
-            err_flag = True
-        for j in range(op): 
-            RR[dst][RP] = nibs & 15
-            nibs = nibs >> 4
-        deb_str = deb_str.ljust(25, ' ') + dumpReg(dst)
-        RPC += 4
+        if (op == 0) or (op > 5):
+            return (Neptune_ExLDNInvalid, word)
+        return (Neptune_ExLDN, word, dst, word & 0x000FFFFF, op)
     elif family == 4: # inherent opcodes
-        if op == 0: # RET
-            if len(RSTACK) == 0:
-                deb_str = 'Stack Underflow!'
-                err_flag = True
-            if DEBUG:
-                deb_str = 'RET'
-            RPC = RSTACK[len(RSTACK)-1]
-            del RSTACK[len(RSTACK)-1]
-        elif op == 1: # STOP
-            print 'STOP reached'
-            return True
-    elif family == 5: # jump opcodes
         if op == 0:
-            deb_str = 'JMP      {0:05x}'.format(aabs)
-            RPC = aabs
+            return (Neptune_ExRET, word)
         elif op == 1:
-            deb_str = 'CALL     {0:05x}'.format(aabs)
-            RSTACK.append(RPC + 4)
-            RPC = aabs
-        elif op == 2:
-            deb_str = 'JC       {0:05x}'.format(aabs)
-            if RF[CARRYF]:
-                RPC = aabs
-            else:
-               RPC += 4
-        elif op == 3:
-            deb_str = 'JNC      {0:05x}'.format(aabs)
-            if RF[CARRYF]:
-                RPC += 4
-            else:
-               RPC = aabs
-        elif op == 4:
-            deb_str = 'JT       {0:05x}'.format(aabs)
-            if RF[CMPF]:
-                RPC = aabs
-            else:
-               RPC += 4
-        elif op == 5:
-            deb_str = 'JNT      {0:05x}'.format(aabs)
-            if RF[CMPF]:
-                RPC += 4
-            else:
-               RPC = aabs
-        else:
-            print 'unknown opcode: {0:08x}'.format(word)
-            err_flag = True                       
-
+            return (Neptune_ExSTOP, word)
+    elif family == 5: # jump opcodes
+        if op < len(JUMPS5):
+            return (JUMPS5[op], word, aabs)
     elif family == 6:
         if dec_bin:
-            Neptune_STO(src, dst, nib_start, nib_end, FIELDS[size])
+            return (Neptune_ExMEM, word, H['Neptune_STO'], src, dst, nib_start, nib_end, field, pmode)
         else:
-            Neptune_LOAD(src, dst, nib_start, nib_end, FIELDS[size])
+            return (Neptune_ExMEM, word, H['Neptune_LOAD'], src, dst, nib_start, nib_end, field, pmode)
     elif family == 7:
         if src == 0:
-            deb_str = 'JMP  {0:05x}'.format(aabs)
-            RPC = aabs
+            return (Neptune_ExJMP, word, aabs)
         elif src == 1:
-            deb_str = 'CALL {0:05x}'.format(aabs)
-            RSTACK.append(RPC + 1)
-            RPC = aabs
+            return (Neptune_ExCALL7, word, aabs)
         elif src == 2:
-            Neptune_LOAD_ABS(aabs, dst, nib_start, nib_end, FIELDS[size])
+            return (Neptune_ExMEM, word, H['Neptune_LOAD_ABS'], aabs, dst, nib_start, nib_end, field, pmode)
+        else:
+            return (Neptune_ExMEM, word, H['Neptune_STO_ABS'], aabs, dst, nib_start, nib_end, field, pmode)
+    return (Neptune_ExUnknown, word)
+#
+# Tracing
+#
+# Executed opcodes are kept as tuples (pc, word, dst, snapshot, flags) in a
+# ring buffer, the text is only made when the trace is written.
+# TRACE_PC keeps pc and word, TRACE_FULL also keeps the register written by
+# the opcode (dst), its value afterwards (snapshot) and the flags (bit 0 carry,
+# bit 1 compare), for P opcodes dst is TR_P and the snapshot is P.
+#
+# A binary trace is a header followed by fixed size records
+#   pc, word     : 32 bit
+#   dst          : register, TRR_P for P or TRR_NONE
+#   flags        : TRF_* bits
+#   value        : 128 bit written register or P, low and high 64 bits
+# all little endian. When a binary trace file is open the ring buffer is
+# written out as records every time it is full (see Neptune_TraceStream).
+# The trace level, the ring buffer and the binary trace file belong to the
+# CPU (TRACE, TRACEBUF and TRACEFILE), every CPU has its own trace.
+#
+TRACE_OFF   = 0
+TRACE_PC    = 1
+TRACE_FULL  = 2
+TRACESIZE   = 65536 # default number of kept opcodes
+TR_P        = -1
+
+TRHEADER    = struct.Struct('<4sHH')       # magic, version, record size
+TRRECORD    = struct.Struct('<IIBBxxQQ')   # pc, word, dst, flags, value low, high
+TRMAGIC     = 'PNTR'
+TRVERSION   = 1
+TRR_P       = 0xfe
+TRR_NONE    = 0xff
+TRF_CARRY   = 1
+TRF_CMP     = 2
+TRF_NIB0    = 0x40 # nibble 0 of value is known (not in text traces)
+TRF_VALID   = 0x80 # carry and compare are known
+
+# where the executors keep the written register, TR_P for P opcodes
+TRACE_DST = {
+    Neptune_ExALU   : 4,
+    Neptune_ExLDN   : 2,
+    Neptune_ExLOADP : TR_P,
+    Neptune_ExEQP   : TR_P,
+    Neptune_ExNEQP  : TR_P,
+    Neptune_ExINCP  : TR_P,
+    Neptune_ExDECP  : TR_P
+}
+
+# selects the trace level and the number of kept opcodes of the CPU
+def Neptune_TraceLevel(cpu, level, size = TRACESIZE):
+    cpu.TRACE = level
+    cpu.TRACEBUF = deque([], size)
+# writes the trace of the CPU to the binary trace file f from now on
+def Neptune_TraceStream(cpu, f):
+    cpu.TRACEFILE = f
+    f.write(TRHEADER.pack(TRMAGIC, TRVERSION, TRRECORD.size))
+# returns the dump of a register snapshot
+def Neptune_DumpValue(ireg, v):
+    if isinstance(v, tuple): # list engine
+        s = ''
+        for j in range(WORDSIZEM1, 0, -1):
+            s = s + '{0:x}'.format(v[j])
+    else:
+        s = '{0:031x}'.format(v >> 4)
+    return '{0:s}: '.format(RN[ireg]) + s
+# returns a register snapshot as int
+def Neptune_SnapshotValue(v):
+    if isinstance(v, (tuple, list)): # list engine
+        x = 0
+        for j in range(WORDSIZEM1, -1, -1):
+            x = (x << 4) | (v[j] & 15)
+        return x
+    return v
+# returns the binary trace records of trace tuples
+def Neptune_TraceRecords(trace):
+    recs = []
+    pack = TRRECORD.pack
+    for pc, word, dst, snap, flags in trace:
+        if dst == None:
+            dst, x = TRR_NONE, 0
+        elif dst == TR_P:
+            dst, x = TRR_P, snap
+        else:
+            x = Neptune_SnapshotValue(snap)
+        if flags == None:
+            flags = 0
+        else:
+            flags = flags | TRF_VALID | TRF_NIB0
+        recs.append(pack(pc, word, dst, flags, x & 0xFFFFFFFFFFFFFFFF, x >> 64))
+    return ''.join(recs)
+# writes the kept opcodes to the binary trace file and empties the trace
+def Neptune_TraceFlush(cpu):
+    cpu.TRACEFILE.write(Neptune_TraceRecords(cpu.TRACEBUF))
+    cpu.TRACEBUF.clear()
+# writes the rest of the trace and stops writing the binary trace
+def Neptune_TraceClose(cpu):
+    Neptune_TraceFlush(cpu)
+    cpu.TRACEFILE = None
+# returns the text of trace tuples, oldest first, like cpu.TRACEBUF
+def Neptune_TraceLines(trace):
+    for pc, word, dst, snap, flags in trace:
+        mnemonic = Neptune_Disasm(word)
+        s = '{0:05x}  {1:08x}        '.format(pc, word)
+        if dst == None:
+            yield s + mnemonic
+        elif dst == TR_P:
+            yield s + mnemonic.ljust(25, ' ') + 'P: {0:x}'.format(snap)
+        else:
+            yield s + mnemonic.ljust(25, ' ') + Neptune_DumpValue(dst, snap)
+# writes the kept opcodes to the file f and empties the trace, to the binary
+# trace file when open
+def Neptune_TraceWrite(cpu, f):
+    if cpu.TRACEFILE != None:
+        Neptune_TraceFlush(cpu)
+        return
+    for line in Neptune_TraceLines(cpu.TRACEBUF):
+        f.write(line + '\n')
+    cpu.TRACEBUF.clear()
+# executes a decoded word, traced
+# Updates all registers as needed
+# returns True when the simulation has to stop
+def Neptune_Execute(cpu, d):
+    pc = cpu.RPC
+    if d[0](cpu, d):
+        return True
+    TRACEBUF = cpu.TRACEBUF
+    if cpu.TRACE == TRACE_PC:
+        TRACEBUF.append((pc, d[1], None, None, None))
+    elif cpu.TRACE == TRACE_FULL:
+        k = TRACE_DST.get(d[0])
+        flags = cpu.RF[CARRYF] | (cpu.RF[CMPF] << 1)
+        if k == None:
+            TRACEBUF.append((pc, d[1], None, None, flags))
+        elif k == TR_P:
+            TRACEBUF.append((pc, d[1], TR_P, cpu.RP, flags))
         else:
-            Neptune_STO_ABS(aabs, dst, nib_start, nib_end, FIELDS[size])
+            TRACEBUF.append((pc, d[1], d[k], cpu.H['Neptune_Snapshot'](cpu, d[k]), flags))
+    if (cpu.TRACEFILE != None) and (len(TRACEBUF) == TRACEBUF.maxlen):
+        Neptune_TraceFlush(cpu)
+    return False
+# executes a single step, the word is decoded every time
+def Neptune_SingleStep(cpu, word):
+    return Neptune_Execute(cpu, Neptune_Decode(word, cpu.H))
+# executes the word at PC, decoding it only on the first visit
+def Neptune_Step(cpu):
+    d = cpu.DCACHE.get(cpu.RPC)
+    if d == None:
+        d = Neptune_Decode(cpu.memory[cpu.RPC >> 2], cpu.H)
+        cpu.DCACHE[cpu.RPC] = d
+    if cpu.TRACE == TRACE_OFF:
+        return d[0](cpu, d)
+    return Neptune_Execute(cpu, d)
+ 
+ 
+#
+# Block translator
+#
+# Straight line code up to the next jump, call, return or stop is translated
+# into the source of one Python function, compiled once and kept in the BCACHE
+# of the CPU by its start PC. The registers, flags and P the block uses are
+# locals of the function, stored back once when it leaves. A block that jumps
+# back to its own start runs the loop inside the function.
+# The function returns which of its exits it took, or that it returned or
+# stopped (PC is then left on the stopping opcode like the interpreter does,
+# the reason in HALT), see Neptune_RunBlocks. Translated blocks are not traced.
+# The generated code works on the int engine registers, only CPUs of the int
+# engine run translated blocks.
+# Every exit remembers the block it leads to so the next block is found
+# without a lookup. Stores don't reach the code, blocks are only dropped when
+# other code is loaded (see Neptune_Load).
+#
+# BCACHE entries are [ function, instructions, start PC, end PC, next blocks,
+# exit PCs ]
+MAXBLOCK = 256      # maximum number of instructions per block
+WORDHEX  = '0x{0:x}'.format(WORDMASK) # mask of the whole word
+
+# nibble expressions are ints when known while translating or strings
+# evaluated when the block runs (P)
+def Neptune_TrOff(x, k):
+    if isinstance(x, int):
+        return x + k
+    return '({0} {1:+d})'.format(x, k)
+
+def Neptune_TrIsConst(*args):
+    for x in args:
+        if not isinstance(x, int):
+            return False
+    return True
+# mask of nibbles nib_start..nib_end, literals are used when known, else the
+# mask is looked up once into a local
+def Neptune_TrMask(lines, nib_start, nib_end, name = '_m'):
+    if Neptune_TrIsConst(nib_start, nib_end):
+        if nib_end < nib_start:
+            return '0'
+        return '0x{0:x}'.format(FMASK[nib_start][nib_end])
+    lines.append('{0} = FMASK[{1}][{2}]'.format(name, nib_start, nib_end))
+    return name
+
+def Neptune_TrNib(nib):
+    if isinstance(nib, int):
+        return '0x{0:x}'.format(NMASK[nib])
+    return 'NMASK[{0}]'.format(nib)
+
+def Neptune_TrShift(nib):
+    if isinstance(nib, int):
+        return '{0:d}'.format(4 * nib)
+    return '(4 * {0})'.format(nib)
+# condition a op b, True/False when known else the source of the test
+def Neptune_TrCond(a, op, b):
+    if Neptune_TrIsConst(a, b) or (a == b):
+        return { '>=': a >= b, '>': a > b, '<': a < b }[op]
+    return '{0} {1} {2}'.format(a, op, b)
+# appends body or orelse depending on cond
+def Neptune_TrIf(lines, cond, body, orelse = []):
+    if cond == True:
+        lines.extend(body)
+    elif cond == False:
+        lines.extend(orelse)
+    else:
+        lines.append('if {0}:'.format(cond))
+        lines.extend([ '    ' + l for l in body ] or [ '    pass' ])
+        if len(orelse) > 0:
+            lines.append('else:')
+            lines.extend([ '    ' + l for l in orelse ])
+
+def Neptune_TrCarry(lines, expr):
+    if set_carry:
+        lines.append('f{0:d} = {1:s}'.format(CARRYF, expr))
+# x & m, registers have no bits above the word
+def Neptune_TrAnd(x, m):
+    if m == WORDHEX:
+        return x
+    return '({0:s} & {1:s})'.format(x, m)
+# writes _r into the field m of dst
+def Neptune_TrWrite(lines, dst, m, r = '_r'):
+    if not WRITABLE[dst]:
+        return
+    if m == WORDHEX:
+        lines.append('r{0:d} = {1:s}'.format(dst, r))
+    else:
+        lines.append('r{0:d} = (r{0:d} & ~{1:s}) | {2:s}'.format(dst, m, r))
+
+def Neptune_TrAddB(src, dst, nib_start, nib_end):
+    body = []
+    m = Neptune_TrMask(body, nib_start, Neptune_TrOff(nib_end, -1))
+    body.append('_r = (r{0:d} & {2:s}) + (r{1:d} & {2:s})'.format(src, dst, m))
+    Neptune_TrCarry(body, '(_r >> {0:s}) != 0'.format(Neptune_TrShift(nib_end)))
+    Neptune_TrWrite(body, dst, m, '(_r & {0:s})'.format(m))
+    orelse = []
+    Neptune_TrCarry(orelse, 'False')
+    lines = []
+    Neptune_TrIf(lines, Neptune_TrCond(nib_end, '>', nib_start), body, orelse)
+    return lines
+
+def Neptune_TrSubB(a, b, dst, nib_start, nib_end):
+    lines = []
+    m = Neptune_TrMask(lines, nib_start, nib_end)
+    lines.append('_r = (r{0:d} & {2:s}) - (r{1:d} & {2:s})'.format(a, b, m))
+    Neptune_TrCarry(lines, '_r < 0')
+    Neptune_TrWrite(lines, dst, m, '(_r & {0:s})'.format(m))
+    return lines
+# decimal add/sub, inlined when the field is known or is one nibble, val is
+# the constant register nibble
+def Neptune_TrDec(a, b, dst, nib_start, nib_end, sub, val):
+    body = []
+    carry = '_c == 1'
+    if nib_start == nib_end: # one nibble like NeptuneInt_DecSerial, also when not BCD
+        sh = Neptune_TrShift(nib_start)
+        if not isinstance(nib_start, int):
+            body.append('_s = ' + sh)
+            sh = '_s'
+        x = []
+        for name, r in ( ( '_a', a ), ( '_b', b ) ):
+            if r == 14:
+                x.append(str(val & 15))
+            else:
+                body.append('{0:s} = (r{1:d} >> {2:s}) & 15'.format(name, r, sh))
+                x.append(name)
+        if sub:
+            body.append('_r = {0:s} - {1:s}'.format(*x))
+            body.append('_c = _r < 0')
+            body.append('if _c:')
+            body.append('    _r += 10')
+        else:
+            body.append('_r = {0:s} + {1:s}'.format(*x))
+            body.append('_c = _r >= 10')
+            body.append('if _c:')
+            body.append('    _r -= 10')
+        if WRITABLE[dst]: # flips the nibble from the old to the new value
+            body.append('r{0:d} ^= ({1:s} ^ (_r & 15)) << {2:s}'.format(dst, x[0] if dst == a else x[1], sh))
+        carry = '_c'
+    elif Neptune_TrIsConst(nib_start, nib_end):
+        m = FMASK[nib_start][nib_end]
+        x = []
+        for name, r in ( ( '_a', a ), ( '_b', b ) ): # whole registers are used as they are
+            e = Neptune_TrAnd('r{0:d}'.format(r), '0x{0:x}'.format(m))
+            if e != 'r{0:d}'.format(r):
+                body.append(name + ' = ' + e)
+                e = name
+            x.append(e)
+        # the add of the sixes carries out of a nibble above 9, then the
+        # field is not BCD
+        body.append('_t1 = {0:s} + 0x{1:x}'.format(x[0], SIXES & m))
+        body.append('if ((_t1 ^ {0:s}) | (({1:s} + 0x{2:x}) ^ {1:s})) & 0x{3:x}:'.format(x[0], x[1], SIXES & m, (ONES & m) << 4))
+        body.append('    _r, _c = NeptuneInt_DecSerial({0:s}, {1:s}, {2:d}, {3:d}, {4})'.format(x[0], x[1], nib_start, nib_end, sub))
+        body.append('else:')
+        if sub: # ten's complement
+            body.append('    _b = 0x{0:x} - {1:s}'.format(NINES & m, x[1]))
+            body.append('    _t2 = _t1 + _b + 0x{0:x}'.format(1 << (4 * nib_start)))
+            x[1] = '_b'
+        else:
+            body.append('    _t2 = _t1 + {0:s}'.format(x[1]))
+        # the nibbles that did not carry give back their six
+        body.append('    _t5 = ~(_t2 ^ _t1 ^ {0:s}) & 0x{1:x}'.format(x[1], (ONES & m) << 4))
+        body.append('    _r = (_t2 - (_t5 >> 4) * 6) & 0x{0:x}'.format(m))
+        if sub: # _t2 has no bits above the carry
+            body.append('    _c = 1 - (_t2 >> {0:d})'.format(4 * (nib_end + 1)))
+        else:
+            body.append('    _c = _t2 >> {0:d}'.format(4 * (nib_end + 1)))
+        Neptune_TrWrite(body, dst, '0x{0:x}'.format(m))
+    else:
+        m = Neptune_TrMask(body, nib_start, nib_end)
+        fn = 'NeptuneInt_DecAdd'
+        if sub:
+            fn = 'NeptuneInt_DecSub'
+        body.append('_r, _c = {0:s}(r{1:d} & {3:s}, r{2:d} & {3:s}, {4}, {5})'.format(fn, a, b, m, nib_start, nib_end))
+        Neptune_TrWrite(body, dst, m)
+    Neptune_TrCarry(body, carry)
+    orelse = []
+    Neptune_TrCarry(orelse, 'False')
+    lines = []
+    Neptune_TrIf(lines, Neptune_TrCond(nib_end, '>=', nib_start), body, orelse)
+    return lines
+# compare flag, eq: test the field for equality, gt: test the left most nibble
+def Neptune_TrCmp(src, dst, nib_start, nib_end, expr):
+    lines = []
+    m = Neptune_TrMask(lines, nib_start, nib_end)
+    eq = '((r{0:d} ^ r{1:d}) & {2:s}) == 0'.format(dst, src, m)
+    gt = '(r{0:d} & {2:s}) > (r{1:d} & {2:s})'.format(dst, src, Neptune_TrNib(nib_end))
+    body = [ 'f{0:d} = {1:s}'.format(CMPF, expr[0].format(eq = eq, gt = gt)) ]
+    orelse = [ 'f{0:d} = {1:s}'.format(CMPF, expr[1].format(eq = eq)) ]
+    Neptune_TrIf(lines, Neptune_TrCond(nib_end, '>=', nib_start), body, orelse)
+    return lines
+
+# dst = r, the nibbles of dst outside of m are kept
+def Neptune_TrKeep(lines, dst, m, r):
+    keep = WORDMASK & ~m
+    if keep:
+        r = '(r{0:d} & 0x{1:x}) | {2:s}'.format(dst, keep, r)
+    lines.append('r{0:d} = {1:s}'.format(dst, r))
+
+def Neptune_TrSRD(dst, nib_start, nib_end):
+    lines = []
+    if WRITABLE[dst] and Neptune_TrIsConst(nib_start, nib_end) and (nib_start < nib_end):
+        # one shift of the register, the mask leaves the nibble end empty
+        Neptune_TrKeep(lines, dst, FMASK[nib_start][nib_end], '((r{0:d} >> 4) & 0x{1:x})'.format(dst, FMASK[nib_start][nib_end - 1]))
+    elif WRITABLE[dst]:
+        body = []
+        m = Neptune_TrMask(body, nib_start, nib_end)
+        Neptune_TrWrite(body, dst, m, Neptune_TrAnd('({0:s} >> 4)'.format(Neptune_TrAnd('r{0:d}'.format(dst), m)), m))
+        orelse = [ 'r{0:d} &= ~{1:s}'.format(dst, Neptune_TrNib(nib_end)) ]
+        Neptune_TrIf(lines, Neptune_TrCond(nib_start, '<', nib_end), body, orelse)
+    return lines
+
+def Neptune_TrSLD(dst, nib_start, nib_end):
+    lines = []
+    if WRITABLE[dst] and Neptune_TrIsConst(nib_start, nib_end) and (nib_start < nib_end):
+        # one shift of the register, nibble start is cleared and start+1 kept
+        m = FMASK[nib_start + 1][min(nib_end, WORDSIZE - 2)] << 4
+        Neptune_TrKeep(lines, dst, m | NMASK[nib_start], '((r{0:d} << 4) & 0x{1:x})'.format(dst, m))
+    elif WRITABLE[dst]:
+        body = []
+        if isinstance(nib_end, int):
+            left = min(nib_end, WORDSIZE - 2)
+        else:
+            left = 'min({0}, {1:d})'.format(nib_end, WORDSIZE - 2)
+        m = Neptune_TrMask(body, Neptune_TrOff(nib_start, 1), left)
+        body.append('r{0:d} = (r{0:d} & ~({1:s} << 4)) | ((r{0:d} & {1:s}) << 4)'.format(dst, m))
+        Neptune_TrIf(lines, Neptune_TrCond(nib_start, '<', nib_end), body)
+        lines.append('r{0:d} &= ~{1:s}'.format(dst, Neptune_TrNib(nib_start)))
+    return lines
+
+# the registers (rN), flags (fN) and P (p) are locals of the block, loaded
+# when it starts unless the block sets them first, and stored back at
+# WRITEBACK, that is before every exit and before the MEM handlers
+WRITEBACK = '@'
+
+# leaves the block to pc, a jump to the start of the block (loop_pc) runs it
+# again in place while it stays within the steps it was given
+def Neptune_TrExit(lines, exits, pc, loop_pc, indent = ''):
+    if pc == loop_pc:
+        lines.append(indent + 'if _n <= _last:')
+        lines.append(indent + '    continue')
+    lines.append(indent + WRITEBACK)
+    lines.append(indent + 'return {0:d}, _n'.format(len(exits)))
+    exits.append(pc)
+# returns the lines loading the locals used by code, WRITEBACK in code is
+# replaced by the lines storing the locals written
+def Neptune_TrLocals(code):
+    read, written = set(), set()
+    for lines in code:
+        for l in lines:
+            for name in re.findall(r'\b([rf]\d+|p)\b', l):
+                if (name in read) or (name in written):
+                    continue
+                # set first: an assignment of the whole block not reading it
+                rhs = l[len(name) + 3:]
+                if (not l.startswith(name + ' = ')) or re.search(r'\b' + name + r'\b', rhs):
+                    read.add(name)
+            m = re.match(r'\s*([rf]\d+|p) *[-+&^|]?= ', l)
+            if m != None:
+                written.add(m.group(1))
+    load, store = [], []
+    for name in sorted(read | written, key = lambda x: (x[0], int(x[1:] or 0))):
+        if name == 'p':
+            if name in read:
+                load.append('    p = cpu.RP')
+            continue
+        reg = name[0].upper()
+        if not ('    {0:s} = cpu.R{0:s}'.format(reg) in load):
+            load.append('    {0:s} = cpu.R{0:s}'.format(reg))
+        if name in read:
+            load.append('    {0:s} = {1:s}[{2:s}]'.format(name, reg, name[1:]))
+        if name in written:
+            store.append('{0:s}[{1:s}] = {2:s}'.format(reg, name[1:], name))
+    if 'p' in written:
+        store.append('cpu.RP = p')
+    for j in range(len(code)):
+        lines = []
+        for l in code[j]:
+            if l.strip() == WRITEBACK:
+                lines.extend([ l[:-len(WRITEBACK)] + s for s in store ])
+            else:
+                lines.append(l)
+        code[j] = lines
+    return load
+# returns the lines of an ALU opcode
+def Neptune_TrALU(name, src, dst, nib_start, nib_end, val):
+    lines = []
+    if name == 'NeptuneInt_AddB':
+        return Neptune_TrAddB(src, dst, nib_start, nib_end)
+    elif name == 'NeptuneInt_AddD':
+        return Neptune_TrDec(src, dst, dst, nib_start, nib_end, False, val)
+    elif name == 'NeptuneInt_SubB':
+        return Neptune_TrSubB(dst, src, dst, nib_start, nib_end)
+    elif name == 'NeptuneInt_RSubB':
+        return Neptune_TrSubB(src, dst, dst, nib_start, nib_end)
+    elif name == 'NeptuneInt_SubD':
+        return Neptune_TrDec(dst, src, dst, nib_start, nib_end, True, val)
+    elif name == 'NeptuneInt_RSubD':
+        return Neptune_TrDec(src, dst, dst, nib_start, nib_end, True, val)
+    elif name == 'NeptuneInt_CmpEq':
+        return Neptune_TrCmp(src, dst, nib_start, nib_end, [ '{eq}', '{eq}' ])
+    elif name == 'NeptuneInt_CmpNEq':
+        return Neptune_TrCmp(src, dst, nib_start, nib_end, [ 'not ({eq})', 'not ({eq})' ])
+    elif name == 'NeptuneInt_CmpGT':
+        return Neptune_TrCmp(src, dst, nib_start, nib_end, [ '{gt}', 'True' ])
+    elif name == 'NeptuneInt_CmpGTEQ':
+        return Neptune_TrCmp(src, dst, nib_start, nib_end, [ '({eq}) or ({gt})', '{eq}' ])
+    elif name == 'NeptuneInt_CmpLT':
+        return [ 'f{0:d} = True'.format(CMPF) ]
+    elif name == 'NeptuneInt_CmpLTEQ':
+        return Neptune_TrCmp(src, dst, nib_start, nib_end, [ '(not ({eq})) or (not ({gt}))', 'True' ])
+    elif name == 'NeptuneInt_SRD':
+        return Neptune_TrSRD(dst, nib_start, nib_end)
+    elif name == 'NeptuneInt_SLD':
+        return Neptune_TrSLD(dst, nib_start, nib_end)
+    m = Neptune_TrMask(lines, nib_start, nib_end)
+    if name == 'NeptuneInt_AND' or name == 'NeptuneInt_OR': # OR does an AND like Neptune_OR
+        if WRITABLE[dst]:
+            lines.append('r{0:d} &= r{1:d} | ~{2:s}'.format(dst, src, m))
+    elif name == 'NeptuneInt_XOR':
+        if WRITABLE[dst]:
+            lines.append('r{0:d} ^= r{1:d} & {2:s}'.format(dst, src, m))
+    elif name == 'NeptuneInt_NOT':
+        Neptune_TrWrite(lines, dst, m, '(~r{0:d} & {1:s})'.format(src, m))
+    elif name == 'NeptuneInt_MOV':
+        Neptune_TrWrite(lines, dst, m, Neptune_TrAnd('r{0:d}'.format(src), m))
+    elif name == 'NeptuneInt_EX':
+        lines.append('_t = r{0:d}'.format(src))
+        Neptune_TrWrite(lines, src, m, Neptune_TrAnd('r{0:d}'.format(dst), m))
+        Neptune_TrWrite(lines, dst, m, Neptune_TrAnd('_t', m))
     else:
-        print 'unknown opcode: {0:08x}'.format(word)
-        err_flag = True
-    if DEBUG:
-         print deb_str_hdr, deb_str
-         
-    return err_flag
+        return None
+    return lines
+# translates the block starting at pc
+def Neptune_Translate(cpu, pc):
+    code = []         # lines of the function body
+    alus = []         # [ index in code, const register value ] of every ALU opcode
+    uses14 = []       # index in code of every opcode reading or writing register 14
+    exits = []        # PC of every exit of the block
+    known_p = None    # P when known while translating
+    start = pc
+    loop_pc = start   # blocks loop in place unless they start on a breakpoint
+    if start in cpu.BREAKS:
+        loop_pc = None
+    n = 0
+    done = False
+    memory = cpu.memory
+    while (not done) and (n < MAXBLOCK) and ((pc >> 2) < len(memory)):
+        if (n > 0) and (pc in cpu.BREAKS): # blocks end at breakpoints
+            break
+        word = int(memory[pc >> 2]) # fields of longs would not be folded
+        d = Neptune_Decode(word, cpu.H)
+        ex = d[0]
+        lines = []
+        P = 'p'
+        if known_p != None:
+            P = known_p
+        try:
+            if (ex == Neptune_ExALU) or (ex == Neptune_ExMEM):
+                src, dst, nib_start, nib_end, pmode = d[3], d[4], d[5], d[6], d[8]
+                if pmode == PM_WP:
+                    nib_end = P
+                elif pmode == PM_P:
+                    nib_start = P
+                    nib_end = P
+                if ex == Neptune_ExMEM: # the handler does the access
+                    lines.append(WRITEBACK) # the handler works on the registers of the CPU
+                    lines.append('{0:s}(cpu, {1}, {2}, {3}, {4})'.format(d[2].__name__, src, dst, nib_start, nib_end))
+                    lines.append('return {0:d}, _n'.format(len(exits)))
+                    exits.append(pc + 4)
+                    uses14.append(len(code))
+                    done = True
+                else:
+                    # constant register, written only when needed (see below)
+                    if isinstance(nib_start, int):
+                        const = '0x{0:x}'.format(d[9] << (4 * nib_start))
+                    else:
+                        const = '{0:d} << (4 * {1})'.format(d[9], nib_start)
+                    alus.append([ len(code), 'r14 = ' + const ])
+                    lines = Neptune_TrALU(d[2].__name__, src, dst, nib_start, nib_end, d[9])
+                    if lines == None:
+                        break
+                    if re.search(r'\br14\b', '\n'.join(lines)):
+                        uses14.append(len(code))
+            elif ex == Neptune_ExLOADP:
+                lines.append('p = {0:d}'.format(d[2]))
+                known_p = d[2]
+            elif (ex == Neptune_ExEQP) or (ex == Neptune_ExNEQP):
+                if isinstance(P, int):
+                    cond = (P == d[2]) == (ex == Neptune_ExEQP)
+                elif ex == Neptune_ExEQP:
+                    cond = 'p == {0:d}'.format(d[2])
+                else:
+                    cond = 'p != {0:d}'.format(d[2])
+                lines.append('f{0:d} = {1}'.format(CMPF, cond))
+            elif (ex == Neptune_ExINCP) or (ex == Neptune_ExDECP):
+                if ex == Neptune_ExINCP:
+                    wrap, step, new = WORDSIZEM1, '+= 1', 0
+                else:
+                    wrap, step, new = 0, '-= 1', WORDSIZEM1
+                if isinstance(P, int):
+                    if P == wrap:
+                        known_p = new
+                    else:
+                        known_p = P + 1 if ex == Neptune_ExINCP else P - 1
+                    lines.append('p = {0:d}'.format(known_p))
+                    Neptune_TrCarry(lines, '{0}'.format(P == wrap))
+                else:
+                    lines.append('if p == {0:d}:'.format(wrap))
+                    lines.append('    p = {0:d}'.format(new))
+                    lines.append('    f{0:d} = True'.format(CARRYF))
+                    lines.append('else:')
+                    lines.append('    p {0:s}'.format(step))
+                    lines.append('    f{0:d} = False'.format(CARRYF))
+            elif ex == Neptune_ExLDN: # like Neptune_ExLDN only the last nibble stays
+                dst, nibs, count = d[2], d[3], d[4]
+                val = (nibs >> (4 * (count - 1))) & 15
+                if isinstance(P, int):
+                    lines.append('r{0:d} = (r{0:d} & ~0x{1:x}) | 0x{2:x}'.format(dst, NMASK[P], val << (4 * P)))
+                else:
+                    lines.append('r{0:d} = (r{0:d} & ~NMASK[p]) | ({1:d} << (4 * p))'.format(dst, val))
+                if dst == 14:
+                    uses14.append(len(code))
+            elif ex == Neptune_ExRET:
+                lines.append(WRITEBACK)
+                lines.append('if len(cpu.RSTACK) == 0:')
+                lines.append('    cpu.HALT = \'Stack Underflow!\'')
+                lines.append('    cpu.RPC = 0x{0:x}'.format(pc))
+                lines.append('    return -2, _n')
+                lines.append('cpu.RPC = cpu.RSTACK.pop()')
+                lines.append('return -1, _n')
+                done = True
+            elif ex == Neptune_ExSTOP:
+                lines.append(WRITEBACK)
+                lines.append('cpu.HALT = \'STOP reached\'')
+                lines.append('cpu.RPC = 0x{0:x}'.format(pc))
+                lines.append('return -2, _n')
+                done = True
+            elif (ex == Neptune_ExJMP) or (ex == Neptune_ExCALL) or (ex == Neptune_ExCALL7):
+                if ex == Neptune_ExCALL:
+                    lines.append('cpu.RSTACK.append(0x{0:x})'.format(pc + 4))
+                elif ex == Neptune_ExCALL7:
+                    lines.append('cpu.RSTACK.append(0x{0:x})'.format(pc + 1))
+                Neptune_TrExit(lines, exits, d[2], loop_pc)
+                done = True
+            elif ex in (Neptune_ExJC, Neptune_ExJNC, Neptune_ExJT, Neptune_ExJNT):
+                flag = CARRYF
+                if (ex == Neptune_ExJT) or (ex == Neptune_ExJNT):
+                    flag = CMPF
+                taken, not_taken = d[2], pc + 4
+                if (ex == Neptune_ExJNC) or (ex == Neptune_ExJNT):
+                    taken, not_taken = not_taken, taken
+                lines.append('if f{0:d}:'.format(flag))
+                Neptune_TrExit(lines, exits, taken, loop_pc, '    ')
+                Neptune_TrExit(lines, exits, not_taken, loop_pc)
+                done = True
+            else:
+                break   # left to the interpreter
+        except IndexError:
+            break       # field out of range, left to the interpreter
+        code.append(lines)
+        pc += 4
+        n += 1
+    b = [ None, n, start, pc, [], exits ]
+    if n > 0:
+        # the constant register is only written by the ALU opcodes followed by
+        # a use of it before the next ALU opcode or the end of the block
+        uses14.append(len(code))
+        for i in range(len(alus)):
+            at, const = alus[i]
+            nxt = len(code) + 1
+            if i + 1 < len(alus):
+                nxt = alus[i + 1][0]
+            for u in uses14:
+                if (u >= at) and (u < nxt):
+                    code[at].insert(0, const)
+                    break
+        if not done:
+            code.append([])
+            Neptune_TrExit(code[-1], exits, pc, None)
+        b[4] = [ None ] * len(exits)
+        src = [ 'def block(cpu, steps):' ] + Neptune_TrLocals(code)
+        indent = '    '
+        if loop_pc in exits: # _n counts the executed instructions
+            src.append('    _last = steps - {0:d}'.format(n))
+            src.extend([ '    _n = 0', '    while True:', '        _n += {0:d}'.format(n) ])
+            indent = '        '
+        else:
+            src.append('    _n = {0:d}'.format(n))
+        for j in range(len(code)):
+            if j < n:
+                src.append(indent + '# {0:05x}  {1:08x}'.format(start + 4 * j, memory[(start >> 2) + j]))
+            src.extend([ indent + l for l in code[j] ])
+        scope = dict()
+        exec compile('\n'.join(src) + '\n', '<block {0:05x}>'.format(start), 'exec') in globals(), scope
+        b[0] = scope['block']
+    cpu.BCACHE[start] = b
+    return b
+# runs translated blocks until STOP, a breakpoint or max_steps instructions,
+# blocks that would go over max_steps and words that can't be translated are
+# stepped by the interpreter. Breakpoints are checked only between blocks.
+# A block gets the instructions it may execute and returns its exit and the
+# instructions executed, the exit is an index in its exit PCs, -1 after a
+# return and -2 when it stopped (PC set by the block). Every exit keeps the
+# block it leads to once it was taken, the next block is found without a
+# lookup.
+# returns the number of executed instructions
+def Neptune_RunBlocks(cpu, max_steps):
+    count = 0
+    BREAKS, BCACHE = cpu.BREAKS, cpu.BCACHE
+    b = None            # block at PC, looked up when None
+    while count < max_steps:
+        if b == None:
+            pc = cpu.RPC
+            if pc in BREAKS:
+                Neptune_Break(cpu)
+                return count
+            b = BCACHE.get(pc)
+            if b == None:
+                b = Neptune_Translate(cpu, pc)
+        if (b[0] == None) or (count + b[1] > max_steps):
+            cpu.RPC = b[2]
+            b = None
+            count += 1
+            if Neptune_Step(cpu):
+                break
+            continue
+        k, i = b[0](cpu, max_steps - count)
+        count += i
+        if k < 0:
+            if k == -2: # stopped, PC is left on the stopping opcode
+                return count
+            b = None    # returned, PC is set
+            continue
+        nxt = b[4][k]
+        if nxt == None: # first time through this exit
+            pc = b[5][k]
+            if pc in BREAKS:
+                cpu.RPC = pc
+                b = None
+                continue
+            nxt = BCACHE.get(pc)
+            if nxt == None:
+                nxt = Neptune_Translate(cpu, pc)
+            b[4][k] = nxt
+        b = nxt
+    if b != None:
+        cpu.RPC = b[2]
+    return count
  
  
-print 'PNeptune Simulator v1.00'
+#
+# Run loop
+#
+# Breakpoints cost nothing per instruction: the interpreter finds them in
+# DCACHE as Neptune_ExBreak words, translated blocks end at them and they are
+# looked up only between blocks. They are kept in the BREAKS of the CPU
+# (PC: reason printed when reached) while it runs.
+#
+MAXSTEPS = 1 << 62  # no step limit
 
-bin = open(argv[1])
+# stops at a breakpoint, PC is left on the breakpoint
+def Neptune_ExBreak(cpu, d):
+    cpu.HALT = d[2]
+    return True
 
-memory = []
+def Neptune_Break(cpu):
+    cpu.HALT = cpu.BREAKS[cpu.RPC]
+# runs the code at PC until STOP, max_steps instructions, until_pc or one of
+# the breakpoints is reached, the opcode at until_pc or at a breakpoint is not
+# executed, runs translated blocks when blocks is True (int engine only).
+# A run started on a breakpoint executes it first.
+# returns the number of executed instructions and the elapsed time in seconds
+def Neptune_Run(cpu, max_steps = None, until_pc = None, breakpoints = [], blocks = False):
+    if blocks and (cpu.engine != 'int'):
+        raise ValueError('translated blocks need a CPU of the int engine, not {0:s}'.format(cpu.engine))
+    if max_steps == None:
+        max_steps = MAXSTEPS
+    BREAKS = dict()
+    for pc in breakpoints:
+        BREAKS[pc] = 'breakpoint at {0:05x}'.format(pc)
+    if until_pc != None:
+        BREAKS[until_pc] = 'PC {0:05x} reached'.format(until_pc)
+    if len(BREAKS) > 0: # blocks have to end at the breakpoints
+        cpu.BCACHE.clear()
+    cpu.BREAKS = BREAKS
+    cpu.HALT = None
+    memory, DCACHE = cpu.memory, cpu.DCACHE
+    count = 0
+    start = time.time()
+    try:
+        if (cpu.RPC in BREAKS) and (max_steps > 0):
+            count = 1
+            if Neptune_SingleStep(cpu, memory[cpu.RPC >> 2]):
+                return count, time.time() - start
+        for pc in BREAKS:
+            DCACHE[pc] = (Neptune_ExBreak, memory[pc >> 2], BREAKS[pc])
+        if blocks:
+            count += Neptune_RunBlocks(cpu, max_steps - count)
+        else:
+            step = Neptune_Step
+            while count < max_steps:
+                if step(cpu):
+                    if not cpu.RPC in BREAKS:
+                        count += 1 # the stopping opcode was executed
+                    break
+                count += 1
+    finally:
+        for pc in BREAKS:
+            DCACHE.pop(pc, None)
+        cpu.BREAKS = dict()
+    return count, time.time() - start
+# prints the instruction rate of a run
+def Neptune_Report(count, elapsed, f = stderr):
+    mips = 0.0
+    if elapsed > 0:
+        mips = count / elapsed / 1e6
+    f.write('{0:d} instructions in {1:.3f} s, {2:.3f} MIPS\n'.format(count, elapsed, mips))
+#
+# CPU instances
+#
+# A NeptuneCPU owns the whole state of one core: registers, flags, stack,
+# memories, the decoded words and blocks of its code, its register file
+# engine and its trace. Every handler and executor gets the CPU it works on,
+# so any number of CPUs can run side by side, in one thread or in several.
+# Cores of a Parallel Neptune share memory and MEM by passing them to every
+# core.
+# engine: 'list' or 'int', default the one of Neptune_SelectEngine
+# trace : trace level, see Neptune_TraceLevel
+#
+class NeptuneCPU(object):
+    __slots__ = ( 'RR', 'RA', 'RPC', 'RSTACK', 'RSTACKPTR', 'RP', 'RF', 'MEM', 'memory', 'HALT',
+                  'DCACHE', 'BCACHE', 'BREAKS', 'engine', 'H', 'TRACE', 'TRACEBUF', 'TRACEFILE' )
 
-for line in bin:
-    line = line.lstrip().rstrip(' \r\n')
-    memory.append(int(line, 16))
-    
-print '{0:5d} words read'.format(len(memory))
-
-Neptune_Reset()
-
-DEBUG = True
-flag = False
-count = 0
-while not flag:
-    word = memory[RPC >> 2]
-    flag = Neptune_SingleStep(word)
-    count += 1
-    if flag or count == 1200:
-        break
-        
+    def __init__(self, memory = None, MEM = None, engine = None, trace = TRACE_OFF):
+        if engine == None:
+            engine = ENGINE
+        if memory == None:
+            memory = []
+        if MEM == None:
+            MEM = bytearray(MEMSIZE)
+        self.RR = []
+        self.RA = []
+        self.RPC = 0
+        self.RSTACK = []
+        self.RSTACKPTR = 0
+        self.RP = 0
+        self.RF = []
+        self.MEM = MEM
+        self.memory = memory
+        self.HALT = None
+        self.DCACHE = dict()
+        self.BCACHE = dict()
+        self.BREAKS = dict()
+        self.engine = engine
+        self.H = ENGINES[engine]
+        self.TRACE = trace
+        self.TRACEBUF = deque([], TRACESIZE)
+        self.TRACEFILE = None
+        self.reset()
+
+    def reset(self):
+        Neptune_Reset(self)
+    # executes one opcode, returns True when the CPU stopped
+    def step(self):
+        return Neptune_Step(self)
+    # see Neptune_Run
+    def run(self, max_steps = None, until_pc = None, breakpoints = [], blocks = False):
+        return Neptune_Run(self, max_steps, until_pc, breakpoints, blocks)
+
+    def dumpReg(self, isrc):
+        return self.H['dumpReg'](self, isrc)
+
+    def setReg(self, ireg, value):
+        Neptune_SetReg(self, ireg, value)
+# reads a code file, one hex word per line or a binary image of big endian
+# words, little endian when the name ends with .le, returns an array of words
+def Neptune_ReadCode(name):
+    code = array('I')
+    if name.endswith('.le') or name.endswith('.be'):
+        # raw images written by the assembler go straight into the array
+        f = open(name, 'rb')
+        f.seek(0, 2)
+        n = f.tell() // code.itemsize
+        f.seek(0)
+        code.fromfile(f, n)
+        f.close()
+        if byteorder != ('little' if name.endswith('.le') else 'big'):
+            code.byteswap()
+        return code
+    data = open(name, 'rb').read()
+    if data.translate(None, string.hexdigits + string.whitespace) == '':
+        for line in data.split():
+            code.append(int(line, 16))
+    else:
+        code.fromstring(data[:len(data) & ~3])
+        if byteorder == 'little':
+            code.byteswap()
+    return code
+# creates MEM with size bytes, the binary image is loaded at address 0
+def Neptune_MemInit(cpu, size = MEMSIZE, image = None):
+    MEM = bytearray(size)
+    if image != None:
+        data = open(image, 'rb').read()
+        MEM[0:len(data)] = data
+        del MEM[size:]
+    cpu.MEM = MEM
+# maps the file name as MEM, the file is made size bytes long when shorter,
+# stores go to the file
+def Neptune_MemMap(cpu, name, size = MEMSIZE):
+    f = open(name, 'a+b')
+    f.seek(0, 2)
+    if f.tell() < size:
+        f.truncate(size)
+    cpu.MEM = mmap.mmap(f.fileno(), size)
+    f.close()
+# loads a code file
+def Neptune_Load(cpu, name):
+    cpu.memory = Neptune_ReadCode(name)
+    cpu.DCACHE.clear()
+    cpu.BCACHE.clear()
+    return len(cpu.memory)
+# writes all nibbles of a register
+def Neptune_SetReg(cpu, ireg, value):
+    setnibble = cpu.H['Neptune_SetNibble']
+    for j in range(WORDSIZE):
+        setnibble(cpu, ireg, j, (value >> (4 * j)) & 15)
+# command line
+# pneptune_sim.py [-e list|int] [-t] [-trace off|pc|full] [-b trace.bin]
+#                 [-n steps] [-u pc] [-bp pc] [-m size] [-d data.img | -map data.img]
+#                 <code.bin>
+def Neptune_Main(args):
+    print 'PNeptune Simulator v1.00'
+
+    translate = False
+    trace = None
+    bintrace = None
+    max_steps = None
+    until_pc = None
+    breakpoints = []
+    memsize = MEMSIZE
+    data = None
+    datamap = None
+    while len(args) > 1 and args[0][0] == '-':
+        if args[0] == '-e' and len(args) > 2:
+            if not Neptune_SelectEngine(args[1]):
+                print 'Unknown engine {0:s}'.format(args[1])
+                return 1
+            args = args[2:]
+        elif args[0] == '-t':
+            translate = True # translated blocks need the int engine
+            Neptune_SelectEngine('int')
+            args = args[1:]
+        elif args[0] == '-trace' and len(args) > 2:
+            levels = { 'off': TRACE_OFF, 'pc': TRACE_PC, 'full': TRACE_FULL }
+            if not args[1] in levels:
+                print 'Unknown trace level {0:s}'.format(args[1])
+                return 1
+            trace = levels[args[1]]
+            args = args[2:]
+        elif args[0] == '-b' and len(args) > 2:
+            bintrace = open(args[1], 'wb')
+            args = args[2:]
+        elif args[0] == '-n' and len(args) > 2:
+            max_steps = int(args[1])
+            args = args[2:]
+        elif args[0] == '-u' and len(args) > 2:
+            until_pc = int(args[1], 16)
+            args = args[2:]
+        elif args[0] == '-bp' and len(args) > 2:
+            breakpoints.append(int(args[1], 16))
+            args = args[2:]
+        elif args[0] == '-m' and len(args) > 2:
+            memsize = int(args[1], 0)
+            args = args[2:]
+        elif args[0] == '-d' and len(args) > 2:
+            data = args[1]
+            args = args[2:]
+        elif args[0] == '-map' and len(args) > 2:
+            datamap = args[1]
+            args = args[2:]
+        else:
+            print 'Unknown option {0:s}'.format(args[0])
+            return 1
+
+    if trace == None: # full trace when interpreting, translated blocks aren't traced
+        trace = TRACE_FULL
+        if translate:
+            trace = TRACE_OFF
+
+    code = Neptune_ReadCode(args[0])
+    print '{0:5d} words read'.format(len(code))
+    cpu = NeptuneCPU(code, trace = trace)
+    if bintrace != None:
+        Neptune_TraceStream(cpu, bintrace)
+    if datamap != None:
+        Neptune_MemMap(cpu, datamap, memsize)
+    else:
+        Neptune_MemInit(cpu, memsize, data)
+
+    try:
+        count, elapsed = Neptune_Run(cpu, max_steps, until_pc, breakpoints, translate)
+    finally:
+        # the trace is written at exit, also when the simulation failed
+        Neptune_TraceWrite(cpu, stdout)
+        if bintrace != None:
+            bintrace.close()
+    if cpu.HALT != None:
+        print cpu.HALT
+    if translate:
+        for i in range(MAXALUREGS):
+            print cpu.dumpReg(i)
+    Neptune_Report(count, elapsed)
+    return 0
+
+
+if __name__ == '__main__':
+    exit(Neptune_Main(argv[1:]))
@@ -0,0 +1,384 @@
+#!/usr/bin/python
+'''
+PNeptune lockstep simulator
+
+Runs one program over many input vectors at once, every lane has its own
+register file, P, flags, PC and stack. The register files are a NumPy array
+of shape (lanes, 16, 32) one nibble per byte, every opcode is executed for all
+lanes at the same PC with vectorized nibble operations. Lanes at other PCs
+(after JC/JNC/JT/JNT went different ways) wait, the lowest PC of the running
+lanes is executed next so the lanes come together again after the branch.
+
+Results are the same as running pneptune_sim.py with the int engine once per
+lane. LOAD/STO are not executed in lockstep, a lane reaching them stops.
+
+pneptune_simd.py [-n steps] [-c] <code.bin> <inputs>
+
+inputs has one lane per line with the initial registers in hex, like the
+manifest of pneptune_batch.py without the code file:
+
+    A=0000000000000000000000000000002 B=5
+    A=7
+
+For every lane a line with the number of executed instructions, carry,
+compare, why it stopped and the 16 registers is written. With -c every lane
+is also run on the scalar simulator and the differences are written.
+
+'''
+from sys import *
+import numpy as np
+import pneptune_sim
+from pneptune_sim import RN, WORDSIZE, WORDSIZEM1, MAXALUREGS, CARRYF, CMPF, WRITABLE, PM_NONE, PM_WP, PM_P
+
+STACKSIZE = 256 # HW stack levels
+
+class NeptuneSIMD(object):
+    __slots__ = ( 'R', 'P', 'PC', 'F', 'STACK', 'SP', 'STEPS', 'ACTIVE', 'HALT', 'memory', 'decoded' )
+
+    def __init__(self, memory, lanes):
+        self.R = np.zeros((lanes, MAXALUREGS, WORDSIZE), np.uint8)
+        self.R[:, 9, :] = 9
+        self.R[:, 15, :] = 15
+        self.P = np.zeros(lanes, np.int32)
+        self.PC = np.zeros(lanes, np.int64)
+        self.F = np.zeros((lanes, 2), np.bool_)
+        self.STACK = np.zeros((lanes, STACKSIZE), np.int64)
+        self.SP = np.zeros(lanes, np.int32)
+        self.STEPS = np.zeros(lanes, np.int64)
+        self.ACTIVE = np.ones(lanes, np.bool_)
+        self.HALT = [ None ] * lanes
+        self.memory = memory
+        self.decoded = dict()
+    # writes all nibbles of a register of one lane
+    def setReg(self, lane, ireg, value):
+        for j in range(WORDSIZE):
+            self.R[lane, ireg, j] = (value >> (4 * j)) & 15
+    # returns a register of one lane as int
+    def getReg(self, lane, ireg):
+        x = 0
+        for v in reversed(self.R[lane, ireg].tolist()):
+            x = (x << 4) | v
+        return x
+
+    def dumpReg(self, lane, ireg):
+        return '{0:s}: {1:031x}'.format(RN[ireg], self.getReg(lane, ireg) >> 4)
+    # stops the lanes m
+    def halt(self, m, reason):
+        self.ACTIVE[m] = False
+        for lane in m.tolist():
+            self.HALT[lane] = reason
+    # runs all lanes until they stopped or executed max_steps instructions
+    # returns the number of executed opcodes (for all lanes together)
+    def run(self, max_steps = None):
+        count = 0
+        while self.ACTIVE.any():
+            pc = int(self.PC[self.ACTIVE].min())
+            m = np.nonzero(self.ACTIVE & (self.PC == pc))[0]
+            d = self.decoded.get(pc)
+            if d == None:
+                if (pc >> 2) >= len(self.memory):
+                    self.halt(m, 'PC {0:05x} out of code'.format(pc))
+                    continue
+                d = pneptune_sim.Neptune_Decode(self.memory[pc >> 2])
+                self.decoded[pc] = d
+            Neptune_VExecute(self, m, d)
+            self.STEPS[m] += 1
+            count += 1
+            if max_steps != None:
+                self.ACTIVE &= self.STEPS < max_steps
+        return count
+#
+# Vectorized handlers
+#
+# s: lanes, m: index array of the lanes executing the opcode, the field is
+# the same for all of them. Carries are propagated nibble by nibble for all
+# lanes at once, like the list engine handlers.
+#
+def Neptune_VAddB(s, m, isrc, idst, nib_start, nib_end):
+    R = s.R
+    c = np.zeros(len(m), np.int16)
+    for i in range(nib_start, nib_end): # the last nibble is excluded like in Neptune_AddB
+        r = R[m, isrc, i].astype(np.int16) + R[m, idst, i] + c
+        c = (r >= 16).astype(np.int16)
+        if WRITABLE[idst]:
+            R[m, idst, i] = r & 15
+    s.F[m, CARRYF] = c == 1
+# decimal and binary add/sub, sub: a - b else a + b, base 10 or 16
+def Neptune_VAddSub(s, m, a, b, idst, nib_start, nib_end, sub, base):
+    R = s.R
+    c = np.zeros(len(m), np.int16)
+    for i in range(nib_start, nib_end + 1):
+        if sub:
+            r = base + R[m, a, i].astype(np.int16) - R[m, b, i] - c
+            c = (r < base).astype(np.int16)
+            r = np.where(c == 1, r, r - base)
+        else:
+            r = R[m, a, i].astype(np.int16) + R[m, b, i] + c
+            c = (r >= base).astype(np.int16)
+            r = np.where(c == 1, r - base, r)
+        if WRITABLE[idst]:
+            R[m, idst, i] = r & 15
+    s.F[m, CARRYF] = c == 1
+
+def Neptune_VAddD(s, m, isrc, idst, nib_start, nib_end):
+    Neptune_VAddSub(s, m, isrc, idst, idst, nib_start, nib_end, False, 10)
+
+def Neptune_VSubB(s, m, isrc, idst, nib_start, nib_end):
+    Neptune_VAddSub(s, m, idst, isrc, idst, nib_start, nib_end, True, 16)
+
+def Neptune_VRSubB(s, m, isrc, idst, nib_start, nib_end):
+    Neptune_VAddSub(s, m, isrc, idst, idst, nib_start, nib_end, True, 16)
+
+def Neptune_VSubD(s, m, isrc, idst, nib_start, nib_end):
+    Neptune_VAddSub(s, m, idst, isrc, idst, nib_start, nib_end, True, 10)
+
+def Neptune_VRSubD(s, m, isrc, idst, nib_start, nib_end):
+    Neptune_VAddSub(s, m, isrc, idst, idst, nib_start, nib_end, True, 10)
+# compares, returns eq of the field and gt of the left most nibble
+def Neptune_VCmp(s, m, isrc, idst, nib_start, nib_end):
+    R = s.R
+    eq = np.ones(len(m), np.bool_)
+    gt = None
+    if nib_end >= nib_start:
+        eq = (R[m, idst, nib_start:nib_end + 1] == R[m, isrc, nib_start:nib_end + 1]).all(axis = 1)
+        gt = R[m, idst, nib_end] > R[m, isrc, nib_end]
+    return eq, gt
+
+def Neptune_VCmpEq(s, m, isrc, idst, nib_start, nib_end):
+    s.F[m, CMPF] = Neptune_VCmp(s, m, isrc, idst, nib_start, nib_end)[0]
+
+def Neptune_VCmpNEq(s, m, isrc, idst, nib_start, nib_end):
+    s.F[m, CMPF] = ~Neptune_VCmp(s, m, isrc, idst, nib_start, nib_end)[0]
+# like Neptune_CmpGT only the left most nibble decides
+def Neptune_VCmpGT(s, m, isrc, idst, nib_start, nib_end):
+    eq, gt = Neptune_VCmp(s, m, isrc, idst, nib_start, nib_end)
+    if gt is None:
+        gt = True
+    s.F[m, CMPF] = gt
+
+def Neptune_VCmpGTEQ(s, m, isrc, idst, nib_start, nib_end):
+    eq, gt = Neptune_VCmp(s, m, isrc, idst, nib_start, nib_end)
+    if gt is None:
+        s.F[m, CMPF] = eq
+    else:
+        s.F[m, CMPF] = eq | gt
+# like Neptune_CmpLT the flag is always set
+def Neptune_VCmpLT(s, m, isrc, idst, nib_start, nib_end):
+    s.F[m, CMPF] = True
+
+def Neptune_VCmpLTEQ(s, m, isrc, idst, nib_start, nib_end):
+    eq, gt = Neptune_VCmp(s, m, isrc, idst, nib_start, nib_end)
+    if gt is None:
+        s.F[m, CMPF] = True
+    else:
+        s.F[m, CMPF] = ~eq | ~gt
+# OR does an AND like Neptune_OR
+def Neptune_VAND(s, m, isrc, idst, nib_start, nib_end):
+    if WRITABLE[idst] and nib_end >= nib_start:
+        s.R[m, idst, nib_start:nib_end + 1] &= s.R[m, isrc, nib_start:nib_end + 1]
+
+def Neptune_VXOR(s, m, isrc, idst, nib_start, nib_end):
+    if WRITABLE[idst] and nib_end >= nib_start:
+        s.R[m, idst, nib_start:nib_end + 1] ^= s.R[m, isrc, nib_start:nib_end + 1]
+
+def Neptune_VNOT(s, m, isrc, idst, nib_start, nib_end):
+    if WRITABLE[idst] and nib_end >= nib_start:
+        s.R[m, idst, nib_start:nib_end + 1] = 15 - s.R[m, isrc, nib_start:nib_end + 1]
+
+def Neptune_VMOV(s, m, isrc, idst, nib_start, nib_end):
+    if WRITABLE[idst] and nib_end >= nib_start:
+        s.R[m, idst, nib_start:nib_end + 1] = s.R[m, isrc, nib_start:nib_end + 1]
+
+def Neptune_VEX(s, m, isrc, idst, nib_start, nib_end):
+    if nib_end >= nib_start:
+        t = s.R[m, isrc, nib_start:nib_end + 1]
+        if WRITABLE[isrc]:
+            s.R[m, isrc, nib_start:nib_end + 1] = s.R[m, idst, nib_start:nib_end + 1]
+        if WRITABLE[idst]:
+            s.R[m, idst, nib_start:nib_end + 1] = t
+
+def Neptune_VSRD(s, m, isrc, idst, nib_start, nib_end):
+    if WRITABLE[idst]:
+        if nib_start < nib_end:
+            s.R[m, idst, nib_start:nib_end] = s.R[m, idst, nib_start + 1:nib_end + 1]
+        s.R[m, idst, nib_end] = 0
+# like Neptune_SLD nibble nib_start + 1 keeps its value
+def Neptune_VSLD(s, m, isrc, idst, nib_start, nib_end):
+    if WRITABLE[idst]:
+        if nib_start < nib_end:
+            left = min(nib_end, WORDSIZE - 2)
+            if left > nib_start:
+                s.R[m, idst, nib_start + 2:left + 2] = s.R[m, idst, nib_start + 1:left + 1]
+        s.R[m, idst, nib_start] = 0
+
+VALU = {
+    'AddB'    : Neptune_VAddB,
+    'AddD'    : Neptune_VAddD,
+    'SubB'    : Neptune_VSubB,
+    'SubD'    : Neptune_VSubD,
+    'RSubB'   : Neptune_VRSubB,
+    'RSubD'   : Neptune_VRSubD,
+    'CmpEq'   : Neptune_VCmpEq,
+    'CmpNEq'  : Neptune_VCmpNEq,
+    'CmpGT'   : Neptune_VCmpGT,
+    'CmpGTEQ' : Neptune_VCmpGTEQ,
+    'CmpLT'   : Neptune_VCmpLT,
+    'CmpLTEQ' : Neptune_VCmpLTEQ,
+    'AND'     : Neptune_VAND,
+    'OR'      : Neptune_VAND,
+    'XOR'     : Neptune_VXOR,
+    'NOT'     : Neptune_VNOT,
+    'MOV'     : Neptune_VMOV,
+    'EX'      : Neptune_VEX,
+    'SRD'     : Neptune_VSRD,
+    'SLD'     : Neptune_VSLD
+}
+# executes the decoded word d for the lanes m, all at the same PC
+def Neptune_VExecute(s, m, d):
+    ex = d[0]
+    pc = int(s.PC[m[0]])
+    if ex == pneptune_sim.Neptune_ExALU:
+        handler = VALU[d[2].__name__.split('_', 1)[1]]
+        src, dst, nib_start, nib_end, pmode, const = d[3], d[4], d[5], d[6], d[8], d[9]
+        if pmode == PM_NONE:
+            groups = [ (m, nib_start, nib_end) ]
+        else: # the field depends on P, the lanes are run by their P
+            groups = []
+            for p in np.unique(s.P[m]).tolist():
+                if pmode == PM_WP:
+                    groups.append((m[s.P[m] == p], nib_start, p))
+                else:
+                    groups.append((m[s.P[m] == p], p, p))
+        for g, ns, ne in groups:
+            if ns > WORDSIZEM1 or ne > WORDSIZEM1:
+                s.halt(g, 'field out of range: {0:08x}'.format(d[1]))
+                continue
+            # used for CONstant source operands in some opcodes
+            s.R[g, 14, :] = 0
+            s.R[g, 14, ns] = const
+            handler(s, g, src, dst, ns, ne)
+        s.PC[m] = pc + 4
+    elif ex == pneptune_sim.Neptune_ExLOADP:
+        s.P[m] = d[2]
+        s.PC[m] = pc + 4
+    elif ex == pneptune_sim.Neptune_ExEQP:
+        s.F[m, CMPF] = s.P[m] == d[2]
+        s.PC[m] = pc + 4
+    elif ex == pneptune_sim.Neptune_ExNEQP:
+        s.F[m, CMPF] = s.P[m] != d[2]
+        s.PC[m] = pc + 4
+    elif ex == pneptune_sim.Neptune_ExINCP:
+        wrap = s.P[m] == WORDSIZEM1
+        s.P[m] = np.where(wrap, 0, s.P[m] + 1)
+        s.F[m, CARRYF] = wrap
+        s.PC[m] = pc + 4
+    elif ex == pneptune_sim.Neptune_ExDECP:
+        wrap = s.P[m] == 0
+        s.P[m] = np.where(wrap, WORDSIZEM1, s.P[m] - 1)
+        s.F[m, CARRYF] = wrap
+        s.PC[m] = pc + 4
+    elif ex == pneptune_sim.Neptune_ExLDN: # like Neptune_ExLDN only the last nibble stays
+        dst, nibs, count = d[2], d[3], d[4]
+        s.R[m, dst, s.P[m]] = (nibs >> (4 * (count - 1))) & 15
+        s.PC[m] = pc + 4
+    elif ex == pneptune_sim.Neptune_ExRET:
+        empty = m[s.SP[m] == 0]
+        if len(empty) > 0:
+            s.halt(empty, 'Stack Underflow!')
+        m = m[s.SP[m] > 0]
+        s.SP[m] -= 1
+        s.PC[m] = s.STACK[m, s.SP[m]]
+    elif ex == pneptune_sim.Neptune_ExSTOP:
+        s.halt(m, 'STOP reached')
+    elif ex == pneptune_sim.Neptune_ExJMP:
+        s.PC[m] = d[2]
+    elif (ex == pneptune_sim.Neptune_ExCALL) or (ex == pneptune_sim.Neptune_ExCALL7):
+        full = m[s.SP[m] == STACKSIZE]
+        if len(full) > 0:
+            s.halt(full, 'Stack Overflow!')
+            s.STEPS[full] -= 1 # not executed
+        m = m[s.SP[m] < STACKSIZE]
+        if ex == pneptune_sim.Neptune_ExCALL:
+            s.STACK[m, s.SP[m]] = pc + 4
+        else:
+            s.STACK[m, s.SP[m]] = pc + 1
+        s.SP[m] += 1
+        s.PC[m] = d[2]
+    elif ex in (pneptune_sim.Neptune_ExJC, pneptune_sim.Neptune_ExJNC, pneptune_sim.Neptune_ExJT, pneptune_sim.Neptune_ExJNT):
+        flag = CARRYF
+        if (ex == pneptune_sim.Neptune_ExJT) or (ex == pneptune_sim.Neptune_ExJNT):
+            flag = CMPF
+        taken = s.F[m, flag]
+        if (ex == pneptune_sim.Neptune_ExJNC) or (ex == pneptune_sim.Neptune_ExJNT):
+            taken = ~taken
+        s.PC[m] = np.where(taken, d[2], pc + 4)
+    elif ex == pneptune_sim.Neptune_ExMEM:
+        s.halt(m, 'LOAD/STO not supported in lockstep')
+        s.STEPS[m] -= 1 # not executed
+    else: # unknown opcodes and invalid LDN stop like in the simulator
+        cpu = pneptune_sim.NeptuneCPU()
+        ex(cpu, d)
+        s.halt(m, cpu.HALT)
+# reads the inputs file, returns { register: value } per lane
+def Neptune_ReadInputs(name):
+    lanes = []
+    for line in open(name):
+        items = line.split('#')[0].split()
+        if len(items) == 0:
+            continue
+        regs = dict()
+        for item in items:
+            reg, value = item.split('=')
+            regs[RN.index(reg)] = int(value, 16)
+        lanes.append(regs)
+    return lanes
+# returns the result line of a lane
+def Neptune_VResult(steps, carry, cmp, halt, regs):
+    s = '{0:d}\t{1:d}\t{2:d}\t{3:s}'.format(steps, carry, cmp, halt or 'steps')
+    for r in regs:
+        s = s + '\t{0:032x}'.format(r)
+    return s
+
+
+if __name__ == '__main__':
+    args = argv[1:]
+    max_steps = None
+    check = False
+    while len(args) > 2 and args[0][0] == '-':
+        if args[0] == '-n':
+            max_steps = int(args[1])
+            args = args[2:]
+        elif args[0] == '-c':
+            check = True
+            args = args[1:]
+        else:
+            print 'Unknown option {0:s}'.format(args[0])
+            exit(1)
+    if len(args) != 2:
+        print 'usage: pneptune_simd.py [-n steps] [-c] <code.bin> <inputs>'
+        exit(1)
+
+    code = pneptune_sim.Neptune_ReadCode(args[0])
+    inputs = Neptune_ReadInputs(args[1])
+    s = NeptuneSIMD(code, len(inputs))
+    for lane in range(len(inputs)):
+        for ireg in inputs[lane]:
+            s.setReg(lane, ireg, inputs[lane][ireg])
+    s.run(max_steps)
+    errors = 0
+    for lane in range(len(inputs)):
+        line = Neptune_VResult(int(s.STEPS[lane]), int(s.F[lane, CARRYF]), int(s.F[lane, CMPF]), s.HALT[lane],
+                               [ s.getReg(lane, i) for i in range(MAXALUREGS) ])
+        print line
+        if check:
+            cpu = pneptune_sim.NeptuneCPU(list(code), engine = 'int')
+            for ireg in inputs[lane]:
+                cpu.setReg(ireg, inputs[lane][ireg])
+            count, elapsed = cpu.run(max_steps)
+            ref = Neptune_VResult(count, int(cpu.RF[CARRYF]), int(cpu.RF[CMPF]), cpu.HALT, cpu.RR)
+            if ref != line:
+                print 'lane {0:d} differs, scalar:'.format(lane)
+                print ref
+                errors += 1
+    if check:
+        print '{0:d} lanes differ'.format(errors)
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+'''
+PNeptune binary traces
+
+Converts traces written by pneptune_sim.py -b to and from the text format of
+sqrt_trace.txt and compares two binary traces.
+
+pneptune_trace.py totext <trace.bin>             text trace to the console
+pneptune_trace.py tobin <trace.txt> <trace.bin>  text trace to binary
+pneptune_trace.py diff <a.bin> <b.bin>           first divergence and summary
+
+'''
+from sys import *
+import mmap
+import pneptune_sim
+from pneptune_sim import TRHEADER, TRRECORD, TRMAGIC, TRVERSION, TRR_P, TRR_NONE, TRF_NIB0, TRF_VALID, TR_P, RN
+
+TRCHUNK = 4096 # records compared at once by the diff
+
+# maps a binary trace file, returns the map and the number of records
+def Neptune_TraceMap(name):
+    f = open(name, 'rb')
+    m = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    f.close()
+    magic, version, size = TRHEADER.unpack_from(m, 0)
+    if magic != TRMAGIC or version != TRVERSION or size != TRRECORD.size:
+        raise ValueError('{0:s}: not a PNeptune trace'.format(name))
+    return m, (len(m) - TRHEADER.size) // TRRECORD.size
+# returns the record i of a mapped trace as (pc, word, dst, flags, value)
+def Neptune_TraceRecord(m, i):
+    pc, word, dst, flags, lo, hi = TRRECORD.unpack_from(m, TRHEADER.size + i * TRRECORD.size)
+    return pc, word, dst, flags, (hi << 64) | lo
+# returns the trace tuple (see pneptune_sim) of a record
+def Neptune_TraceTuple(r):
+    pc, word, dst, flags, x = r
+    if flags & TRF_VALID:
+        flags = flags & 3
+    else:
+        flags = None
+    if dst == TRR_NONE:
+        return pc, word, None, None, flags
+    elif dst == TRR_P:
+        return pc, word, TR_P, x, flags
+    return pc, word, dst, x, flags
+# returns the records of a mapped trace as trace tuples
+def Neptune_TraceTuples(m, n):
+    for i in range(n):
+        yield Neptune_TraceTuple(Neptune_TraceRecord(m, i))
+# returns the trace tuple of a text trace line or None
+# 00000  2000001e        LOADP    #1e             P: 1e
+def Neptune_TraceParse(line):
+    line = line.rstrip(' \r\n')
+    if len(line) < 15 or line[5:7] != '  ':
+        return None
+    try:
+        pc = int(line[0:5], 16)
+        word = int(line[7:15], 16)
+    except ValueError:
+        return None
+    if len(line) < 48:
+        return pc, word, None, None, None
+    name, value = line[48:].split(': ')
+    if name == 'P':
+        return pc, word, TR_P, int(value, 16), None
+    return pc, word, RN.index(name), int(value, 16) << 4, None
+# converts the text trace tname to the binary trace bname
+def Neptune_TraceToBin(tname, bname):
+    trace = []
+    for line in open(tname):
+        t = Neptune_TraceParse(line)
+        if t != None:
+            trace.append(t)
+    f = open(bname, 'wb')
+    f.write(TRHEADER.pack(TRMAGIC, TRVERSION, TRRECORD.size))
+    # text traces don't have nibble 0 and the flags, left unknown
+    f.write(pneptune_sim.Neptune_TraceRecords(trace))
+    f.close()
+    return len(trace)
+# compares two records, nibble 0 and the flags only when both know them
+def Neptune_TraceSame(a, b):
+    if a[0:3] != b[0:3]:
+        return False
+    va, vb = a[4], b[4]
+    if not (a[3] & b[3] & TRF_NIB0):
+        va, vb = va >> 4, vb >> 4
+    if va != vb:
+        return False
+    if a[3] & b[3] & TRF_VALID:
+        return (a[3] & 3) == (b[3] & 3)
+    return True
+# compares two binary traces, equal chunks are compared as bytes
+# returns the index of the first different record or None, and the number of
+# different records
+def Neptune_TraceDiff(ma, na, mb, nb):
+    first = None
+    count = 0
+    n = min(na, nb)
+    size = TRRECORD.size
+    for c in range(0, n, TRCHUNK):
+        s = TRHEADER.size + c * size
+        e = TRHEADER.size + min(c + TRCHUNK, n) * size
+        if ma[s:e] == mb[s:e]:
+            continue
+        for i in range(c, min(c + TRCHUNK, n)):
+            if not Neptune_TraceSame(Neptune_TraceRecord(ma, i), Neptune_TraceRecord(mb, i)):
+                if first == None:
+                    first = i
+                count += 1
+    if first == None and na != nb:
+        first = n
+    return first, count + abs(na - nb)
+# returns the text of a record
+def Neptune_TraceText(r):
+    return list(pneptune_sim.Neptune_TraceLines([ Neptune_TraceTuple(r) ]))[0]
+
+
+if __name__ == '__main__':
+    args = argv[1:]
+    if len(args) == 2 and args[0] == 'totext':
+        m, n = Neptune_TraceMap(args[1])
+        for line in pneptune_sim.Neptune_TraceLines(Neptune_TraceTuples(m, n)):
+            stdout.write(line + '\n')
+    elif len(args) == 3 and args[0] == 'tobin':
+        print '{0:d} records written'.format(Neptune_TraceToBin(args[1], args[2]))
+    elif len(args) == 3 and args[0] == 'diff':
+        ma, na = Neptune_TraceMap(args[1])
+        mb, nb = Neptune_TraceMap(args[2])
+        first, count = Neptune_TraceDiff(ma, na, mb, nb)
+        print '{0:s}: {1:d} records'.format(args[1], na)
+        print '{0:s}: {1:d} records'.format(args[2], nb)
+        if first == None:
+            print 'traces are the same'
+            exit(0)
+        print 'first difference at record {0:d}'.format(first)
+        if first < na:
+            print '< ' + Neptune_TraceText(Neptune_TraceRecord(ma, first))
+        if first < nb:
+            print '> ' + Neptune_TraceText(Neptune_TraceRecord(mb, first))
+        print '{0:d} records differ'.format(count)
+        exit(1)
+    else:
+        print 'usage: pneptune_trace.py totext <trace.bin>'
+        print '       pneptune_trace.py tobin <trace.txt> <trace.bin>'
+        print '       pneptune_trace.py diff <a.bin> <b.bin>'
+        exit(1)
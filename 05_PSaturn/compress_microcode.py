@@ -0,0 +1,167 @@
+#!/usr/bin/python
+'''
+Analyses the microcode and writes a two level encoding of it
+
+compress_microcode.py [-m listing] [-k field] [-n] [<index file> <table file>]
+
+Reports the microwords used by more than one row, the rows the sequencer never
+addresses, the values of every field and the fields given by other fields.
+Then the splits of the microword in an index table and a table of the
+different values of the fields from the split field on, with the block RAM
+(EBR of the MachXO2) and LUT4 they need, and writes the proposed split: the
+index table has 512 words, the fields before the split and the number of the
+value in the table. The split is the one with the fewest EBR for the index
+table and the smallest table, -k gives the field to split at. The files are
+for readmemb, default mc_idx.bin and mc_uniq.bin, -n writes nothing.
+
+The files written are read back and every used row is decoded and compared
+with the listing. Rows not used decode to anything.
+
+'''
+from sys import *
+import os
+from microcode import compileFile, formatError, loadTables, formatField, unpackWord, MC_FIELDS, MC_BITS
+from microcode import sequencerRows, fieldValues, fieldDependencies, splitLayout, splitEncode, splitDecode
+from microcode import valueBits, ebrCount, lutCount, readWords, writeWords
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+LISTING = os.path.join(DIR, 'mc_tbl_1.txt')
+INDEXFILE = os.path.join(DIR, 'mc_idx.bin')
+TABLEFILE = os.path.join(DIR, 'mc_uniq.bin')
+MCFILE = os.path.join(DIR, 'mc_tbl.bin')
+
+# returns the names of fields
+def fieldNames(order):
+    return ', '.join([ MC_FIELDS[i][0] for i in order ])
+# prints the rows with the same microword
+def printDuplicates(rows, used):
+    same = dict()
+    for a in used:
+        same.setdefault(rows[a].word, []).append(a)
+    groups = sorted([ addrs for addrs in same.values() if len(addrs) > 1 ])
+    print '{0:d} used rows, {1:d} different microwords, {2:d} used by more than one row:'.format(
+        len(used), len(same), len(groups))
+    for addrs in groups:
+        print '  {0:08x}  {1:s}'.format(rows[addrs[0]].word, ' '.join([ '{0:03x}'.format(a) for a in addrs ]))
+# prints the rows the sequencer doesn't address
+def printUnused(rows, used):
+    unused = sorted(set(range(len(rows))) - set(used))
+    print '{0:d} rows not addressed by the sequencer:'.format(len(unused))
+    for a in unused:
+        print '  {0:03x}  line {1:d}  {2:s}'.format(a, rows[a].lineNum, rows[a].comment)
+# prints the values of the fields and the fields given by others
+def printFields(fieldsList, tables):
+    values = fieldValues(fieldsList)
+    print 'fields:'
+    for i in range(len(MC_FIELDS)):
+        name, width = MC_FIELDS[i][:2]
+        s = '  {0:18s} {1:d} bits, {2:2d} values, {3:d} bits needed'.format(name, width, len(values[i]), valueBits(len(values[i])))
+        if len(values[i]) == 1:
+            s = s + ', always ' + formatField(values[i][0], MC_FIELDS[i], tables)
+        print s
+    constant = [ i for i in range(len(MC_FIELDS)) if len(values[i]) == 1 ]
+    for src, dst, count in fieldDependencies(fieldsList, constant):
+        print '  {0:s} gives {1:s} ({2:d} values)'.format(fieldNames(src), MC_FIELDS[dst][0], count)
+    for a in range(len(MC_FIELDS)):
+        for b in range(a + 1, len(MC_FIELDS)):
+            if MC_FIELDS[a][2] != None and MC_FIELDS[a][2] == MC_FIELDS[b][2] and a not in constant:
+                n = len([ f for f in fieldsList if f[a] == f[b] ])
+                print '  {0:s} = {1:s} in {2:d} rows'.format(MC_FIELDS[a][0], MC_FIELDS[b][0], n)
+# returns the layouts of the splits of the used rows
+def splitLayouts(words, used):
+    return [ (split, splitLayout(words, used, split)) for split in range(len(MC_FIELDS)) ]
+# prints the splits, the block RAM and LUT4 they need
+def printSplits(layouts, depth):
+    print 'splits:                 index     table      EBR   EBR    LUT4'
+    print '                        bits      words bits index table  table'
+    print '  {0:20s} {1:4d}   {2:8s}     {3:5d} {4:5s}  {5:5s}'.format('none', MC_BITS, '', ebrCount(depth, MC_BITS), '', '')
+    for split, layout in layouts:
+        if len(layout['inner']) == 0 or split in layout['constant']:
+            continue
+        print '  {0:20s} {1:4d}   {2:4d} {3:4d}     {4:5d} {5:5d}  {6:5d}'.format(MC_FIELDS[split][0],
+            layout['indexWidth'], len(layout['values']), layout['tableWidth'],
+            ebrCount(depth, layout['indexWidth']), ebrCount(len(layout['values']), layout['tableWidth']),
+            lutCount(len(layout['values']), layout['tableWidth']))
+# returns the split with the fewest EBR for the index table, then the
+# smallest table
+def proposeSplit(layouts, depth):
+    layouts = [ (split, layout) for split, layout in layouts if len(layout['inner']) > 0 ]
+    return min(layouts, key = lambda (split, layout): (ebrCount(depth, layout['indexWidth']),
+                                                       len(layout['values']) * layout['tableWidth']))
+# returns the used rows that don't decode to their microword from the files
+def checkFiles(indexName, tableName, words, used, layout):
+    index = readWords(indexName)
+    table = readWords(tableName)
+    return [ a for a in used if splitDecode(index[a], table, layout) != words[a] ]
+
+
+if __name__ == '__main__':
+    args = argv[1:]
+    splitName = None
+    write = True
+    while len(args) > 0 and args[0][0] == '-':
+        if args[0] == '-m' and len(args) > 1:
+            LISTING = args[1]
+            args = args[1:]
+        elif args[0] == '-k' and len(args) > 1:
+            splitName = args[1]
+            args = args[1:]
+        elif args[0] == '-n':
+            write = False
+        else:
+            print 'Unknown option {0:s}'.format(args[0])
+            exit(1)
+        args = args[1:]
+    if len(args) == 2:
+        INDEXFILE, TABLEFILE = args
+    elif len(args) != 0:
+        print 'usage: compress_microcode.py [-m listing] [-k field] [-n] [<index file> <table file>]'
+        exit(1)
+    tables = loadTables()
+    rows, errors = compileFile(LISTING, tables)
+    if len(errors) > 0:
+        for e in errors:
+            print formatError(e)
+        exit(1)
+    words = [ row.word for row in rows ]
+    if os.path.exists(MCFILE) and readWords(MCFILE) != words:
+        print '{0:s} is not the listing, run transform_microcode.py'.format(os.path.relpath(MCFILE))
+    used = [ a for a in sequencerRows() if a < len(rows) ]
+    fieldsList = [ unpackWord(words[a]) for a in used ]
+    printDuplicates(rows, used)
+    printUnused(rows, used)
+    printFields(fieldsList, tables)
+    layouts = splitLayouts(words, used)
+    printSplits(layouts, len(rows))
+    if splitName == None:
+        split, layout = proposeSplit(layouts, len(rows))
+    else:
+        names = [ f[0] for f in MC_FIELDS ]
+        if splitName not in names or len(layouts[names.index(splitName)][1]['inner']) == 0:
+            print 'No split at {0:s}'.format(splitName)
+            exit(1)
+        split, layout = layouts[names.index(splitName)]
+    bits = valueBits(len(layout['values']))
+    print 'split at {0:s}:'.format(MC_FIELDS[split][0])
+    print '  index {0:d} x {1:d}: {2:s}{3:s}number of the value ({4:d} bits)'.format(len(rows), layout['indexWidth'],
+        fieldNames(layout['outer']), ', ' if len(layout['outer']) > 0 else '', bits)
+    print '  table {0:d} x {1:d}: {2:s}'.format(len(layout['values']), layout['tableWidth'], fieldNames(layout['inner']))
+    if len(layout['constant']) > 0:
+        print '  left out: {0:s}'.format(', '.join([ '{0:s} = {1:s}'.format(MC_FIELDS[i][0],
+            formatField(v, MC_FIELDS[i], tables)) for i, v in sorted(layout['constant'].items()) ]))
+    ebrIndex = ebrCount(len(rows), layout['indexWidth'])
+    ebrTable = ebrCount(len(layout['values']), layout['tableWidth'])
+    print '  {0:d} EBR with the table in EBR, {1:d} EBR and {2:d} LUT4 with the table in LUT4, {3:s} {4:d} EBR'.format(
+        ebrIndex + ebrTable, ebrIndex, lutCount(len(layout['values']), layout['tableWidth']),
+        os.path.basename(MCFILE), ebrCount(len(rows), MC_BITS))
+    if not write:
+        exit(0)
+    index, table = splitEncode(words, used, layout)
+    writeWords(INDEXFILE, index, layout['indexWidth'])
+    writeWords(TABLEFILE, table, layout['tableWidth'])
+    bad = checkFiles(INDEXFILE, TABLEFILE, words, used, layout)
+    for a in bad:
+        print 'Row {0:03x} decodes to another microword'.format(a)
+    print '{0:s} and {1:s} written, {2:d} of {3:d} used rows equal'.format(os.path.relpath(INDEXFILE), os.path.relpath(TABLEFILE), len(used) - len(bad), len(used))
+    if len(bad) > 0:
+        exit(1)
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+'''
+Inspects the microcode of the decoder sequencer
+
+inspect_microcode.py [-m listing] <opcode>...
+inspect_microcode.py [-m listing] [-s] -r <hex file>
+inspect_microcode.py [-m listing] -c
+
+Opcodes are given as hex nibbles from the first one, like 8082F: prints the
+opcode of opcode_tbl_sorted.txt, the microcode address and the fields of the
+microword. -r annotates every opcode of a readmemh file, like rom71_h16.hex,
+from address 0 on: address, nibbles, opcode, microcode address and fields,
+followed by how often every row is used. -s prints only the rows. The opcodes
+are read one after the other, data between them is decoded as opcodes too.
+-c compares the row of every opcode with the address the sequencer computes
+(mca in saturn_decoder_sequencer.v).
+
+The rows are found with the pattern index of microcode.py.
+
+'''
+from sys import *
+import os
+from microcode import compileFile, rowIndex, lookupIndex, auditIndex, formatFields, formatError, loadTables
+from opcodes import loadOpcodes, decodeOpcode, opcodeLength, readNibbles
+
+LISTING = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mc_tbl_1.txt')
+
+# returns the nibbles of a hex text, the first nibble is the first character
+def hexNibbles(text):
+    return [ int(c, 16) for c in text ]
+# returns the text of nibbles
+def nibblesText(nibbles):
+    return ''.join([ '{0:X}'.format(n) for n in nibbles ])
+# returns the text of an opcode of the table or ?
+def opcodeText(op):
+    if op == None:
+        return '?'
+    return '{0:7s} {1:s}'.format(op.name, op.args).rstrip()
+# prints the microcode of opcodes given as hex text
+def inspectOpcodes(texts, rows, index, tables, opcodes, opindex):
+    for text in texts:
+        nibbles = hexNibbles(text) + [ 0 ] * 21
+        op = decodeOpcode(opcodes, opindex, nibbles)
+        row = lookupIndex(index, nibbles)
+        print '{0:s}  {1:s}'.format(text.upper(), opcodeText(op))
+        if row == None:
+            print '  no microcode'
+            continue
+        print '  mca {0:03x}  line {1:d}  {2:s}'.format(row, rows[row].lineNum, rows[row].comment)
+        print '  {0:s}'.format(formatFields(rows[row].fields, tables))
+# annotates the opcodes of the nibbles, returns the lines and the number of
+# times every row is used
+def annotateNibbles(nibbles, rows, index, tables, opcodes, opindex):
+    lines = []
+    used = [ 0 ] * len(rows)
+    texts = dict()  # text after the address by nibbles of the opcode
+    end = len(nibbles)
+    nibbles = nibbles + [ 0 ] * 32
+    pc = 0
+    while pc < end:
+        op = decodeOpcode(opcodes, opindex, nibbles, pc)
+        length = 1
+        if op != None:
+            length = opcodeLength(op, nibbles, pc)
+        row = lookupIndex(index, nibbles, pc)
+        if row != None:
+            used[row] += 1
+        key = (tuple(nibbles[pc:pc + length]), row)
+        text = texts.get(key)
+        if text == None:
+            text = '{0:21s} {1:16s}'.format(nibblesText(key[0]), opcodeText(op))
+            if row != None:
+                text = text + ' {0:03x}  {1:s}'.format(row, formatFields(rows[row].fields, tables))
+            texts[key] = text
+        lines.append('{0:05X}  {1:s}'.format(pc, text))
+        pc += length
+    return lines, used
+# prints how often the rows are used
+def printUsage(used, rows):
+    for i in range(len(rows)):
+        print '{0:03x}  {1:7d}  {2:s}'.format(i, used[i], rows[i].comment)
+    print '{0:d} opcodes, {1:d} of {2:d} rows used'.format(sum(used), len([ u for u in used if u > 0 ]), len(rows))
+
+
+if __name__ == '__main__':
+    args = argv[1:]
+    summary = False
+    rom = None
+    check = False
+    while len(args) > 0 and args[0][0] == '-':
+        if args[0] == '-m' and len(args) > 1:
+            LISTING = args[1]
+            args = args[1:]
+        elif args[0] == '-r' and len(args) > 1:
+            rom = args[1]
+            args = args[1:]
+        elif args[0] == '-s':
+            summary = True
+        elif args[0] == '-c':
+            check = True
+        else:
+            print 'Unknown option {0:s}'.format(args[0])
+            exit(1)
+        args = args[1:]
+    if rom == None and not check and len(args) == 0:
+        print 'usage: inspect_microcode.py [-m listing] <opcode>...'
+        print '       inspect_microcode.py [-m listing] [-s] -r <hex file>'
+        print '       inspect_microcode.py [-m listing] -c'
+        exit(1)
+    tables = loadTables()
+    rows, errors = compileFile(LISTING, tables)
+    if len(errors) == 0:
+        index, errors = rowIndex(rows, LISTING)
+    if len(errors) > 0:
+        for e in errors:
+            print formatError(e)
+        exit(1)
+    opcodes, opindex = loadOpcodes()
+    if check:
+        count, diffs = auditIndex(index)
+        for (row, mca), (n, first) in sorted(diffs.items()):
+            print '{0:d} opcodes from {1:s}: row {2:s}, sequencer {3:03x}'.format(
+                n, first, 'none' if row == None else '{0:03x}'.format(row), mca)
+        print '{0:d} opcodes compared, {1:d} differ'.format(count, sum([ d[0] for d in diffs.values() ]))
+    elif rom != None:
+        lines, used = annotateNibbles(readNibbles(rom), rows, index, tables, opcodes, opindex)
+        if not summary:
+            stdout.write('\n'.join(lines) + '\n')
+        printUsage(used, rows)
+    else:
+        inspectOpcodes(args, rows, index, tables, opcodes, opindex)
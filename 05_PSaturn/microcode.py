@@ -0,0 +1,494 @@
+#!/usr/bin/python
+'''
+Saturn microcode compiler
+
+Compiles the microcode listing (mc_tbl_1.txt) to the 32 bit microwords of
+mcrom in saturn_decoder_sequencer.v. A row is the opcode pattern followed by
+the fields of MC_FIELDS, comments start with #:
+
+1001_0xxx_0000_xxxx_xxxx_xxxx , 0, 0, 0, 0, 0, 0, 0, 0, 0, 6,`ALU_OP_EQ  , `OP_A  , `K_B  , `OP_A   # ?A=B
+
+The rows are in groups of 16, the decoder selects the group and a nibble of
+the opcode the row inside it, so the address of a row is its position.
+The symbols of the fields are the `defines of saturn_defs.v. Errors are
+collected, nothing is written when there is one.
+
+'''
+import os
+import re
+import hashlib
+import cPickle
+from collections import namedtuple
+
+# the symbols of the fields are the `defines of saturn_defs.v with these
+# prefixes, parsed once and cached next to it
+DEFSFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'saturn_defs.v')
+CACHEFILE = '.mccache'
+CACHEVERSION = 1
+TABLE_PREFIXES = [
+    ( 'OP1',    '`OP_' ),
+    ( 'KOP',    '`K_' ),
+    ( 'ALU_OP', '`ALU_OP_' )
+]
+DEFINE = re.compile(r"\s*`define\s+(\w+)\s+(\d+)'([hdb])([0-9a-fA-F_]+)")
+RADIX = { 'h': 16, 'd': 10, 'b': 2 }
+
+FLAG = None     # field is a 0/1 flag
+NUMBER = ''     # field is a number
+# fields of a row from the left, they fill the microword from bit 31 down
+# name, width, table of the symbols of the field or FLAG or NUMBER
+# names and widths like the op_ signals of saturn_decoder_sequencer.v
+# (mc[31] to mc[0]). The header of mc_tbl_1.txt is not used: it only names the
+# flags, has no widths for the other fields and has the two goto columns the
+# other way round.
+MC_FIELDS = [
+    ( 'forced_carry',      1, FLAG ),    # forced carry with literal 0
+    ( 'forced_hex',        1, FLAG ),    # forced hex mode
+    ( 'write_carry',       1, FLAG ),
+    ( 'write_dst',         1, FLAG ),
+    ( 'write_sticky',      1, FLAG ),
+    ( 'abit',              1, FLAG ),    # goto on bit set/clear ?ABIT ?CBIT
+    ( 'goto_on_cond_true', 1, FLAG ),    # goto on condition true ?HS ?ST ?P ?A
+    ( 'spare_24',          1, FLAG ),
+    ( 'spare_23',          1, FLAG ),
+    ( 'field_left',        3, NUMBER ),  # field length
+    ( 'alu_op',            5, 'ALU_OP' ),
+    ( 'alu_reg1',          6, 'OP1' ),
+    ( 'alu_reg2',          3, 'KOP' ),
+    ( 'alu_dst',           6, 'OP1' )
+]
+MC_BITS = 32
+MC_ROWS = 512   # size of mcrom
+MC_GROUP = 16   # rows per group
+PATTERN_DIGITS = '01x'
+
+# shifts of the fields in the microword
+MC_SHIFTS = []
+shift = MC_BITS
+for name, width, symbols in MC_FIELDS:
+    shift -= width
+    MC_SHIFTS.append(shift)
+del shift
+
+# errors by kind
+E_SYNTAX  = 'syntax'
+E_PATTERN = 'bad pattern'
+E_FLAG    = 'bad flag'
+E_NUMBER  = 'bad number'
+E_SYMBOL  = 'unknown symbol'
+E_GROUP   = 'incomplete group'
+E_SIZE    = 'too many rows'
+E_CONFLICT = 'conflict'
+
+MCError = namedtuple('MCError', 'fileName lineNum kind message')
+# a compiled row, fields as numbers in the order of MC_FIELDS
+Row = namedtuple('Row', 'lineNum pattern fields word comment')
+
+# returns the text of an error
+def formatError(e):
+    return '{0:s}:{1:d}: {2:s}: {3:s}'.format(e.fileName, e.lineNum, e.kind, e.message)
+# returns the microword of the fields
+def packWord(fields):
+    word = 0
+    for i in range(len(MC_FIELDS)):
+        word |= fields[i] << MC_SHIFTS[i]
+    return word
+# returns the fields of a microword
+def unpackWord(word):
+    return tuple([ (word >> MC_SHIFTS[i]) & ((1 << MC_FIELDS[i][1]) - 1) for i in range(len(MC_FIELDS)) ])
+# returns the `defines of the lines of a Verilog file with a sized number as
+# value: [ (symbol, width, value) ], in the order of the file
+def parseDefines(lines):
+    defines = []
+    for line in lines:
+        m = DEFINE.match(line)
+        if m != None:
+            defines.append(('`' + m.group(1), int(m.group(2)), int(m.group(4).replace('_', ''), RADIX[m.group(3)])))
+    return defines
+# returns the `defines of a Verilog file, parsed again only when the file
+# changed: the cache is used when the size and time of the file are the same
+# or its contents are
+def loadDefines(defsName):
+    cacheName = os.path.join(os.path.dirname(defsName), CACHEFILE)
+    st = os.stat(defsName)
+    cache = None
+    if os.path.exists(cacheName):
+        try:
+            f = open(cacheName, 'rb')
+            cache = cPickle.load(f)
+            f.close()
+        except (EOFError, cPickle.UnpicklingError):
+            pass # broken cache, parsed again
+    if cache != None and cache['version'] == CACHEVERSION and cache['file'] == defsName:
+        if (cache['mtime'], cache['size']) == (st.st_mtime, st.st_size):
+            return cache['defines']
+    else:
+        cache = None
+    f = open(defsName, 'rb')
+    data = f.read()
+    f.close()
+    key = hashlib.sha1(data).hexdigest()
+    if cache == None or cache['sha1'] != key:
+        cache = { 'version': CACHEVERSION, 'file': defsName, 'sha1': key,
+                  'defines': parseDefines(data.splitlines()) }
+    cache['mtime'], cache['size'] = st.st_mtime, st.st_size
+    try:
+        f = open(cacheName + '.tmp', 'wb')
+        cPickle.dump(cache, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        if os.path.exists(cacheName) and os.name == 'nt':
+            os.remove(cacheName)
+        os.rename(cacheName + '.tmp', cacheName)
+    except (IOError, OSError):
+        pass # read only directory, parsed every time
+    return cache['defines']
+# returns the symbol tables of the fields from the `defines of a Verilog file
+# { table: (symbols { symbol: value }, names { value: first symbol }) }
+# symbols with the same value decode to the first one, like `OP_IN and `OP_OUT
+def loadTables(defsName = DEFSFILE):
+    defines = loadDefines(defsName)
+    tables = dict()
+    for table, prefix in TABLE_PREFIXES:
+        symbols = dict()
+        names = dict()
+        for symbol, width, value in defines:
+            if symbol.startswith(prefix):
+                symbols[symbol] = value
+                names.setdefault(value, symbol)
+        tables[table] = (symbols, names)
+    return tables
+# returns the value of a field and None or None and the error
+def parseField(text, field, tables):
+    name, width, symbols = field
+    if symbols is FLAG:
+        if text != '0' and text != '1':
+            return None, (E_FLAG, '{0:s} is {1:s}, not 0 or 1'.format(name, text))
+        return int(text), None
+    if symbols is NUMBER:
+        if not text.isdigit() or int(text) >= (1 << width):
+            return None, (E_NUMBER, '{0:s} is {1:s}, not 0..{2:d}'.format(name, text, (1 << width) - 1))
+        return int(text), None
+    value = tables[symbols][0].get(text)
+    if value == None:
+        return None, (E_SYMBOL, '{0:s} for {1:s}'.format(text, name))
+    if value >= (1 << width):
+        return None, (E_NUMBER, '{0:s} = {1:d} does not fit {2:d} bits of {3:s}'.format(text, value, width, name))
+    return value, None
+# returns the text of a field, the symbol of its value when it has one
+def formatField(value, field, tables):
+    name, width, symbols = field
+    if symbols is FLAG or symbols is NUMBER:
+        return '{0:d}'.format(value)
+    return tables[symbols][1].get(value, '{0:d}\'h{1:02x}'.format(width, value))
+# returns the fields of a row as text like in the listing
+def formatFields(fields, tables):
+    return ', '.join([ formatField(fields[i], MC_FIELDS[i], tables) for i in range(len(MC_FIELDS)) ])
+# returns the row of a line or None and the errors
+def parseRow(line, lineNum, fileName, tables):
+    code, sep, comment = line.partition('#')
+    items = [ item.strip() for item in code.split(',') ]
+    if len(items) != len(MC_FIELDS) + 1:
+        return None, [ MCError(fileName, lineNum, E_SYNTAX, '{0:d} fields, {1:d} expected'.format(len(items) - 1, len(MC_FIELDS))) ]
+    errors = []
+    pattern = items[0].replace('_', '')
+    if len(pattern) != 24 or pattern.strip(PATTERN_DIGITS) != '':
+        errors.append(MCError(fileName, lineNum, E_PATTERN, items[0]))
+    fields = []
+    for i in range(len(MC_FIELDS)):
+        value, err = parseField(items[i + 1], MC_FIELDS[i], tables)
+        if err != None:
+            errors.append(MCError(fileName, lineNum, err[0], err[1]))
+        fields.append(value)
+    if len(errors) > 0:
+        return None, errors
+    return Row(lineNum, pattern, tuple(fields), packWord(fields), comment.strip()), errors
+# compiles the lines of a listing as they are read, returns the rows and the errors
+def compileLines(lines, fileName = '', tables = None):
+    if tables == None:
+        tables = loadTables()
+    rows = []
+    errors = []
+    start = None    # line and row of the first row of the running group
+    for lineNum, line in enumerate(lines, 1):
+        code = line.split('#', 1)[0].strip()
+        if code == '':
+            if start != None and (len(rows) - start[1]) % MC_GROUP != 0:
+                errors.append(MCError(fileName, start[0], E_GROUP, '{0:d} rows, groups have {1:d}'.format(len(rows) - start[1], MC_GROUP)))
+            start = None
+            continue
+        if start == None:
+            start = (lineNum, len(rows))
+        row, errs = parseRow(line, lineNum, fileName, tables)
+        errors.extend(errs)
+        if row == None: # keeps the addresses of the rows after it
+            row = Row(lineNum, None, None, 0, '')
+        rows.append(row)
+    if start != None and (len(rows) - start[1]) % MC_GROUP != 0:
+        errors.append(MCError(fileName, start[0], E_GROUP, '{0:d} rows, groups have {1:d}'.format(len(rows) - start[1], MC_GROUP)))
+    if len(rows) > MC_ROWS:
+        errors.append(MCError(fileName, rows[MC_ROWS].lineNum, E_SIZE, '{0:d} rows, mcrom has {1:d}'.format(len(rows), MC_ROWS)))
+    return rows, errors
+# compiles a listing file, returns the rows and the errors
+def compileFile(fileName, tables = None):
+    f = open(fileName, 'rt')
+    rows, errors = compileLines(f, fileName, tables)
+    f.close()
+    return rows, errors
+# returns the text of words of width bits for readmemb
+def formatBits(words, width):
+    return ''.join([ '{0:0{1:d}b}\n'.format(word, max(width, 1)) for word in words ])
+# writes the words for readmemb at once, the file is replaced only when the
+# contents changed, returns True when it was written
+def writeWords(fileName, words, width = MC_BITS):
+    data = formatBits(words, width)
+    if os.path.exists(fileName):
+        f = open(fileName, 'rb')
+        old = f.read()
+        f.close()
+        if old == data:
+            return False
+    f = open(fileName + '.tmp', 'wb')
+    f.write(data)
+    f.close()
+    if os.path.exists(fileName) and os.name == 'nt': # rename doesn't replace on Windows
+        os.remove(fileName)
+    os.rename(fileName + '.tmp', fileName)
+    return True
+#
+# Pattern index
+#
+# The patterns of the rows and of the opcode table are nibbles with don't
+# care bits, like 1001_0xxx_0000_xxxx, the first nibble is the first of the
+# opcode. They are compiled to a trie over the nibbles of the opcode: a node is
+# a list of 16 nodes or a leaf, the index of the most specific pattern that
+# matches or None. Nodes are shared, the trie of mc_tbl_1.txt has a few
+# hundred, looking up an opcode reads at most 6 nibbles.
+#
+
+# returns the (mask, value) of the nibbles of a pattern of 0, 1 and x
+def patternNibbles(pattern):
+    pattern = pattern.replace('_', '')
+    nibbles = []
+    for i in range(0, len(pattern), 4):
+        bits = pattern[i:i + 4]
+        nibbles.append((int(bits.replace('0', '1').replace('x', '0'), 2), int(bits.replace('x', '0'), 2)))
+    return nibbles
+# returns the number of bits a pattern fixes
+def patternBits(nibbles):
+    return sum([ bin(mask).count('1') for mask, value in nibbles ])
+# builds the node of the patterns cands that match the nibbles above depth
+def indexNode(patterns, bits, cands, depth, nodes, conflicts):
+    key = (cands, depth)
+    if key in nodes:
+        return nodes[key]
+    if all([ m == 0 for i in cands for m, v in patterns[i][depth:] ]):
+        node = None
+        if len(cands) > 0:
+            best = max([ bits[i] for i in cands ])
+            same = [ i for i in cands if bits[i] == best ]
+            node = same[0]
+            if len(same) > 1:
+                conflicts.add(tuple(same))
+    else:
+        node = []
+        for nibble in range(16):
+            match = tuple([ i for i in cands if depth >= len(patterns[i]) or
+                            nibble & patterns[i][depth][0] == patterns[i][depth][1] ])
+            node.append(indexNode(patterns, bits, match, depth + 1, nodes, conflicts))
+    nodes[key] = node
+    return node
+# returns the trie of the patterns and the sets of the patterns that match the
+# same opcodes with the same number of bits
+def buildIndex(patterns):
+    patterns = [ patternNibbles(p) for p in patterns ]
+    bits = [ patternBits(p) for p in patterns ]
+    conflicts = set()
+    root = indexNode(patterns, bits, tuple(range(len(patterns))), 0, dict(), conflicts)
+    return root, sorted(conflicts)
+# returns the pattern of the opcode at pos of the nibbles or None, raises
+# IndexError when the pattern needs more nibbles
+def lookupIndex(index, nibbles, pos = 0):
+    node = index
+    while node.__class__ is list:
+        node = node[nibbles[pos]]
+        pos += 1
+    return node
+# returns the index of the rows and the errors of rows that match the same
+# opcodes
+def rowIndex(rows, fileName = ''):
+    index, conflicts = buildIndex([ row.pattern for row in rows ])
+    errors = []
+    for same in conflicts:
+        errors.append(MCError(fileName, rows[same[0]].lineNum, E_CONFLICT, 'rows {0:s} match the same opcodes'.format(
+            ', '.join([ '{0:03x}'.format(i) for i in same ]))))
+    return index, errors
+# returns the microcode address the sequencer computes for the nibbles of an
+# opcode, like mca in saturn_decoder_sequencer.v
+def sequencerAddress(n):
+    op0, op1, op2 = n[0], n[1], n[2]
+    if op0 == 0x0:
+        return (0x00 << 4) | n[3] if op1 == 0xE else (0x01 << 4) | op1
+    if op0 == 0x1:
+        if op1 <= 0x5:
+            return (0x02 + op1) << 4 | op2
+        return (0x08 << 4) | op1
+    if op0 <= 0x7:
+        return 0x1F0 | op0
+    if op0 == 0x8:
+        if op1 == 0x0:
+            return (0x09 << 4) | n[3] if op2 == 0x8 else (0x0A << 4) | op2
+        if op1 == 0x1:
+            if op2 == 0x8 or op2 == 0x9:
+                return (0x0B + op2 - 0x8) << 4 | n[4]
+            if op2 == 0xA:
+                if n[4] <= 0x2:
+                    return (0x0D + n[4]) << 4 | n[5]
+                return 0x000
+            if op2 == 0xB:
+                return (0x10 << 4) | n[3]
+            return (0x11 << 4) | op2
+        if op1 == 0xA or op1 == 0xB:
+            return (0x12 + op1 - 0xA) << 4 | op2
+        return (0x14 << 4) | op1
+    if op0 <= 0xB:
+        return (0x15 + 2 * (op0 - 0x9) + (op1 >> 3)) << 4 | op2
+    return (0x1B + op0 - 0xC) << 4 | op1
+# returns the number of nibbles the sequencer reads to address an opcode
+def sequencerNibbles(prefix):
+    if prefix[:2] == [ 0x8, 0x1 ]:
+        return 6
+    return 4
+# compares the index with the addressing of the sequencer for every opcode,
+# returns the number of opcodes compared and the differences as
+# { (index row, sequencer address): [ count, first opcode as text ] }
+def auditIndex(index):
+    diffs = dict()
+    count = 0
+    stack = [ (index, []) ]
+    while len(stack) > 0:
+        node, prefix = stack.pop()
+        if node.__class__ is list or len(prefix) < sequencerNibbles(prefix):
+            for nibble in range(15, -1, -1):
+                stack.append((node[nibble] if node.__class__ is list else node, prefix + [ nibble ]))
+            continue
+        count += 1
+        mca = sequencerAddress(prefix + [ 0 ] * 6)
+        if node != mca:
+            d = diffs.setdefault((node, mca), [ 0, ''.join([ '{0:X}'.format(n) for n in prefix ]) ])
+            d[0] += 1
+    return count, diffs
+#
+# Analysis and compaction
+#
+# Only the rows the sequencer addresses matter, the others are don't care.
+# The microword can be split in two levels: the fields from a split field on
+# are replaced by the index of their values in a table of the different
+# values, the index table keeps the fields before the split and that index.
+# Fields with the same value in every row are left out of both.
+#
+
+# block RAM of the MachXO2 as depth, width
+EBR_CONFIGS = [ (8192, 1), (4096, 2), (2048, 4), (1024, 9), (512, 18) ]
+LUT_ROM = 16    # words of a LUT4 as ROM
+
+# returns the addresses the sequencer computes for any opcode
+def sequencerRows():
+    addrs = set()
+    for prefix in range(1 << 16):
+        n = [ prefix >> 12, (prefix >> 8) & 15, (prefix >> 4) & 15, prefix & 15 ]
+        if sequencerNibbles(n) > 4:
+            for suffix in range(256):
+                addrs.add(sequencerAddress(n + [ suffix >> 4, suffix & 15 ]))
+        else:
+            addrs.add(sequencerAddress(n + [ 0, 0 ]))
+    return sorted(addrs)
+# returns the number of bits to number count values
+def valueBits(count):
+    bits = 0
+    while (1 << bits) < count:
+        bits += 1
+    return bits
+# returns the number of block RAMs of a ROM of depth words of width bits
+def ebrCount(depth, width):
+    if depth == 0 or width == 0:
+        return 0
+    return min([ -(-depth // d) * -(-width // w) for d, w in EBR_CONFIGS ])
+# returns the number of LUT4 of a ROM of depth words of width bits without
+# the multiplexers
+def lutCount(depth, width):
+    return -(-depth // LUT_ROM) * width
+# returns the different values of every field in the fields of the rows
+def fieldValues(fieldsList):
+    return [ sorted(set([ fields[i] for fields in fieldsList ])) for i in range(len(MC_FIELDS)) ]
+# returns the fields that are a function of one field or of two fields, not
+# constant and not given by one of the two: [ (sources, field, values of the
+# sources) ]
+def fieldDependencies(fieldsList, constant):
+    free = [ i for i in range(len(MC_FIELDS)) if i not in constant ]
+    sources = [ (a,) for a in free ] + [ (a, b) for a in free for b in free if a < b ]
+    deps = []
+    for src in sources:
+        for dst in free:
+            if dst in src or [ d for d in deps if d[1] == dst and set(d[0]) < set(src) ]:
+                continue
+            values = dict()
+            for fields in fieldsList:
+                key = tuple([ fields[i] for i in src ])
+                if values.setdefault(key, fields[dst]) != fields[dst]:
+                    break
+            else:
+                deps.append((src, dst, len(values)))
+    return deps
+# returns the layout of a split at field split of the rows of the addresses
+# { 'constant': { field: value }, 'outer': fields of the index table,
+#   'inner': fields of the table, 'values': [ inner fields ], 'indexWidth',
+#   'tableWidth' }
+def splitLayout(words, addrs, split):
+    fieldsList = [ unpackWord(words[a]) for a in addrs ]
+    values = fieldValues(fieldsList)
+    constant = dict([ (i, values[i][0]) for i in range(len(MC_FIELDS)) if len(values[i]) == 1 ])
+    outer = [ i for i in range(split) if i not in constant ]
+    inner = [ i for i in range(split, len(MC_FIELDS)) if i not in constant ]
+    table = sorted(set([ tuple([ fields[i] for i in inner ]) for fields in fieldsList ]))
+    return { 'constant': constant, 'outer': outer, 'inner': inner, 'values': table,
+             'indexWidth': sum([ MC_FIELDS[i][1] for i in outer ]) + valueBits(len(table)),
+             'tableWidth': sum([ MC_FIELDS[i][1] for i in inner ]) }
+# returns a number of the fields, the first one in the high bits
+def packFields(fields, order):
+    word = 0
+    for i in order:
+        word = (word << MC_FIELDS[i][1]) | fields[i]
+    return word
+# sets the fields of a number of packFields, returns the low bits left
+def unpackFields(word, order, fields):
+    for i in reversed(order):
+        fields[i] = word & ((1 << MC_FIELDS[i][1]) - 1)
+        word >>= MC_FIELDS[i][1]
+    return word
+# returns the index table of the words and the table of a layout, the
+# addresses not given get 0
+def splitEncode(words, addrs, layout):
+    slots = dict([ (v, i) for i, v in enumerate(layout['values']) ])
+    bits = valueBits(len(layout['values']))
+    index = [ 0 ] * len(words)
+    for a in addrs:
+        fields = unpackWord(words[a])
+        slot = slots[tuple([ fields[i] for i in layout['inner'] ])]
+        index[a] = (packFields(fields, layout['outer']) << bits) | slot
+    table = [ packFields(dict(zip(layout['inner'], v)), layout['inner']) for v in layout['values'] ]
+    return index, table
+# returns the microword of an index word and the table of a layout
+def splitDecode(indexWord, table, layout):
+    fields = [ 0 ] * len(MC_FIELDS)
+    for i, value in layout['constant'].items():
+        fields[i] = value
+    bits = valueBits(len(layout['values']))
+    unpackFields(indexWord >> bits, layout['outer'], fields)
+    unpackFields(table[indexWord & ((1 << bits) - 1)], layout['inner'], fields)
+    return packWord(fields)
+# returns the words of a readmemb file
+def readWords(fileName):
+    f = open(fileName, 'rt')
+    words = [ int(line, 2) for line in f if line.strip() != '' ]
+    f.close()
+    return words
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+'''
+Saturn opcode table
+
+Reads opcode_tbl_sorted.txt, a row is the mnemonic, its arguments, the
+nibbles of the opcode from the first one and a comment:
+
+"A=DAT0 ","fs      ","1","5","2","a"," "," "," ", "                  "
+
+Nibbles in hex are fixed, a and b are a field 0..7 and 8..F, the other
+letters are arguments. LC and LA load the number of nibbles given by the
+nibble n plus one.
+
+'''
+import os
+import csv
+from collections import namedtuple
+from microcode import buildIndex, lookupIndex
+
+OPCODEFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opcode_tbl_sorted.txt')
+LITERAL_OPS = ( 'LC(', 'LA(' )  # opcodes with a variable number of nibbles
+
+# nibbles is the text of the nibbles of the row, length the number of nibbles
+# or None for LC and LA
+Opcode = namedtuple('Opcode', 'name args nibbles length comment')
+
+# returns the pattern of 0, 1 and x of the nibbles of a row
+def opcodePattern(nibbles):
+    bits = []
+    for n in nibbles:
+        if n in '0123456789ABCDEF':
+            bits.append('{0:04b}'.format(int(n, 16)))
+        elif n == 'a':
+            bits.append('0xxx')
+        elif n == 'b':
+            bits.append('1xxx')
+        else:
+            bits.append('xxxx')
+    return '_'.join(bits)
+# returns the opcodes of a table file, rows without nibbles are left out
+def readOpcodes(fileName = OPCODEFILE):
+    opcodes = []
+    f = open(fileName, 'rb')
+    for row in csv.reader(f, skipinitialspace = True):
+        if len(row) < 10:
+            continue
+        nibbles = ''.join([ n.strip() for n in row[2:9] ])
+        if nibbles == '':
+            continue
+        name = row[0].strip()
+        length = len(nibbles)
+        if name.startswith(LITERAL_OPS):
+            length = None
+        opcodes.append(Opcode(name, row[1].strip(), nibbles, length, row[9].strip()))
+    f.close()
+    return opcodes
+# returns the opcodes of a table and their index
+def loadOpcodes(fileName = OPCODEFILE):
+    opcodes = readOpcodes(fileName)
+    index, conflicts = buildIndex([ opcodePattern(op.nibbles) for op in opcodes ])
+    return opcodes, index
+# returns the number of nibbles of an opcode at pos of the nibbles
+def opcodeLength(op, nibbles, pos = 0):
+    if op.length != None:
+        return op.length
+    n = op.nibbles.index('n')
+    return n + 1 + nibbles[pos + n] + 1
+# returns the opcode at pos of the nibbles or None, raises IndexError when
+# there are not enough nibbles
+def decodeOpcode(opcodes, index, nibbles, pos = 0):
+    i = lookupIndex(index, nibbles, pos)
+    if i == None:
+        return None
+    return opcodes[i]
+# returns the nibbles of a file for readmemh of 16 bit words, the first
+# nibble is the low one of the word
+def readNibbles(fileName):
+    nibbles = []
+    f = open(fileName, 'rt')
+    for line in f:
+        line = line.split('//')[0].strip()
+        if line != '':
+            word = int(line, 16)
+            nibbles.extend([ word & 15, (word >> 4) & 15, (word >> 8) & 15, word >> 12 ])
+    f.close()
+    return nibbles
@@ -37,8 +37,8 @@
 `define K_D        3'h3
 `define K_9        3'h4 // 9s or Fs depending on the decimal flag
 `define K_LIT      3'h5 // literal from opcode or zero
-`define K_D0       3'h5 // for address generation
-`define K_D1       3'h6 // for address generation
+`define K_D0       3'h6 // for address generation
+`define K_D1       3'h7 // for address generation
 
 // ALU operations
 `define ALU_OP_NONE 5'h00
@@ -0,0 +1,548 @@
+#!/usr/bin/python
+'''
+Saturn reference model driven by the microcode
+
+saturn_sim.py [-m microcode] [-n steps] [-u pc] [-t] [-r] <hex file>
+
+Runs a readmemh file of 16 bit words, like cputest.hex or rom71_h16.hex,
+from address 0 on. The opcodes are decoded with opcode_tbl_sorted.txt, what
+they do is the microword of mc_tbl.bin the sequencer addresses (mca in
+saturn_decoder_sequencer.v): ALU_OP_*, the OP_* source, K_* second operand
+and OP_* destination, the field from field_left or the field decoder
+(P WP XS X S M B W, A is field_left 4) and the flags. The symbols are the
+`defines of saturn_defs.v. Jumps, calls, returns, the literals and the
+masks are done like the sequencer does them, the data path like
+saturn_alru.v, so changes to the microcode show up like in the RTL.
+
+-n  stops after steps opcodes, default 1000000
+-u  stops before the opcode at pc (hex)
+-t  prints every opcode like the RTL trace, PC and nibbles and mnemonic
+-r  prints the registers after every opcode
+
+The run stops too on an opcode not in the table and on a jump to itself.
+The file is ROM from 0 to 1FFFF like in saturn_top.v, writes there are
+lost, the rest of the 1M nibbles is RAM. Interrupts, the timers and the
+display are not modelled.
+
+Where saturn_alru.v has no path yet the model does what its comments say:
+HS can be read as a source, EX writes the second operand back to the register
+of the first one, writing PC jumps. The goto flags of the microword tell a
+test, the position of the offset is taken from the opcode (?ABIT ?CBIT have
+it after the bit number), as the listing and the sequencer have the two flags
+the other way round.
+
+'''
+from sys import *
+import os
+import time
+from collections import namedtuple
+from microcode import loadTables, readWords, unpackWord, sequencerAddress
+from opcodes import loadOpcodes, decodeOpcode, opcodeLength, readNibbles
+
+MCFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mc_tbl.bin')
+MEMSIZE = 1 << 20   # nibbles
+ROMSIZE = 0x20000   # read only nibbles from 0, like async_rom of saturn_top.v
+MAXSTEPS = 1000000
+ADDRMASK = 0xFFFFF
+W64 = (1 << 64) - 1
+NINES = 0x9999999999999999
+ONES = 0x1111111111111111
+FIELD_NAMES = [ 'P', 'WP', 'XS', 'X', 'S', 'M', 'B', 'W' ]
+# start and end nibble of the fields of the field decoder, None is P
+FIELDS = [ (None, None), (0, None), (2, 2), (0, 2), (15, 15), (3, 14), (0, 1), (0, 15) ]
+
+# state of the core
+MEM = bytearray(MEMSIZE)    # one nibble per byte
+ABCD = [ 0 ] * 4
+RR = [ 0 ] * 8              # R0..R7, R5 to R7 are the extra registers
+STK = [ 0 ] * 8             # RSTK is STK[0]
+D = [ 0, 0 ]                # D0 D1
+PC = 0
+P = 0
+ST = 0
+HS = 0                      # MP SR SB XM
+OUT = 0
+IN = 0
+CARRY = 0
+DECIMAL = 0
+HALT = None                 # why the run stopped
+
+# how the field of an opcode is found
+M_FIXED = 0     # right and left are given
+M_P     = 1     # right and left are P
+M_WP    = 2     # right is given, left is P
+M_PLUS  = 3     # right is P, left is P plus left (LC LA)
+# jumps
+J_NONE   = 0
+J_ALWAYS = 1    # GOTO GOLONG GOVLNG, no ALU
+J_CARRY  = 2    # GOC
+J_NCARRY = 3    # GONC
+J_CALL   = 4    # GOSUB GOSUBL GOSBVL after the ALU pushed the return address
+J_TEST   = 5    # GOYES after a test that set the carry
+# returns
+R_NONE   = 0
+R_ALWAYS = 1    # RTN RTNSXM RTNSC RTNCC RTI
+R_CARRY  = 2    # RTNC RTNYES
+R_NCARRY = 3    # RTNNC
+# flags the sequencer sets from the opcode
+F_SETXM   = 1
+F_SETC    = 2
+F_CLRC    = 4
+F_SETDEC  = 8
+F_SETHEX  = 16
+
+# a decoded opcode, the fields of the microword and what the sequencer
+# takes from the nibbles
+Instr = namedtuple('Instr', 'length text alu src op2 dst forcedCarry forcedHex writeCarry writeDst writeSticky '
+                           'mode right left literal shiftLiteral shiftP flags jump ret push pull target')
+
+MASKS = [ [ ((1 << (4 * (left - right + 1))) - 1) << (4 * right) if left >= right else 0
+            for left in range(16) ] for right in range(16) ]
+# nibble adders of saturn_alru.v by a << 5 | b << 1 | carry: (sum, carry)
+ADD_DEC = []
+SUB_DEC = []
+for i in range(512):
+    a, b, c = i >> 5, (i >> 1) & 15, i & 1
+    s = a + b + c
+    ADD_DEC.append((((s & 15) + 6) & 15, 1) if s > 9 else (s & 15, 0))
+    s = (a - b - c) & 31
+    SUB_DEC.append((((s & 15) - 6) & 15 if s & 16 else s & 15, 1 if s > 10 else 0))
+del i, a, b, c, s
+
+DCACHE = dict()     # pc: Instr of the opcodes in ROM
+OPCODES = None
+OPINDEX = None
+WORDS = None
+ALU = dict()        # ALU_OP_ name without prefix: value
+SEL = dict()        # OP_ and K_ names without prefix: value
+
+# loads the opcode table, the microcode and the symbols
+def loadModel(mcName = MCFILE):
+    global OPCODES, OPINDEX, WORDS
+    OPCODES, OPINDEX = loadOpcodes()
+    WORDS = readWords(mcName)
+    tables = loadTables()
+    for table, prefix, names in ( ('ALU_OP', '`ALU_OP_', ALU), ('OP1', '`OP_', SEL), ('KOP', '`K_', SEL) ):
+        for symbol, value in tables[table][0].items():
+            names[symbol[len(prefix):]] = value
+    DCACHE.clear()
+# clears the registers and the flags, PC to 0
+def resetCore():
+    global PC, P, ST, HS, OUT, IN, CARRY, DECIMAL, HALT
+    ABCD[:] = [ 0 ] * 4
+    RR[:] = [ 0 ] * 8
+    STK[:] = [ 0 ] * 8
+    D[:] = [ 0, 0 ]
+    PC = P = ST = HS = OUT = IN = CARRY = DECIMAL = 0
+    HALT = None
+# loads a readmemh file from address 0, returns the number of nibbles
+def loadHex(fileName):
+    nibbles = readNibbles(fileName)[:MEMSIZE]
+    MEM[:] = bytearray(MEMSIZE)
+    MEM[:len(nibbles)] = bytearray(nibbles)
+    DCACHE.clear()
+    return len(nibbles)
+# returns the signed value of nibbles, the first is the low one
+def signedNibbles(nibbles):
+    v = 0
+    for n in reversed(nibbles):
+        v = (v << 4) | n
+    if nibbles[-1] & 8:
+        v -= 1 << (4 * len(nibbles))
+    return v
+# returns the value of nibbles, the first is the low one
+def nibblesValue(nibbles):
+    v = 0
+    for n in reversed(nibbles):
+        v = (v << 4) | n
+    return v
+# returns the opcode at pc decoded or None when it is not in the table
+def decodeAt(pc):
+    n = [ MEM[(pc + i) & ADDRMASK] for i in range(22) ]
+    op = decodeOpcode(OPCODES, OPINDEX, n)
+    if op == None:
+        return None
+    length = opcodeLength(op, n)
+    text = '{0:s} {1:s}'.format(''.join([ '{0:X}'.format(x) for x in n[:length] ]), op.name)
+    if op.args != '':
+        text = text + ' ' + op.args
+    (forcedCarry, forcedHex, writeCarry, writeDst, writeSticky, abit, condTrue, spare24, spare23,
+     fieldLeft, alu, src, op2, dst) = unpackWord(WORDS[sequencerAddress(n)])
+    op0, op1, op2n, op3 = n[0], n[1], n[2], n[3]
+    isLC = op0 == 0x3
+    isLA = op0 == 0x8 and op1 == 0x0 and op2n == 0x8 and op3 == 0x2
+    isLetExCP = op0 == 0x8 and op1 == 0x0 and op2n in (0xC, 0xD, 0xF)     # C=P n P=C n CPEX n
+    isCON = op0 == 0x8 and op1 == 0x1 and op2n == 0x8                     # A=A+CON
+    isACBIT = op0 == 0x8 and op1 == 0x0 and op2n == 0x8 and 0x4 <= op3 <= 0xB
+    # field
+    mode = M_FIXED
+    if fieldLeft == 6:
+        if op0 == 0x0:
+            field = op2n & 7
+        elif op0 == 0x1 or (op0 == 0x8 and op1 == 0x1 and op2n in (0x8, 0x9, 0xA)):
+            field = op3 & 7
+        else:
+            field = op1 & 7
+        right, left = FIELDS[field]
+        if right == None:
+            mode = M_P
+        elif left == None:
+            mode = M_WP
+    elif isLC or isLA:
+        mode = M_PLUS
+        right, left = 0, op1 if isLC else n[4]
+    elif isLetExCP:
+        right, left = op3, op3
+    else:
+        right = 0
+        left = 15 if fieldLeft == 7 else fieldLeft
+        if op0 == 0x1 and op1 == 0x5 and op2n & 8:     # DAT0=A n
+            left = op3
+    # literal, in the order of the sequencer
+    literal = 0
+    if isLC:
+        literal = nibblesValue(n[2:18])
+    elif isLA:
+        literal = nibblesValue(n[5:21])
+    elif isCON:
+        literal = n[5]
+    if isACBIT:
+        literal = 1 << n[4]
+    if op0 == 0x8 and 0x4 <= op1 <= 0x7:               # ST=0 n ?ST=1 n
+        literal = 1 << op2n
+    if (op0 == 0x1 and op1 in (0x6, 0x7, 0x8, 0xC, 0x9, 0xA, 0xB, 0xD, 0xE, 0xF)) or \
+       (op0 == 0x8 and op1 in (0x2, 0x3, 0x8, 0x9)):  # Dn=Dn+n Dn=hh ?P=n HS=0 n
+        literal = (literal & ~15) | op2n
+    if op0 == 0x1 and op1 in (0x9, 0xA, 0xB, 0xD, 0xE, 0xF):
+        literal = (literal & 15) | (nibblesValue(n[3:7]) << 4)
+    if op0 == 0x2:
+        literal = (literal & ~15) | op1
+    # control
+    jump, ret, push, pull, target = J_NONE, R_NONE, False, False, 0
+    if op0 == 0x4 or op0 == 0x5:
+        if op1 == 0 and op2n == 0:
+            ret = R_CARRY if op0 == 0x4 else R_NCARRY
+        else:
+            jump = J_CARRY if op0 == 0x4 else J_NCARRY
+            target = pc + 1 + signedNibbles(n[1:3])
+    elif op0 == 0x6:
+        jump, target = J_ALWAYS, pc + 1 + signedNibbles(n[1:4])
+    elif op0 == 0x7:
+        jump, target, push = J_CALL, pc + 4 + signedNibbles(n[1:4]), True
+        literal = (pc + 4) & ADDRMASK
+    elif op0 == 0x8 and op1 == 0xC:
+        jump, target = J_ALWAYS, pc + 2 + signedNibbles(n[2:6])
+    elif op0 == 0x8 and op1 == 0xE:
+        jump, target, push = J_CALL, pc + 6 + signedNibbles(n[2:6]), True
+        literal = (pc + 6) & ADDRMASK
+    elif op0 == 0x8 and op1 == 0xD:
+        jump, target = J_ALWAYS, nibblesValue(n[2:7])
+    elif op0 == 0x8 and op1 == 0xF:
+        jump, target, push = J_CALL, nibblesValue(n[2:7]), True
+        literal = (pc + 7) & ADDRMASK
+    elif abit or condTrue:
+        offset = n[5:7] if isACBIT else n[3:5]
+        if offset == [ 0, 0 ]:
+            ret = R_CARRY
+        else:
+            jump, target = J_TEST, pc + (5 if isACBIT else 3) + signedNibbles(offset)
+    elif op0 == 0x0 and (op1 <= 0x3 or op1 == 0xF):
+        ret = R_ALWAYS
+    flags = 0
+    if op0 == 0x0:
+        flags = { 0x0: F_SETXM, 0x2: F_SETC, 0x3: F_CLRC, 0x4: F_SETHEX, 0x5: F_SETDEC }.get(op1, 0)
+        push = op1 == 0x6
+        pull = op1 == 0x7
+    return Instr(length, text, alu, src, op2, dst, forcedCarry, forcedHex, writeCarry, writeDst, writeSticky,
+                 mode, right, left, literal, isLC or isLA or isCON, isLetExCP, flags, jump, ret, push, pull,
+                 target & ADDRMASK)
+# returns the value of a source register, the OP_ mux of saturn_alru.v
+def readSource(sel, literal):
+    group = sel >> 3
+    if group == 0:
+        return ABCD[sel & 3]
+    if group == 1:
+        return RR[sel & 7]
+    if group == 3:
+        return literal
+    if group == 4:
+        k = sel & 7
+        if k == 0:
+            return PC
+        if k == 1:
+            return STK[0]
+        if k == 2 or k == 3:
+            return D[k - 2]
+        if k == 4:
+            return ST
+        if k == 5:
+            return IN
+        if k == 6:
+            return P * ONES
+        return 0    # CONFIG
+    if group == 5:
+        return HS
+    if group == 6:
+        return NINES if DECIMAL else W64
+    return 0        # memory and zero
+# returns the value of the second operand, the K_ mux of saturn_alru.v
+def readOp2(sel, literal):
+    if sel <= 3:
+        return ABCD[sel]
+    if sel == 4:
+        return NINES if DECIMAL else W64
+    if sel == 5:
+        return literal
+    return D[sel - 6]
+# writes the nibbles of mask of a register, the write back of saturn_alru.v
+def writeRegister(sel, value, mask, right, shiftP):
+    global PC, P, ST, HS, OUT
+    group = sel >> 3
+    if group == 0:
+        ABCD[sel & 3] = (ABCD[sel & 3] & ~mask) | (value & mask)
+    elif group == 1:
+        RR[sel & 7] = (RR[sel & 7] & ~mask) | (value & mask)
+    elif group == 4:
+        k = sel & 7
+        if k == 0:
+            PC = value & ADDRMASK
+        elif k == 1:
+            STK[0] = value & ADDRMASK
+        elif k == 2 or k == 3:
+            mask &= ADDRMASK
+            D[k - 2] = (D[k - 2] & ~mask) | (value & mask)
+        elif k == 4:
+            ST = value & 0xFFFF
+        elif k == 5:
+            OUT = value & 0xFFF
+        elif k == 6:
+            P = (value >> (4 * right)) & 15 if shiftP else value & 15
+    elif group == 5:
+        HS = value & 15
+# returns count nibbles of memory at addr, the first is the low one
+def readMemory(addr, count):
+    v = 0
+    for i in range(count - 1, -1, -1):
+        v = (v << 4) | MEM[(addr + i) & ADDRMASK]
+    return v
+# writes count nibbles of value to memory at addr, ROM is not written
+def writeMemory(addr, value, count):
+    for i in range(count):
+        a = (addr + i) & ADDRMASK
+        if a >= ROMSIZE:
+            MEM[a] = value & 15
+        value >>= 4
+# adds or subtracts nibble by nibble from right to left in decimal, returns
+# the result and the carry of the left nibble
+def decimalAdd(a, b, carry, right, left, table):
+    q = 0
+    for i in range(right, left + 1):
+        s = 4 * i
+        r, carry = table[(((a >> s) & 15) << 5) | (((b >> s) & 15) << 1) | carry]
+        q |= r << s
+    return q, carry
+# executes the ALU operation of an opcode
+def executeALU(d):
+    global CARRY, HS
+    mode, right, left = d.mode, d.right, d.left
+    if mode == M_P:
+        right = left = P
+    elif mode == M_WP:
+        left = P
+    elif mode == M_PLUS:
+        right, left = P, (P + left) & 15
+    mask = MASKS[right][left]
+    literal = d.literal
+    if d.shiftLiteral:
+        literal = (literal << (4 * right)) & W64
+    a = readSource(d.src, literal) & mask
+    b = readOp2(d.op2, literal)
+    bm = b & mask
+    op = d.alu
+    carry = 0
+    sticky = 0
+    q = a
+    if op == ALU['TFR'] or op == ALU['EX']:
+        pass
+    elif op == ALU['ADD'] or op == ALU['SUB']:
+        if left < right:
+            q = 0
+        elif DECIMAL and not d.forcedHex:
+            q, carry = decimalAdd(a, bm, d.forcedCarry, right, left, ADD_DEC if op == ALU['ADD'] else SUB_DEC)
+        else:
+            s = 4 * right
+            width = 4 * (left - right + 1)
+            if op == ALU['ADD']:
+                r = (a >> s) + (bm >> s) + d.forcedCarry
+                carry = r >> width
+            else:
+                r = (a >> s) - (bm >> s) - d.forcedCarry
+                carry = 1 if r < 0 else 0
+            q = (r << s) & mask
+    elif op == ALU['AND'] or op == ALU['TST0'] or op == ALU['TST1']:
+        q = a & bm
+        if op == ALU['TST0']:
+            carry = 1 if q & 0xFFFF == 0 else 0
+        elif op == ALU['TST1']:
+            carry = 1 if q & 0xFFFF != 0 else 0
+    elif op == ALU['OR']:
+        q = a | bm
+    elif op == ALU['ANDN']:
+        q = a & ~bm
+    elif op == ALU['SL']:
+        q = (a << 4) & W64
+        sticky = 1 if (a >> (4 * left)) & 15 else 0
+    elif op == ALU['SR']:
+        q = a >> 4
+        sticky = 1 if (a >> (4 * right)) & 15 else 0
+    elif op == ALU['SRB']:
+        q = a >> 1
+        sticky = (a >> (4 * right)) & 1
+    elif op == ALU['SLC']:
+        q = ((a << 4) | (a >> 60)) & W64
+    elif op == ALU['SRC']:
+        q = (a >> 4) | ((a & 15) << 60)
+    elif op == ALU['EQ']:
+        carry = 1 if a == bm else 0
+    elif op == ALU['NEQ']:
+        carry = 1 if a != bm else 0
+    elif op == ALU['GTEQ']:
+        carry = 1 if a >= bm else 0
+    elif op == ALU['GT']:
+        carry = 1 if a > bm else 0
+    elif op == ALU['LTEQ']:
+        carry = 1 if a <= bm else 0
+    elif op == ALU['LT']:
+        carry = 1 if a < bm else 0
+    elif op == ALU['RD']:
+        q = readMemory(b & ADDRMASK, max(left - right + 1, 0)) << (4 * right)
+    elif op == ALU['WR']:
+        writeMemory(b & ADDRMASK, a >> (4 * right), max(left - right + 1, 0))
+    if d.writeCarry:
+        CARRY = carry
+    if d.writeSticky:
+        HS = (HS & ~2) | (sticky << 1)
+    if d.writeDst:
+        writeRegister(d.dst, q, mask, right, d.shiftP)
+    if op == ALU['EX']:
+        writeRegister(d.src, bm, mask, right, d.shiftP)
+# executes the opcode at PC, returns True when the run has to stop
+def stepCore():
+    global PC, CARRY, DECIMAL, HS, HALT
+    pc = PC
+    d = DCACHE.get(pc)
+    if d == None:
+        d = decodeAt(pc)
+        if d == None:
+            HALT = 'unknown opcode at {0:05X}'.format(pc)
+            return True
+        if pc < ROMSIZE:
+            DCACHE[pc] = d
+    flags = d.flags
+    if flags:
+        if flags & F_SETXM:
+            HS |= 1
+        if flags & F_SETC:
+            CARRY = 1
+        if flags & F_CLRC:
+            CARRY = 0
+        if flags & F_SETDEC:
+            DECIMAL = 1
+        if flags & F_SETHEX:
+            DECIMAL = 0
+    jump = d.jump
+    if jump == J_ALWAYS or (jump == J_CARRY and CARRY) or (jump == J_NCARRY and not CARRY):
+        if d.target == pc:
+            HALT = 'loop at {0:05X}'.format(pc)
+            return True
+        PC = d.target
+        return False
+    # PC holds the address of the next opcode while the ALU runs, A=PC
+    PC = (pc + d.length) & ADDRMASK
+    if d.push:
+        STK[1:] = STK[:-1]
+    if d.alu != 0:
+        executeALU(d)
+    if d.pull:
+        STK[:-1] = STK[1:]
+        STK[-1] = 0
+    ret = d.ret
+    if ret == R_ALWAYS or (ret == R_CARRY and CARRY) or (ret == R_NCARRY and not CARRY):
+        PC = STK[0]
+        STK[:-1] = STK[1:]
+        STK[-1] = 0
+    elif jump == J_CALL or (jump == J_TEST and CARRY):
+        PC = d.target
+    return False
+# returns the text of the registers like the RTL with showregs
+def registersText():
+    return ('PC: {0:05X} P:{1:X} A:{2:016X} B:{3:016X} C:{4:016X} D:{5:016X}\n'
+            'D0:{6:05X} D1:{7:05X} ST:{8:04X} HS:{9:X} CY:{10:d} {11:s} RSTK:{12:s}').format(
+            PC, P, ABCD[0], ABCD[1], ABCD[2], ABCD[3], D[0], D[1], ST, HS, CARRY,
+            'DEC' if DECIMAL else 'HEX', ' '.join([ '{0:05X}'.format(a) for a in STK ]))
+# runs max steps opcodes or until the opcode at untilPc, prints the opcodes
+# when trace is True, the registers after them when regs is True
+# returns the number of opcodes executed and the elapsed time in seconds
+def runCore(steps = MAXSTEPS, untilPc = None, trace = False, regs = False):
+    global HALT
+    count = 0
+    step = stepCore
+    start = time.time()
+    if trace or regs or untilPc != None:
+        while count < steps:
+            if PC == untilPc:
+                HALT = 'PC {0:05X} reached'.format(PC)
+                break
+            if trace:
+                d = DCACHE.get(PC) or decodeAt(PC)
+                print '{0:05X} {1:s}'.format(PC, d.text if d != None else '?')
+            if step():
+                break
+            count += 1
+            if regs:
+                print registersText()
+    else:
+        while count < steps:
+            if step():
+                break
+            count += 1
+    return count, time.time() - start
+
+
+if __name__ == '__main__':
+    args = argv[1:]
+    mcName = MCFILE
+    steps = MAXSTEPS
+    untilPc = None
+    trace = False
+    regs = False
+    while len(args) > 0 and args[0][0] == '-':
+        if args[0] == '-m' and len(args) > 1:
+            mcName = args[1]
+            args = args[1:]
+        elif args[0] == '-n' and len(args) > 1:
+            steps = int(args[1])
+            args = args[1:]
+        elif args[0] == '-u' and len(args) > 1:
+            untilPc = int(args[1], 16)
+            args = args[1:]
+        elif args[0] == '-t':
+            trace = True
+        elif args[0] == '-r':
+            regs = True
+        else:
+            print 'Unknown option {0:s}'.format(args[0])
+            exit(1)
+        args = args[1:]
+    if len(args) != 1:
+        print 'usage: saturn_sim.py [-m microcode] [-n steps] [-u pc] [-t] [-r] <hex file>'
+        exit(1)
+    loadModel(mcName)
+    print '{0:d} nibbles read'.format(loadHex(args[0]))
+    resetCore()
+    count, elapsed = runCore(steps, untilPc, trace, regs)
+    if HALT != None:
+        print HALT
+    print registersText()
+    rate = count / elapsed if elapsed > 0 else 0.0
+    print '{0:d} opcodes in {1:.3f} s, {2:.0f} opcodes/s, {3:.1f} M/min'.format(count, elapsed, rate, rate * 60 / 1e6)